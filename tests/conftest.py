@@ -0,0 +1,48 @@
+import argparse
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture
+def cert(tmp_path) -> Path:
+    # The client certificate the camera presents to the NVR, as in the docs
+    if not shutil.which("openssl"):
+        pytest.skip("openssl is not installed")
+    key, cert = tmp_path / "private.key", tmp_path / "client.pem"
+    subprocess.run(
+        ["openssl", "ecparam", "-out", key, "-name", "prime256v1", "-genkey"],
+        check=True,
+        capture_output=True,
+    )
+    subprocess.run(
+        ["openssl", "req", "-new", "-x509", "-sha256", "-days", "1"]
+        + ["-key", key, "-out", cert, "-subj", "/CN=camera.ubnt.dev"],
+        check=True,
+        capture_output=True,
+    )
+    cert.write_bytes(cert.read_bytes() + key.read_bytes())
+    return cert
+
+
+@pytest.fixture
+def parse_args(cert):
+    """
+    Parse a command line like the entry point: `argv` are the global
+    arguments the cameras depend on, then the subcommand and its arguments.
+    """
+
+    def parse(impl: str, cls, argv: list[str]) -> argparse.Namespace:
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--host", "-H", required=True)
+        parser.add_argument("--cert", "-c", required=True)
+        parser.add_argument("--mac", "-m", default="AABBCCDDEEFF")
+        parser.add_argument("--ip", "-i", default="192.168.1.10")
+        parser.add_argument("--name", "-n", default="unifi-cam-proxy")
+        sp = parser.add_subparsers(dest="impl", required=True)
+        cls.add_parser(sp.add_parser(impl))
+        return parser.parse_args(["-H", "192.0.2.2", "-c", str(cert)] + argv)
+
+    return parse
@@ -0,0 +1,100 @@
+from unifi.alertstream import AlertStreamParser, _sample_part, parse_boundary
+
+
+def xml_part(event_type: str, state: str = "active", length: bool = True) -> bytes:
+    part = _sample_part(event_type, state, None)
+    if not length:
+        headers, _, body = part.partition(b"\r\n\r\n")
+        headers = b"\r\n".join(
+            line
+            for line in headers.split(b"\r\n")
+            if not line.lower().startswith(b"content-length")
+        )
+        part = headers + b"\r\n\r\n" + body
+    return part
+
+
+def jpeg_part(size: int) -> bytes:
+    # JPEG data can contain anything, including what looks like an event
+    data = (b"<eventType>VMD</eventType>" * size)[:size]
+    return (
+        b"--boundary\r\nContent-Type: image/jpeg\r\n"
+        + f"Content-Length: {size}\r\n\r\n".encode()
+        + data
+    )
+
+
+def feed(parser: AlertStreamParser, data: bytes, chunk_size: int) -> list:
+    alerts = []
+    for offset in range(0, len(data), chunk_size):
+        alerts += parser.feed(data[offset : offset + chunk_size])
+    return alerts
+
+
+def summary(alerts) -> list:
+    return [(a.event_type, a.channel, a.active, a.target_type) for a in alerts]
+
+
+def test_content_length():
+    data = xml_part("VMD") + xml_part("VMD", "inactive")
+    assert summary(AlertStreamParser().feed(data)) == [
+        ("VMD", "1", True, None),
+        ("VMD", "1", False, None),
+    ]
+
+
+def test_without_content_length():
+    data = xml_part("VMD", length=False) + xml_part("linedetection", length=False)
+    # A part without a length ends at the next delimiter
+    assert summary(AlertStreamParser().feed(data)) == [("VMD", "1", True, None)]
+    parser = AlertStreamParser()
+    assert len(parser.feed(data + b"--boundary\r\n")) == 2
+
+
+def test_split_across_feeds():
+    data = xml_part("VMD") + xml_part("fielddetection", length=False) + xml_part("VMD")
+    expected = [
+        ("VMD", "1", True, None),
+        ("fielddetection", "1", True, None),
+        ("VMD", "1", True, None),
+    ]
+    # Every chunk size splits a delimiter or header somewhere
+    for chunk_size in (1, 2, 3, 5, 7, 64):
+        assert summary(feed(AlertStreamParser(), data, chunk_size)) == expected
+
+    parser = AlertStreamParser()
+    delimiter = data.index(b"--boundary", 1)
+    assert len(parser.feed(data[: delimiter + 4])) == 1
+    assert len(parser.feed(data[delimiter + 4 :])) == 2
+
+
+def test_jpeg_parts_are_skipped():
+    data = jpeg_part(5000) + xml_part("VMD") + jpeg_part(10) + xml_part("VMD")
+    for chunk_size in (1, 100, len(data)):
+        parser = AlertStreamParser()
+        assert len(feed(parser, data, chunk_size)) == 2
+        # Nothing of the JPEGs is buffered
+        assert len(parser._buffer) < 100
+
+
+def test_videoloss_heartbeats_ignored():
+    data = (
+        xml_part("videoloss", "inactive")
+        + xml_part("VMD")
+        + xml_part("videoloss", "inactive")
+    )
+    assert summary(AlertStreamParser().feed(data)) == [("VMD", "1", True, None)]
+
+
+def test_target_type():
+    data = _sample_part("linedetection", "active", "Human")
+    assert summary(AlertStreamParser().feed(data)) == [
+        ("linedetection", "1", True, "human")
+    ]
+
+
+def test_custom_boundary():
+    boundary = parse_boundary('multipart/mixed; boundary="MIME_boundary"')
+    assert boundary == b"MIME_boundary"
+    data = xml_part("VMD").replace(b"--boundary", b"--MIME_boundary")
+    assert len(AlertStreamParser(boundary).feed(data)) == 1
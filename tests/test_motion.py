@@ -0,0 +1,137 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from unifi.motion import (  # noqa: E402
+    PIXEL_THRESHOLD,
+    MotionDetector,
+    MotionZone,
+    ZoneScorer,
+    parse_analytics_settings,
+    polygon_mask,
+)
+
+WIDTH, HEIGHT = 16, 8
+
+
+def frame(value: int = 100, box=None, box_value: int = 200) -> bytes:
+    pixels = np.full((HEIGHT, WIDTH), value, np.uint8)
+    if box:
+        x1, y1, x2, y2 = box
+        pixels[y1:y2, x1:x2] = box_value
+    return pixels.tobytes()
+
+
+def test_first_frame_has_no_motion():
+    detector = MotionDetector(WIDTH, HEIGHT)
+    assert not detector.process(frame(box=(0, 0, 4, 4))).any()
+
+
+def test_moving_object():
+    detector = MotionDetector(WIDTH, HEIGHT)
+    detector.process(frame())
+    moving = detector.process(frame(box=(2, 1, 6, 5)))
+
+    assert moving.shape == (HEIGHT, WIDTH)
+    assert moving[1:5, 2:6].all()
+    assert moving.sum() == 16
+
+
+def test_small_changes_are_noise():
+    detector = MotionDetector(WIDTH, HEIGHT)
+    detector.process(frame())
+    assert not detector.process(frame(100 + PIXEL_THRESHOLD)).any()
+
+
+def test_object_that_stopped_moving():
+    detector = MotionDetector(WIDTH, HEIGHT)
+    detector.process(frame())
+    detector.process(frame(box=(2, 1, 6, 5)))
+    # Still differs from the background, but not from the previous frame
+    assert not detector.process(frame(box=(2, 1, 6, 5))).any()
+
+
+LEFT = [(0.0, 0.0), (0.5, 0.0), (0.5, 1.0), (0.0, 1.0)]
+RIGHT = [(0.5, 0.0), (1.0, 0.0), (1.0, 1.0), (0.5, 1.0)]
+
+
+def moving(*pixels) -> "np.ndarray":
+    mask = np.zeros((HEIGHT, WIDTH), bool)
+    for x, y in pixels:
+        mask[y, x] = True
+    return mask
+
+
+def test_polygon_mask():
+    mask = polygon_mask(LEFT, WIDTH, HEIGHT)
+    assert mask[:, :8].all()
+    assert not mask[:, 8:].any()
+
+    # Pixels are inside when their centre is
+    triangle = polygon_mask([(0.0, 0.0), (1.0, 0.0), (0.0, 1.0)], WIDTH, HEIGHT)
+    assert triangle[0, 0] and not triangle[HEIGHT - 1, WIDTH - 1]
+    assert [int(row.sum()) for row in triangle] == [15, 13, 11, 9, 7, 5, 3, 1]
+
+
+def test_whole_frame_threshold():
+    scorer = ZoneScorer([], [], WIDTH, HEIGHT, threshold=10)
+
+    # 1 of 128 pixels is 8% of the full scale, 2 pixels 16%
+    assert scorer.score(moving((0, 0))) == ({"0": 8}, {})
+    assert scorer.score(moving((0, 0), (1, 0))) == ({"0": 16}, {"0": 16})
+    assert scorer.score(np.ones((HEIGHT, WIDTH), bool)) == ({"0": 100}, {"0": 100})
+
+
+def test_zone_sensitivity():
+    zones = [MotionZone("1", LEFT, 50), MotionZone("2", RIGHT, 90)]
+    scorer = ZoneScorer(zones, [], WIDTH, HEIGHT, threshold=10)
+    # 4 of 64 pixels in each zone
+    mask = moving((0, 0), (1, 0), (2, 0), (3, 0), (8, 0), (9, 0), (10, 0), (11, 0))
+
+    levels, active = scorer.score(mask)
+    assert levels == {"1": 62, "2": 62}
+    assert active == {"1": 62, "2": 62}
+
+    levels, active = scorer.score(moving((0, 0), (1, 0), (8, 0), (9, 0)))
+    assert levels == {"1": 31, "2": 31}
+    assert active == {"2": 31}
+
+
+def test_privacy_mask():
+    scorer = ZoneScorer([], [LEFT], WIDTH, HEIGHT, threshold=10)
+
+    assert scorer.score(moving(*((x, 0) for x in range(8)))) == ({"0": 0}, {})
+    # The zone is the visible half only, 2 of 64 pixels
+    assert scorer.score(moving((8, 0), (9, 0))) == ({"0": 31}, {"0": 31})
+
+
+def test_coarse_grid():
+    scorer = ZoneScorer([MotionZone("1", LEFT, 50)], [], WIDTH, HEIGHT, 10)
+    grid = np.zeros((2, 4), bool)
+    grid[0, 0] = True
+
+    # One cell of the grid covers 8 of the zone's 64 pixels
+    assert scorer.score(grid) == ({"1": 100}, {"1": 100})
+    assert scorer.score(np.zeros((2, 4), bool)) == ({"1": 0}, {})
+
+
+def test_parse_analytics_settings():
+    zones, masks = parse_analytics_settings(
+        {
+            "motionZones": [
+                {"id": 3, "points": [[0, 0], [1, 0], [1, 1]], "sensitivity": 120},
+                {"id": 4, "points": [[0, 0], [1, 0]]},
+                {"coord": [[0, 0], [0.5, 0], [0.5, 1]]},
+                {"id": 5, "points": LEFT, "sensitivity": None},
+                {"id": 6, "points": LEFT, "sensitivity": "high"},
+            ],
+            "privacyZones": [{"points": LEFT}],
+        }
+    )
+    assert zones == [
+        MotionZone("3", [(0, 0), (1, 0), (1, 1)], 100),
+        MotionZone("2", [(0, 0), (0.5, 0), (0.5, 1)], 50),
+        MotionZone("5", LEFT, 50),
+        MotionZone("6", LEFT, 50),
+    ]
+    assert masks == [LEFT]
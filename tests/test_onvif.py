@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import re
+import xml.etree.ElementTree as ET
+
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+test_utils = pytest.importorskip("aiohttp.test_utils")
+pytest.importorskip("httpx")
+
+from unifi import onvif  # noqa: E402
+from unifi.onvif import OnvifError, OnvifEventsClient  # noqa: E402
+
+ENVELOPE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<s:Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope"'
+    ' xmlns:wsa="http://www.w3.org/2005/08/addressing"'
+    ' xmlns:wsnt="http://docs.oasis-open.org/wsn/b-2"'
+    ' xmlns:tev="http://www.onvif.org/ver10/events/wsdl"'
+    ' xmlns:tds="http://www.onvif.org/ver10/device/wsdl"'
+    ' xmlns:trt="http://www.onvif.org/ver10/media/wsdl"'
+    ' xmlns:tt="http://www.onvif.org/ver10/schema"'
+    ' xmlns:tns1="http://www.onvif.org/ver10/topics">'
+    "<s:Body>{}</s:Body></s:Envelope>"
+)
+
+
+def notification(topic: str, state: str) -> str:
+    return (
+        "<wsnt:NotificationMessage>"
+        f'<wsnt:Topic Dialect="http://www.onvif.org/ver10/tev/topicExpression'
+        f'/ConcreteSet">tns1:{topic}</wsnt:Topic>'
+        '<wsnt:Message><tt:Message UtcTime="2024-01-01T00:00:00Z"'
+        ' PropertyOperation="Changed">'
+        '<tt:Source><tt:SimpleItem Name="VideoSourceConfigurationToken"'
+        ' Value="VideoSource_1"/></tt:Source>'
+        f'<tt:Data><tt:SimpleItem Name="IsMotion" Value="{state}"/></tt:Data>'
+        "</tt:Message></wsnt:Message></wsnt:NotificationMessage>"
+    )
+
+
+class OnvifStub:
+    """A camera answering the handful of ONVIF calls the client makes."""
+
+    def __init__(self, username: str = "admin") -> None:
+        self.username = username
+        self.actions: list[str] = []
+        self.pulls = [
+            [notification("RuleEngine/CellMotionDetector/Motion", "true")],
+            [],
+            [notification("RuleEngine/CellMotionDetector/Motion", "false")],
+        ]
+        self.app = web.Application()
+        self.app.router.add_post("/onvif/{service}", self.handle)
+        self.server = test_utils.TestServer(self.app, host="127.0.0.1")
+
+    def url(self, service: str) -> str:
+        return f"http://127.0.0.1:{self.server.port}/onvif/{service}"
+
+    async def handle(self, request: "web.Request") -> "web.Response":
+        body = await request.text()
+        action = re.search(r"<wsa:Action>[^<]*/([^</]+)</wsa:Action>", body)
+        name = action.group(1) if action else ""
+        self.actions.append(name)
+        username = ET.fromstring(body).find(f".//{{{onvif.WSSE_NS}}}Username")
+        if name != "GetSystemDateAndTime" and (
+            username is None or username.text != self.username
+        ):
+            return self.reply(
+                "<s:Fault><s:Reason><s:Text>Not authorized</s:Text></s:Reason>"
+                "</s:Fault>",
+                status=400,
+            )
+        return self.reply(getattr(self, name)(body))
+
+    def reply(self, body: str, status: int = 200) -> "web.Response":
+        return web.Response(
+            body=ENVELOPE.format(body).encode(),
+            status=status,
+            content_type="application/soap+xml",
+        )
+
+    def GetSystemDateAndTime(self, body: str) -> str:
+        return (
+            "<tds:GetSystemDateAndTimeResponse><tds:SystemDateAndTime>"
+            "<tt:UTCDateTime><tt:Time><tt:Hour>12</tt:Hour><tt:Minute>0"
+            "</tt:Minute><tt:Second>0</tt:Second></tt:Time><tt:Date>"
+            "<tt:Year>2024</tt:Year><tt:Month>1</tt:Month><tt:Day>1</tt:Day>"
+            "</tt:Date></tt:UTCDateTime></tds:SystemDateAndTime>"
+            "</tds:GetSystemDateAndTimeResponse>"
+        )
+
+    def GetCapabilities(self, body: str) -> str:
+        return (
+            "<tds:GetCapabilitiesResponse><tds:Capabilities>"
+            f"<tt:Events><tt:XAddr>{self.url('events')}</tt:XAddr></tt:Events>"
+            f"<tt:Media><tt:XAddr>{self.url('media')}</tt:XAddr></tt:Media>"
+            "</tds:Capabilities></tds:GetCapabilitiesResponse>"
+        )
+
+    def GetProfiles(self, body: str) -> str:
+        profiles = "".join(
+            f'<trt:Profiles token="Profile_{i}"><tt:Name>Stream {i}</tt:Name>'
+            '<tt:VideoSourceConfiguration token="VideoSourceConfig">'
+            "<tt:SourceToken>VideoSource_1</tt:SourceToken>"
+            "</tt:VideoSourceConfiguration></trt:Profiles>"
+            for i in (1, 2)
+        )
+        return f"<trt:GetProfilesResponse>{profiles}</trt:GetProfilesResponse>"
+
+    def CreatePullPointSubscriptionRequest(self, body: str) -> str:
+        return (
+            "<tev:CreatePullPointSubscriptionResponse><tev:SubscriptionReference>"
+            f"<wsa:Address>{self.url('subscription')}</wsa:Address>"
+            "</tev:SubscriptionReference></tev:CreatePullPointSubscriptionResponse>"
+        )
+
+    def PullMessagesRequest(self, body: str) -> str:
+        messages = self.pulls.pop(0) if self.pulls else []
+        return (
+            f"<tev:PullMessagesResponse>{''.join(messages)}"
+            "</tev:PullMessagesResponse>"
+        )
+
+    def RenewRequest(self, body: str) -> str:
+        return "<wsnt:RenewResponse/>"
+
+    def UnsubscribeRequest(self, body: str) -> str:
+        return "<wsnt:UnsubscribeResponse/>"
+
+
+def run_with_stub(test, login: str = "admin", **kwargs) -> "OnvifStub":
+    async def main():
+        stub = OnvifStub(**kwargs)
+        await stub.server.start_server()
+        try:
+            client = OnvifEventsClient(
+                "127.0.0.1",
+                stub.server.port,
+                login,
+                "secret",
+                logging.getLogger(__name__),
+            )
+            await test(client)
+        finally:
+            await stub.server.close()
+        return stub
+
+    return asyncio.run(main())
+
+
+def test_video_sources():
+    async def test(client):
+        assert await client.video_sources() == {
+            "Profile_1": "VideoSource_1",
+            "Profile_2": "VideoSource_1",
+        }
+
+    stub = run_with_stub(test)
+    assert stub.actions == ["GetSystemDateAndTime", "GetCapabilities", "GetProfiles"]
+
+
+def test_pull_point_events(monkeypatch):
+    # Renew after every pull
+    monkeypatch.setattr(onvif, "TERMINATION_TIME", 0)
+    notifications = []
+
+    async def test(client):
+        events = client.events()
+        async for notification in events:
+            notifications.append(notification)
+            if len(notifications) == 2:
+                break
+        await events.aclose()
+
+    stub = run_with_stub(test)
+    assert [(n.topic, n.state) for n in notifications] == [
+        ("RuleEngine/CellMotionDetector/Motion", True),
+        ("RuleEngine/CellMotionDetector/Motion", False),
+    ]
+    assert notifications[0].source == {"VideoSourceConfigurationToken": "VideoSource_1"}
+    assert stub.actions == [
+        "GetSystemDateAndTime",
+        "GetCapabilities",
+        "CreatePullPointSubscriptionRequest",
+        "PullMessagesRequest",
+        "RenewRequest",
+        "PullMessagesRequest",
+        "RenewRequest",
+        "PullMessagesRequest",
+        "UnsubscribeRequest",
+    ]
+
+
+def test_fault():
+    async def test(client):
+        with pytest.raises(OnvifError, match="Not authorized"):
+            await client.video_sources()
+
+    run_with_stub(test, username="operator")
+
+
+def test_username_is_escaped():
+    async def test(client):
+        assert len(await client.video_sources()) == 2
+
+    run_with_stub(test, login="R&D <admin>", username="R&D <admin>")
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("websockets")
+
+from unifi.cams.base import UnifiCamBase  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# Seconds resolving the stream source takes, during which the pre-warm is
+# still in progress
+RESOLVE_TIME = 0.1
+PREWARM_TIMEOUT = 0.3
+
+# Produces no output and runs until killed, like ffmpeg waiting on a camera
+FFMPEG = """#!/bin/sh
+case "$*" in
+    *"-h full"*) echo timeout ;;
+    *) exec sleep 30 ;;
+esac
+"""
+
+
+class FakeCam(UnifiCamBase):
+    def __init__(self, args, logger) -> None:
+        super().__init__(args, logger)
+        self.spawned: list[str] = []
+
+    async def get_snapshot(self) -> Path:
+        raise NotImplementedError
+
+    async def get_stream_source(self, stream_index: str) -> str:
+        await asyncio.sleep(RESOLVE_TIME)
+        return f"rtsp://192.0.2.1/{stream_index}"
+
+    async def spawn_video_stream(self, stream_index: str, stream_name: str):
+        self.spawned.append(stream_index)
+        return await super().spawn_video_stream(stream_index, stream_name)
+
+
+@pytest.fixture
+def make_cam(tmp_path, monkeypatch, parse_args):
+    (tmp_path / "ffmpeg").write_text(FFMPEG)
+    (tmp_path / "ffmpeg").chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+
+    def make() -> FakeCam:
+        args = parse_args(
+            "fake",
+            FakeCam,
+            ["fake", "--ffmpeg-args", "-c copy", "--stream-cache-dir", ""]
+            + ["--prewarm-streams", "video1"]
+            + ["--prewarm-timeout", str(PREWARM_TIMEOUT)],
+        )
+        return FakeCam(args, logger)
+
+    return make
+
+
+async def close(cam: FakeCam) -> None:
+    cam.close_streams()
+    # Reap the killed ingests before the loop is closed
+    await asyncio.gather(*(p._proc.wait() for p in cam._pipelines.values()))
+
+
+async def nvr() -> "asyncio.Server":
+    async def discard(reader, writer):
+        await reader.read()
+        writer.close()
+
+    return await asyncio.start_server(discard, "127.0.0.1", 0)
+
+
+def test_released_after_timeout(make_cam):
+    async def main():
+        cam = make_cam()
+        try:
+            await cam.prewarm_streams()
+            pipeline = cam._pipelines["video1"]
+            alive = pipeline.is_alive()
+            await asyncio.sleep(PREWARM_TIMEOUT + 0.2)
+            return alive, pipeline.is_alive()
+        finally:
+            await close(cam)
+
+    assert asyncio.run(main()) == (True, False)
+
+
+def test_request_during_prewarm_reuses_ingest(make_cam):
+    async def main():
+        cam = make_cam()
+        server = await nvr()
+        try:
+            prewarm = asyncio.create_task(cam.prewarm_streams())
+            await asyncio.sleep(RESOLVE_TIME / 2)
+            # The NVR asks for the stream while its source is still resolved
+            await cam.start_video_stream(
+                "video1", "stream_name", server.sockets[0].getsockname()[:2]
+            )
+            await prewarm
+            pipeline = cam._pipelines["video1"]
+            # An attached stream is not released when the pre-warm times out
+            await asyncio.sleep(PREWARM_TIMEOUT + 0.2)
+            return cam.spawned, pipeline.stream_name, pipeline.is_alive()
+        finally:
+            await close(cam)
+            server.close()
+
+    assert asyncio.run(main()) == (["video1"], "stream_name", True)
@@ -0,0 +1,181 @@
+import asyncio
+import builtins
+import io
+import logging
+import tempfile
+import time
+from pathlib import Path
+
+import pytest
+
+reolinkapi = pytest.importorskip("reolinkapi")
+web = pytest.importorskip("aiohttp.web")
+test_utils = pytest.importorskip("aiohttp.test_utils")
+
+from unifi.cams.reolink import Reolink  # noqa: E402
+from unifi.loop_monitor import LoopMonitor  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# Seconds each call of the fake SDK, and each file opened on the slow disk,
+# blocks its thread
+BLOCK = 0.3
+# Longest the event loop may be held up meanwhile
+MAX_LAG = 0.03
+
+SNAPSHOT = b"\xff\xd8" + bytes(1024) + b"\xff\xd9"
+
+
+class BlockingCamera:
+    def __init__(self, **kwargs) -> None:
+        time.sleep(BLOCK)
+
+    def get_recording_encoding(self):
+        time.sleep(BLOCK)
+        return [
+            {
+                "value": {
+                    "Enc": {
+                        "mainStream": {"frameRate": 25},
+                        "subStream": {"frameRate": 15},
+                    }
+                }
+            }
+        ]
+
+
+class CameraStub:
+    """Serves Reolink snapshots, and takes the uploads meant for the NVR."""
+
+    def __init__(self) -> None:
+        self.uploads: list[bytes] = []
+        self.app = web.Application()
+        self.app.router.add_get("/cgi-bin/api.cgi", self.snapshot)
+        self.app.router.add_post("/upload", self.upload)
+        self.server = test_utils.TestServer(self.app, host="127.0.0.1")
+
+    @property
+    def address(self) -> str:
+        return f"127.0.0.1:{self.server.port}"
+
+    async def snapshot(self, request: "web.Request") -> "web.Response":
+        return web.Response(body=SNAPSHOT, content_type="image/jpeg")
+
+    async def upload(self, request: "web.Request") -> "web.Response":
+        form = await request.post()
+        self.uploads.append(form["payload"].file.read())
+        return web.Response()
+
+
+@pytest.fixture
+def slow_disk(tmp_path, monkeypatch) -> Path:
+    """Temporary files go to a disk on which opening a file blocks."""
+    slow = tmp_path / "slow"
+    slow.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(slow))
+    real_open = builtins.open
+
+    def slow_open(file, *args, **kwargs):
+        if str(file).startswith(str(slow)):
+            time.sleep(BLOCK)
+        return real_open(file, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "open", slow_open)
+    monkeypatch.setattr(io, "open", slow_open)
+    return slow
+
+
+def make_cam(parse_args, ip: str = "192.0.2.1") -> Reolink:
+    args = parse_args(
+        "reolink",
+        Reolink,
+        ["-i", ip, "reolink", "-u", "admin", "-p", "secret"]
+        + ["--stream-cache-dir", ""],
+    )
+    return Reolink(args, logger)
+
+
+async def max_lag_ms(awaitable) -> float:
+    """Await `awaitable` under a loop monitor, returning the longest lag."""
+    monitor = LoopMonitor(logger, 0.01, MAX_LAG)
+    monitor.start()
+    try:
+        # Let the monitor start measuring before the awaitable runs
+        await asyncio.sleep(monitor.interval * 2)
+        await awaitable
+    finally:
+        monitor.stop()
+    assert monitor.stats()["samples"] > 0
+    return monitor.stats()["max_lag_ms"]
+
+
+def run_with_stub(parse_args, test):
+    async def main():
+        stub = CameraStub()
+        await stub.server.start_server()
+        try:
+            return stub, await test(make_cam(parse_args, stub.address), stub)
+        finally:
+            await stub.server.close()
+
+    return asyncio.run(main())
+
+
+def test_connect_does_not_block_loop(monkeypatch, parse_args):
+    monkeypatch.setattr(reolinkapi, "Camera", BlockingCamera)
+
+    async def connect():
+        cam = make_cam(parse_args)
+        return cam, await max_lag_ms(cam.connect())
+
+    cam, lag = asyncio.run(connect())
+    assert cam.stream_fps == (25, 15)
+    assert lag < MAX_LAG * 1000
+
+
+def test_fetch_to_file_does_not_block_loop(parse_args, slow_disk):
+    async def test(cam, stub):
+        url = f"http://{stub.address}/cgi-bin/api.cgi?cmd=Snap"
+        return await max_lag_ms(cam.fetch_to_file(url, slow_disk / "screen.jpg"))
+
+    _, lag = run_with_stub(parse_args, test)
+    assert (slow_disk / "screen.jpg").read_bytes() == SNAPSHOT
+    assert lag < MAX_LAG * 1000
+
+
+def test_snapshot_request_does_not_block_loop(parse_args, slow_disk):
+    async def test(cam, stub):
+        request = {
+            "functionName": "GetRequest",
+            "messageId": 1,
+            "responseExpected": False,
+            "payload": {
+                "what": "snapshot",
+                "uri": f"http://{stub.address}/upload",
+            },
+        }
+        return await max_lag_ms(cam.process_snapshot_request(request))
+
+    stub, lag = run_with_stub(parse_args, test)
+    assert stub.uploads == [SNAPSHOT]
+    assert lag < MAX_LAG * 1000
+
+
+def test_motion_start_does_not_block_loop(parse_args, slow_disk):
+    async def test(cam, stub):
+        lag = await max_lag_ms(cam.trigger_motion_start())
+        return cam._motion_snapshot, lag
+
+    _, (snapshot, lag) = run_with_stub(parse_args, test)
+    assert snapshot.read_bytes() == SNAPSHOT
+    assert lag < MAX_LAG * 1000
+
+
+def test_ffmpeg_args_before_connect(parse_args):
+    cam = make_cam(parse_args)
+    assert "tick_rate" not in cam.get_extra_ffmpeg_args("video1")
+    assert not cam.is_video_transcoded("video1")
+
+    cam.stream_fps = (25, 15)
+    assert "tick_rate=50" in cam.get_extra_ffmpeg_args("video1")
+    assert "tick_rate=30" in cam.get_extra_ffmpeg_args("video2")
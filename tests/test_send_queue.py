@@ -0,0 +1,162 @@
+import asyncio
+import json
+import logging
+import time
+
+import pytest
+
+pytest.importorskip("websockets")
+
+from websockets.exceptions import ConnectionClosed  # noqa: E402
+
+from unifi.send_queue import (  # noqa: E402
+    PRIORITY_EVENT,
+    PRIORITY_RESPONSE,
+    SendQueue,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class FakeSocket:
+    def __init__(self, delay: float = 0, closed: bool = False) -> None:
+        self.delay = delay
+        self.closed = closed
+        self.sent: list[str] = []
+
+    async def send(self, data: bytes) -> None:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.closed:
+            raise ConnectionClosed(None, None)
+        self.sent.append(json.loads(data)["functionName"])
+
+
+def message(name: str) -> dict:
+    return {"functionName": name}
+
+
+def run_queue(fill, flush_interval: float = 0.01, delay: float = 0) -> list[str]:
+    async def main():
+        ws = FakeSocket(delay)
+        queue = SendQueue(ws, logger, flush_interval=flush_interval)
+        fill(queue)
+        writer = asyncio.create_task(queue.run())
+        await queue.drain(1)
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+        return ws.sent
+
+    return asyncio.run(main())
+
+
+def test_responses_before_events():
+    def fill(queue):
+        queue.put(message("EventAnalytics"), PRIORITY_EVENT)
+        queue.put(message("ChangeVideoSettings"), PRIORITY_RESPONSE)
+        queue.put(message("EventSmartDetect"), PRIORITY_EVENT)
+        queue.put(message("GetRequest"), PRIORITY_RESPONSE)
+
+    assert run_queue(fill) == [
+        "ChangeVideoSettings",
+        "GetRequest",
+        "EventAnalytics",
+        "EventSmartDetect",
+    ]
+
+
+def test_coalesce_by_key():
+    def fill(queue):
+        queue.put(message("EventAnalytics"), PRIORITY_EVENT, key="motion")
+        queue.put(message("EventSmartDetect"), PRIORITY_EVENT, key="motion")
+        queue.put(message("EventPing"), PRIORITY_EVENT)
+        assert len(queue) == 2
+
+    assert run_queue(fill) == ["EventSmartDetect", "EventPing"]
+
+
+def test_cancel_pending_event():
+    def fill(queue):
+        queue.put(message("EventAnalytics"), PRIORITY_EVENT, key="motion-start-1")
+        queue.put(message("EventAnalytics"), PRIORITY_EVENT, cancels="motion-start-1")
+        queue.put(message("EventPing"), PRIORITY_EVENT)
+        assert queue.stats()["coalesced"] == 2
+
+    assert run_queue(fill) == ["EventPing"]
+
+
+def test_cancel_after_sent():
+    async def main():
+        ws = FakeSocket()
+        queue = SendQueue(ws, logger, flush_interval=0.01)
+        writer = asyncio.create_task(queue.run())
+        queue.put(message("EventStart"), PRIORITY_EVENT, key="motion-start-1")
+        await queue.drain(1)
+        # The start went out, so the stop must go out too
+        queue.put(message("EventStop"), PRIORITY_EVENT, cancels="motion-start-1")
+        await queue.drain(1)
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+        return ws.sent
+
+    assert asyncio.run(main()) == ["EventStart", "EventStop"]
+
+
+def test_full_queue_drops_oldest_event():
+    async def main():
+        ws = FakeSocket()
+        queue = SendQueue(ws, logger, max_size=2)
+        queue.put(message("EventOld"), PRIORITY_EVENT)
+        queue.put(message("Response"), PRIORITY_RESPONSE)
+        queue.put(message("EventNew"), PRIORITY_EVENT)
+        return queue.stats()
+
+    stats = asyncio.run(main())
+    assert stats["dropped"] == 1
+    assert stats["depth"] == 2
+
+
+def test_stop_cancels_writer():
+    async def main():
+        ws = FakeSocket(delay=0.1)
+        queue = SendQueue(ws, logger, flush_interval=0.01)
+        writer = asyncio.create_task(queue.run())
+        for i in range(5):
+            queue.put(message(f"Response{i}"), PRIORITY_RESPONSE)
+        await asyncio.sleep(0.15)
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+        await asyncio.sleep(0.1)
+        return ws.sent, len(queue)
+
+    sent, depth = asyncio.run(main())
+    assert sent == ["Response0"]
+    assert depth == 3
+
+
+def test_drain_times_out():
+    async def main():
+        queue = SendQueue(FakeSocket(), logger)
+        queue.put(message("Response"), PRIORITY_RESPONSE)
+        # Nothing is sending, so the queue never empties
+        await asyncio.wait_for(queue.drain(0.05), 1)
+        return len(queue)
+
+    assert asyncio.run(main()) == 1
+
+
+def test_drain_returns_when_connection_closed():
+    async def main():
+        queue = SendQueue(FakeSocket(closed=True), logger)
+        writer = asyncio.create_task(queue.run())
+        queue.put(message("Response"), PRIORITY_RESPONSE)
+        queue.put(message("EventAnalytics"), PRIORITY_EVENT)
+        start = time.monotonic()
+        await queue.drain(1)
+        await writer
+        # Queued after the close, still nothing to wait for
+        queue.put(message("EventPing"), PRIORITY_EVENT)
+        await queue.drain(1)
+        return time.monotonic() - start
+
+    assert asyncio.run(main()) < 0.5
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+
+from unifi.spool import SpoolRing
+from unifi.stream import (
+    PREVIOUS_TAG_SIZE,
+    TAG_HEADER_SIZE,
+    TAG_TYPE_VIDEO,
+    TRAILER_SIZE,
+    StreamPipeline,
+)
+
+logger = logging.getLogger(__name__)
+
+UNIT_OVERHEAD = TAG_HEADER_SIZE + PREVIOUS_TAG_SIZE + TRAILER_SIZE
+
+
+def video_unit(keyframe: bool, index: int, data_size: int = 100) -> bytes:
+    data = bytes([0x17 if keyframe else 0x27, 1, index]) + bytes(data_size - 3)
+    header = bytes([TAG_TYPE_VIDEO]) + data_size.to_bytes(3, "big") + bytes(7)
+    return header + data + bytes(PREVIOUS_TAG_SIZE + TRAILER_SIZE)
+
+
+def spooled(ring: SpoolRing) -> list[tuple[bool, int]]:
+    units = []
+    while len(ring):
+        chunk = ring.peek(1)
+        units.append((chunk[TAG_HEADER_SIZE] == 0x17, chunk[TAG_HEADER_SIZE + 2]))
+        ring.consume(len(chunk))
+    return units
+
+
+def test_replay_starts_at_keyframe(tmp_path):
+    ring = SpoolRing(tmp_path / "spool", 5 * (100 + UNIT_OVERHEAD))
+    for i in range(8):
+        ring.append(video_unit(i % 4 == 0, i))
+
+    # The first GOP was partly evicted, so all of it is dropped
+    assert spooled(ring) == [(True, 4), (False, 5), (False, 6), (False, 7)]
+    ring.close()
+
+
+def test_gop_larger_than_ring(tmp_path):
+    ring = SpoolRing(tmp_path / "spool", 3 * (100 + UNIT_OVERHEAD))
+    units = [video_unit(True, 0)] + [video_unit(False, i) for i in range(1, 5)]
+    units += [video_unit(True, 5), video_unit(False, 6)]
+    for unit in units:
+        ring.append(unit)
+
+    # Nothing of the GOP that did not fit is kept, not even its tail
+    assert spooled(ring) == [(True, 5), (False, 6)]
+    ring.close()
+
+
+def test_clear_accepts_any_unit(tmp_path):
+    ring = SpoolRing(tmp_path / "spool", 2 * (100 + UNIT_OVERHEAD))
+    for i in range(4):
+        ring.append(video_unit(i == 0, i))
+    ring.clear()
+    ring.append(video_unit(False, 9))
+
+    assert spooled(ring) == [(False, 9)]
+    ring.close()
+
+
+def test_replacement_pipeline_replays_spool(tmp_path):
+    async def main():
+        received = asyncio.get_running_loop().create_future()
+
+        async def serve(reader, writer):
+            received.set_result(await reader.read())
+            writer.close()
+
+        server = await asyncio.start_server(serve, "127.0.0.1", 0)
+        destination = server.sockets[0].getsockname()[:2]
+        ring = SpoolRing(tmp_path / "spool", 10 * (100 + UNIT_OVERHEAD))
+        config = video_unit(True, 0)
+        config = config[:TAG_HEADER_SIZE] + b"\x17\x00" + config[TAG_HEADER_SIZE + 2 :]
+
+        dead = StreamPipeline("video1", "stream", "", 10, logger, spool=ring)
+        dead.detach(outage=True)
+        for unit in (config, video_unit(True, 1), video_unit(False, 2)):
+            await dead._process_unit(unit)
+        # The NVR is back, and the ingest that spooled for it has died
+        dead.stop()
+
+        pipeline = StreamPipeline("video1", "stream", "", 10, logger, spool=ring)
+        await pipeline.attach(destination)
+        await pipeline._process_unit(config)
+        await asyncio.wait_for(pipeline._replay_task, 1)
+        pipeline.detach()
+        data = await asyncio.wait_for(received, 1)
+        pipeline.stop()
+        server.close()
+        ring.close()
+        return data
+
+    received = asyncio.run(main())
+    assert received.endswith(video_unit(True, 1) + video_unit(False, 2))
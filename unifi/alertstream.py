@@ -0,0 +1,209 @@
+"""
+Incremental parser for the multipart event stream of Hikvision's ISAPI
+(/ISAPI/Event/notification/alertStream).
+
+Cameras send an EventNotificationAlert XML document per event and a
+"videoloss" heartbeat every few seconds, sometimes interleaved with JPEG
+parts for smart events. Only the handful of fields needed for motion events
+are pulled out of the XML, and parts that are not events of interest are
+dropped without being parsed.
+"""
+import argparse
+import random
+import time
+from typing import Optional
+
+# Event types reported as motion, compared lower-cased
+EVENT_TYPES = frozenset(
+    {"vmd", "linedetection", "fielddetection", "regionentrance", "regionexiting"}
+)
+DEFAULT_BOUNDARY = b"boundary"
+
+
+class Alert:
+    __slots__ = ("event_type", "channel", "active", "target_type")
+
+    def __init__(
+        self,
+        event_type: str,
+        channel: Optional[str],
+        active: bool,
+        target_type: Optional[str],
+    ) -> None:
+        self.event_type = event_type
+        self.channel = channel
+        self.active = active
+        # "human" or "vehicle" on cameras with target classification
+        self.target_type = target_type
+
+    def __repr__(self) -> str:
+        return (
+            f"Alert({self.event_type}, channel={self.channel},"
+            f" active={self.active}, target={self.target_type})"
+        )
+
+
+def parse_boundary(content_type: str) -> bytes:
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "boundary" and value:
+            return value.strip('"').encode()
+    return DEFAULT_BOUNDARY
+
+
+def _tag(body: bytes, name: bytes) -> Optional[str]:
+    start = body.find(b"<" + name + b">")
+    if start == -1:
+        return None
+    start += len(name) + 2
+    end = body.find(b"</", start)
+    if end == -1:
+        return None
+    return body[start:end].decode(errors="replace").strip()
+
+
+def parse_alert(body: bytes) -> Optional[Alert]:
+    """The alert of an EventNotificationAlert part, if it is of interest."""
+    event_type = _tag(body, b"eventType")
+    if event_type is None or event_type.lower() not in EVENT_TYPES:
+        return None
+    state = _tag(body, b"eventState")
+    target_type = _tag(body, b"targetType")
+    return Alert(
+        event_type,
+        _tag(body, b"channelID") or _tag(body, b"dynChannelID"),
+        state is None or state.lower() == "active",
+        target_type.lower() if target_type else None,
+    )
+
+
+class AlertStreamParser:
+    """
+    Splits the multipart stream into parts as bytes arrive. Parts are sized
+    by their Content-Length, or by the next boundary when there is none.
+    Parts that are not XML are skipped as they arrive, without buffering.
+    """
+
+    def __init__(self, boundary: bytes = DEFAULT_BOUNDARY) -> None:
+        self._delimiter = b"--" + boundary
+        self._buffer = bytearray()
+        self._in_body = False
+        self._is_xml = True
+        # Bytes left in the current part, -1 when it ends at the next boundary
+        self._remaining = -1
+
+    def feed(self, data: bytes) -> list[Alert]:
+        self._buffer += data
+        buf = self._buffer
+        alerts = []
+        while buf:
+            if not self._in_body:
+                start = buf.find(self._delimiter)
+                if start == -1:
+                    # Keep a possible partial delimiter
+                    del buf[: max(0, len(buf) - len(self._delimiter))]
+                    break
+                end = buf.find(b"\r\n\r\n", start)
+                if end == -1:
+                    del buf[:start]
+                    break
+                headers = bytes(buf[start + len(self._delimiter) : end]).lower()
+                del buf[: end + 4]
+                self._in_body = True
+                self._is_xml = b"content-type" not in headers or b"xml" in headers
+                self._remaining = -1
+                for line in headers.split(b"\r\n"):
+                    name, _, value = line.partition(b":")
+                    if name.strip() == b"content-length":
+                        try:
+                            self._remaining = int(value)
+                        except ValueError:
+                            pass
+                continue
+
+            if self._remaining >= 0:
+                if not self._is_xml:
+                    skipped = min(len(buf), self._remaining)
+                    del buf[:skipped]
+                    self._remaining -= skipped
+                    if self._remaining:
+                        break
+                    self._in_body = False
+                    continue
+                if len(buf) < self._remaining:
+                    break
+                body = bytes(buf[: self._remaining])
+                del buf[: self._remaining]
+            else:
+                end = buf.find(self._delimiter)
+                if end == -1:
+                    break
+                body = bytes(buf[:end])
+                del buf[:end]
+
+            self._in_body = False
+            if self._is_xml:
+                alert = parse_alert(body)
+                if alert:
+                    alerts.append(alert)
+        return alerts
+
+
+def _sample_part(event_type: str, state: str, target: Optional[str]) -> bytes:
+    region = (
+        "<DetectionRegionList><DetectionRegionEntry><regionID>1</regionID>"
+        f"<targetType>{target}</targetType></DetectionRegionEntry>"
+        "</DetectionRegionList>"
+        if target
+        else ""
+    )
+    body = (
+        '<?xml version="1.0" encoding="UTF-8"?>\r\n'
+        '<EventNotificationAlert version="2.0"'
+        ' xmlns="http://www.hikvision.com/ver20/XMLSchema">\r\n'
+        "<ipAddress>192.168.1.64</ipAddress><portNo>80</portNo>"
+        "<protocol>HTTP</protocol><macAddress>44:19:b6:00:00:00</macAddress>"
+        "<channelID>1</channelID><dateTime>2024-01-01T00:00:00+00:00</dateTime>"
+        "<activePostCount>1</activePostCount>"
+        f"<eventType>{event_type}</eventType><eventState>{state}</eventState>"
+        f"<eventDescription>{event_type} alarm</eventDescription>{region}"
+        "</EventNotificationAlert>\r\n"
+    ).encode()
+    return (
+        b'--boundary\r\nContent-Type: application/xml; charset="UTF-8"\r\n'
+        + f"Content-Length: {len(body)}\r\n\r\n".encode()
+        + body
+    )
+
+
+def benchmark(count: int, chunk_size: int) -> None:
+    samples = [
+        _sample_part("videoloss", "inactive", None),
+        _sample_part("VMD", "active", None),
+        _sample_part("linedetection", "active", "human"),
+        _sample_part("fielddetection", "active", "vehicle"),
+    ]
+    # Mostly heartbeats, as on an idle camera
+    weights = [6, 2, 1, 1]
+    data = b"".join(random.choices(samples, weights, k=count))
+
+    parser = AlertStreamParser()
+    alerts = 0
+    start = time.perf_counter()
+    for offset in range(0, len(data), chunk_size):
+        alerts += len(parser.feed(data[offset : offset + chunk_size]))
+    elapsed = time.perf_counter() - start
+    print(
+        f"{count} parts ({alerts} alerts, {len(data)} bytes) in {elapsed:.3f}s:"
+        f" {count / elapsed:.0f} parts/s, {8 * len(data) / elapsed / 1e6:.0f} Mbit/s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the alertStream parser")
+    parser.add_argument("--count", default=100000, type=int, help="Parts to parse")
+    parser.add_argument(
+        "--chunk-size", default=4096, type=int, help="Bytes fed to the parser at once"
+    )
+    args = parser.parse_args()
+    benchmark(args.count, args.chunk_size)
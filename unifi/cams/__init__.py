@@ -1,6 +1,7 @@
 from unifi.cams.dahua import DahuaCam
 from unifi.cams.frigate import FrigateCam
 from unifi.cams.hikvision import HikvisionCam
+from unifi.cams.onvif import OnvifCam
 from unifi.cams.reolink import Reolink
 from unifi.cams.reolink_nvr import ReolinkNVRCam
 from unifi.cams.rtsp import RTSPCam
@@ -9,6 +10,7 @@ __all__ = [
     "FrigateCam",
     "HikvisionCam",
     "DahuaCam",
+    "OnvifCam",
     "RTSPCam",
     "Reolink",
     "ReolinkNVRCam",
@@ -1,10 +1,11 @@
 import argparse
+import asyncio
 import atexit
 import json
 import logging
+import re
 import shutil
 import ssl
-import subprocess
 import sys
 import tempfile
 import time
@@ -19,19 +20,107 @@ import packaging
 import websockets
 
 from unifi.core import RetryableError
+from unifi.executor import run_blocking, write_file
+from unifi.log import LogSampler
+from unifi.loop_monitor import get_loop_monitor
+from unifi.motion import MotionZone, Polygon, parse_analytics_settings
+from unifi.probe import StreamInfo, StreamInfoCache, probe_stream
+from unifi.procstats import ProcessSampler
+from unifi.restream import STREAMS, HttpApi
+from unifi.send_queue import PRIORITY_EVENT, PRIORITY_RESPONSE, SendQueue
+from unifi.snapshot import SnapshotResizer, decode_snapshot
+from unifi.spool import SpoolRing
+from unifi.stream import StreamPipeline, TranscodeLadder
 
 AVClientRequest = AVClientResponse = dict[str, Any]
 
+DEFAULT_AUDIO_ARGS = "-ar 32000 -ac 1 -codec:a aac -b:a 32k"
+DEFAULT_VIDEO_ENCODER_ARGS = "-c:v libx264 -preset veryfast -tune zerolatency"
+# Input probing used when the stream parameters are already known
+FAST_PROBE_ARGS = "-probesize 32768 -analyzeduration 500000"
+
+# Frequent messages whose processing is only logged once in a while
+SAMPLED_MESSAGES = ("ubnt_avclient_time", "GetRequest")
+
+# Per-stream encoder settings requested by Protect in ChangeVideoSettings
+VIDEO_SETTING_KEYS = (
+    "fps",
+    "bitRateCbrAvg",
+    "bitRateVbrMax",
+    "isCbr",
+    "width",
+    "height",
+)
+
 
 class SmartDetectObjectType(Enum):
     PERSON = "person"
     VEHICLE = "vehicle"
 
 
+def parse_rendition(value: str) -> tuple[str, tuple[int, int]]:
+    try:
+        stream_index, size = value.split("=")
+        return stream_index, parse_size(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Invalid rendition '{value}', expected STREAM=WIDTHxHEIGHT"
+        )
+
+
+def parse_size(value: str) -> tuple[int, int]:
+    try:
+        width, height = value.lower().split("x")
+        return int(width), int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Invalid size '{value}', expected WIDTHxHEIGHT"
+        )
+
+
+def copy_to_tempfile(src: Path) -> Path:
+    with src.open("rb") as fsrc, tempfile.NamedTemporaryFile(delete=False) as fdst:
+        shutil.copyfileobj(fsrc, fdst)
+    return Path(fdst.name)
+
+
+_ffmpeg_timeout_option: Optional[str] = None
+
+
+async def get_ffmpeg_timeout_option(logger: logging.Logger) -> Optional[str]:
+    """
+    Name of the socket timeout option of the installed ffmpeg, which was
+    renamed in ffmpeg 5. Checked once per process.
+    """
+    global _ffmpeg_timeout_option
+    if _ffmpeg_timeout_option is None:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg",
+                "-h",
+                "full",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            output, _ = await proc.communicate()
+        except OSError:
+            logger.exception("Could not check for ffmpeg options")
+            return None
+        if proc.returncode != 0:
+            logger.error("Could not check for ffmpeg options")
+            return None
+        _ffmpeg_timeout_option = "-stimeout" if b"stimeout" in output else "-timeout"
+    return _ffmpeg_timeout_option
+
+
 class UnifiCamBase(metaclass=ABCMeta):
     def __init__(self, args: argparse.Namespace, logger: logging.Logger) -> None:
         self.args = args
         self.logger = logger
+        self.protocol_logger = logger.getChild("protocol")
+        self.stream_logger = logger.getChild("stream")
+        self.motion_logger = logger.getChild("motion")
+        self._log_sampler = LogSampler()
 
         self._msg_id: int = 0
         self._init_time: float = time.time()
@@ -40,7 +129,29 @@ class UnifiCamBase(metaclass=ABCMeta):
         self._motion_event_id: int = 0
         self._motion_event_ts: Optional[float] = None
         self._motion_object_type: Optional[SmartDetectObjectType] = None
-        self._ffmpeg_handles: dict[str, subprocess.Popen] = {}
+        self.motion_zones: list[MotionZone] = []
+        self.privacy_masks: list[Polygon] = []
+        # Bumped whenever Protect changes the zones or masks
+        self.analytics_version: int = 0
+        self._pipelines: dict[str, StreamPipeline] = {}
+        self._ladder: Optional[TranscodeLadder] = None
+        self._video_settings: dict[str, dict[str, Any]] = {}
+        self._encoder_configured: set[str] = set()
+        # Rate control arguments each stream's ffmpeg was spawned with
+        self._rate_control: dict[str, str] = {}
+        self._stream_info: dict[str, StreamInfo] = {}
+        self._stream_sources: dict[str, str] = {}
+        self._fast_probe: set[str] = set()
+        self._stream_cache = StreamInfoCache(args.stream_cache_dir, self.stream_logger)
+        self._source_cache: dict[str, tuple[str, float]] = {}
+        self._spools: dict[str, SpoolRing] = {}
+        self._prewarming: dict[str, asyncio.Task] = {}
+        self._http_api: Optional[HttpApi] = None
+        self._resizer = SnapshotResizer(
+            args.snapshot_max_size, args.snapshot_quality, logger
+        )
+        self._sampler = ProcessSampler()
+        self._process_stats: dict[str, dict[str, Any]] = {}
 
         # Set up ssl context for requests
         self._ssl_context = ssl.create_default_context()
@@ -48,6 +159,7 @@ class UnifiCamBase(metaclass=ABCMeta):
         self._ssl_context.verify_mode = ssl.CERT_NONE
         self._ssl_context.load_cert_chain(args.cert, args.cert)
         self._session: Optional[websockets.legacy.client.WebSocketClientProtocol] = None
+        self._send_queue: Optional[SendQueue] = None
         atexit.register(self.close_streams)
 
         self._needs_flv_timestamps: bool = False
@@ -57,8 +169,9 @@ class UnifiCamBase(metaclass=ABCMeta):
         parser.add_argument(
             "--ffmpeg-args",
             "-f",
-            default="-c:v copy -ar 32000 -ac 1 -codec:a aac -b:a 32k",
-            help="Transcoding args for `ffmpeg -i <src> <args> <dst>`",
+            default=None,
+            help="Transcoding args for `ffmpeg -i <src> <args> <dst>` (default: copy"
+            " H.264 video and AAC audio, transcode anything else)",
         )
         parser.add_argument(
             "--rtsp-transport",
@@ -66,23 +179,161 @@ class UnifiCamBase(metaclass=ABCMeta):
             choices=["tcp", "udp", "http", "udp_multicast"],
             help="RTSP transport protocol used by stream",
         )
+        parser.add_argument(
+            "--stream-grace-period",
+            default=0,
+            type=float,
+            help="Seconds to keep streams running after the NVR disconnects so they"
+            " can be re-attached without renegotiating RTSP (default: disabled)",
+        )
+        parser.add_argument(
+            "--prewarm-streams",
+            nargs="+",
+            default=[],
+            choices=STREAMS,
+            help="Start these streams while connecting to the NVR, so they are"
+            " ready when it requests them",
+        )
+        parser.add_argument(
+            "--prewarm-timeout",
+            default=30,
+            type=float,
+            help="Seconds a pre-warmed stream waits for the NVR to request it",
+        )
+        parser.add_argument(
+            "--gop-cache",
+            action="store_true",
+            help="Keep streams running and serve the most recent GOP to the NVR"
+            " immediately when it requests a stream",
+        )
+        parser.add_argument(
+            "--transcode-ladder",
+            nargs="+",
+            default=[],
+            type=parse_rendition,
+            metavar="STREAM=WIDTHxHEIGHT",
+            help="Encode these streams from a single decode of the video1 source,"
+            " e.g. video2=1280x720 video3=640x360 (--ffmpeg-args must re-encode"
+            " video)",
+        )
+        parser.add_argument(
+            "--honor-video-settings",
+            action="store_true",
+            help="Apply the fps, bitrate and resolution requested by Protect when"
+            " re-encoding video",
+        )
+        parser.add_argument(
+            "--stream-cache-dir",
+            default=str(Path.home() / ".cache" / "unifi-cam-proxy"),
+            help="Directory to persist detected stream parameters in, used to skip"
+            " probing on later starts (set to '' to disable)",
+        )
+        parser.add_argument(
+            "--stream-source-ttl",
+            default=300,
+            type=float,
+            help="Seconds to reuse a resolved stream URL before asking the camera"
+            " again, the last known URL is used if the camera cannot be reached",
+        )
+        parser.add_argument(
+            "--snapshot-max-size",
+            default=(1280, 720),
+            type=parse_size,
+            help="Largest snapshot uploaded to the NVR as WIDTHxHEIGHT, larger"
+            " snapshots are scaled down if Pillow is installed",
+        )
+        parser.add_argument(
+            "--snapshot-quality",
+            default=80,
+            type=int,
+            help="JPEG quality of scaled down snapshots",
+        )
+        parser.add_argument(
+            "--http-api",
+            default=0,
+            type=int,
+            help="Specify a port number to enable the HTTP API (default: disabled)",
+        )
+        parser.add_argument(
+            "--mjpeg-fps",
+            default=2,
+            type=float,
+            help="Frame rate of the HTTP API's MJPEG stream",
+        )
+        parser.add_argument(
+            "--restream-queue",
+            default=512,
+            type=int,
+            help="Tags buffered for each HTTP API stream client before it starts"
+            " losing frames",
+        )
+        parser.add_argument(
+            "--spool-dir",
+            default=None,
+            help="Directory to spool streams to while the NVR is unreachable,"
+            " replayed once it is back (default: disabled)",
+        )
+        parser.add_argument(
+            "--spool-size",
+            default=64,
+            type=int,
+            help="Size in MB of the spool file of each stream",
+        )
+        parser.add_argument(
+            "--spool-replay-rate",
+            default=16,
+            type=float,
+            help="Maximum rate in Mbps at which spooled footage is replayed",
+        )
+        parser.add_argument(
+            "--stats-interval",
+            default=30,
+            type=float,
+            help="Seconds between samples of per-stream CPU, memory and I/O usage"
+            " (0 to disable)",
+        )
+        parser.add_argument(
+            "--stream-cpu-budget",
+            default=None,
+            type=float,
+            help="Warn when a stream pipeline uses more than this CPU percentage",
+        )
+        parser.add_argument(
+            "--stream-memory-budget",
+            default=None,
+            type=float,
+            help="Warn when a stream pipeline uses more than this many MB of memory",
+        )
 
     async def _run(self, ws) -> None:
         self._session = ws
-        await self.init_adoption()
-        while True:
-            try:
-                msg = await ws.recv()
-            except websockets.exceptions.ConnectionClosedError:
-                self.logger.info(f"Connection to {self.args.host} was closed.")
-                raise RetryableError()
-
-            if msg is not None:
-                force_reconnect = await self.process(msg)
-                if force_reconnect:
-                    self.logger.info("Reconnecting...")
+        send_queue = self._send_queue = SendQueue(ws, self.protocol_logger)
+        writer = asyncio.create_task(send_queue.run())
+        monitor = asyncio.create_task(self.monitor_streams())
+        try:
+            await self.init_adoption()
+            while True:
+                try:
+                    msg = await ws.recv()
+                except websockets.exceptions.ConnectionClosedError:
+                    self.logger.info(f"Connection to {self.args.host} was closed.")
                     raise RetryableError()
 
+                if msg is not None:
+                    force_reconnect = await self.process(msg)
+                    if force_reconnect:
+                        self.logger.info("Reconnecting...")
+                        raise RetryableError()
+        finally:
+            monitor.cancel()
+            if not writer.done():
+                # End a motion event in progress while it can still be sent,
+                # and let responses sent right before reconnecting go out
+                await self.trigger_motion_stop()
+                await send_queue.drain(1)
+                writer.cancel()
+            self._send_queue = None
+
     async def run(self) -> None:
         return
 
@@ -92,6 +343,15 @@ class UnifiCamBase(metaclass=ABCMeta):
     async def change_video_settings(self, options) -> None:
         return
 
+    async def change_stream_settings(
+        self, stream_index: str, settings: dict[str, Any]
+    ) -> bool:
+        """
+        Reconfigure the camera's encoder for a stream, returning True if the
+        camera now produces the requested settings itself.
+        """
+        return False
+
     @abstractmethod
     async def get_snapshot(self) -> Path:
         raise NotImplementedError("You need to write this!")
@@ -100,8 +360,138 @@ class UnifiCamBase(metaclass=ABCMeta):
     async def get_stream_source(self, stream_index: str) -> str:
         raise NotImplementedError("You need to write this!")
 
+    async def resolve_stream_source(self, stream_index: str) -> str:
+        cached = self._source_cache.get(stream_index)
+        if cached and time.time() - cached[1] < self.args.stream_source_ttl:
+            return cached[0]
+
+        try:
+            source = await self.get_stream_source(stream_index)
+        except RetryableError:
+            if not cached:
+                raise
+            self.logger.warning(
+                f"Could not resolve stream source for {stream_index},"
+                " using last known URL"
+            )
+            return cached[0]
+
+        self._source_cache[stream_index] = (source, time.time())
+        return source
+
     def get_extra_ffmpeg_args(self, stream_index: str = "") -> str:
-        return self.args.ffmpeg_args
+        if self.args.ffmpeg_args is not None:
+            return self.args.ffmpeg_args
+        return (
+            f"{self.get_video_ffmpeg_args(stream_index)}"
+            f" {self.get_audio_ffmpeg_args(stream_index)}"
+        )
+
+    def get_video_ffmpeg_args(self, stream_index: str) -> str:
+        info = self._stream_info.get(stream_index)
+        if stream_index in dict(self.args.transcode_ladder):
+            return DEFAULT_VIDEO_ENCODER_ARGS
+        if info and info["video"] and info["video"].get("codec_name") != "h264":
+            return DEFAULT_VIDEO_ENCODER_ARGS
+        return "-c:v copy"
+
+    def get_audio_ffmpeg_args(self, stream_index: str) -> str:
+        info = self._stream_info.get(stream_index)
+        if not info:
+            return DEFAULT_AUDIO_ARGS
+        audio = info["audio"]
+        if not audio:
+            return ""
+        if audio.get("codec_name") == "aac" and audio.get("channels", 1) <= 2:
+            return "-c:a copy"
+        return DEFAULT_AUDIO_ARGS
+
+    def uses_stream_probe(self, stream_index: str) -> bool:
+        """Whether the ffmpeg arguments of a stream depend on probing it."""
+        return self.args.ffmpeg_args is None
+
+    async def probe_stream_source(self, stream_index: str, source: str) -> None:
+        self._stream_sources[stream_index] = source
+        if not self.uses_stream_probe(stream_index):
+            # Configured arguments are used as they are, skip the probe delay
+            self._fast_probe.discard(stream_index)
+            return
+
+        info = await self._stream_cache.get(source)
+        if info:
+            self._fast_probe.add(stream_index)
+        else:
+            self._fast_probe.discard(stream_index)
+            info = await probe_stream(
+                source, self.args.rtsp_transport, self.stream_logger
+            )
+            if info:
+                self._stream_cache.put(source, info)
+
+        if info:
+            self._stream_info[stream_index] = info
+        else:
+            self._stream_info.pop(stream_index, None)
+
+    def check_stream_config(self, stream_index: str, kind: str, data: bytes) -> None:
+        source = self._stream_sources.get(stream_index)
+        if source and not self._stream_cache.check_fingerprint(source, kind, data):
+            self.logger.info(
+                f"Stream parameters of {stream_index} changed, re-probing on restart"
+            )
+            self._fast_probe.discard(stream_index)
+
+    def invalidate_stream_cache(self, stream_index: str) -> None:
+        source = self._stream_sources.get(stream_index)
+        if source:
+            self._stream_cache.invalidate(source)
+        self._fast_probe.discard(stream_index)
+
+    def is_video_transcoded(self, stream_index: str) -> bool:
+        return (
+            re.search(
+                r"-(c:v|codec:v|vcodec)\s+copy",
+                self.get_extra_ffmpeg_args(stream_index),
+            )
+            is None
+        )
+
+    def get_rate_control_args(self, stream_index: str, scale: bool = True) -> str:
+        settings = self._video_settings.get(stream_index)
+        if (
+            not settings
+            or stream_index in self._encoder_configured
+            or not self.is_video_transcoded(stream_index)
+        ):
+            return ""
+
+        args = []
+        if settings.get("fps"):
+            args.append(f"-r {settings['fps']}")
+        if settings.get("bitRateCbrAvg"):
+            bitrate = settings["bitRateCbrAvg"]
+            max_bitrate = (
+                bitrate if settings.get("isCbr") else settings.get("bitRateVbrMax")
+            ) or bitrate
+            args.append(
+                f"-b:v {bitrate} -maxrate {max_bitrate} -bufsize {2 * max_bitrate}"
+            )
+        if scale and settings.get("width") and settings.get("height"):
+            args.append(f"-s {settings['width']}x{settings['height']}")
+        return " ".join(args)
+
+    def rate_control_changed(self, stream_index: str) -> bool:
+        """
+        Whether a stream was spawned with other rate control than the current
+        settings ask for, such as a stream started before the NVR sent them.
+        """
+        if stream_index not in self._rate_control:
+            return False
+        # Ladder renditions are scaled by the ladder's filter graph
+        scale = stream_index not in dict(self.args.transcode_ladder)
+        return self._rate_control[stream_index] != self.get_rate_control_args(
+            stream_index, scale
+        )
 
     async def get_feature_flags(self) -> dict[str, Any]:
         return {
@@ -113,7 +503,10 @@ class UnifiCamBase(metaclass=ABCMeta):
 
     # API for subclasses
     async def trigger_motion_start(
-        self, object_type: Optional[SmartDetectObjectType] = None
+        self,
+        object_type: Optional[SmartDetectObjectType] = None,
+        levels: Optional[dict[str, int]] = None,
+        zones_status: Optional[dict[str, int]] = None,
     ) -> None:
         if not self._motion_event_ts:
             payload: dict[str, Any] = {
@@ -126,16 +519,18 @@ class UnifiCamBase(metaclass=ABCMeta):
                 "edgeType": "start",
                 "eventId": self._motion_event_id,
                 "eventType": "motion",
-                "levels": {"0": 47},
+                "levels": levels or {"0": 47},
                 "motionHeatmap": "",
                 "motionSnapshot": "",
             }
+            if zones_status:
+                payload["zonesStatus"] = zones_status
             if object_type:
                 payload.update(
                     {
                         "objectTypes": [object_type.value],
                         "edgeType": "enter",
-                        "zonesStatus": {"0": 48},
+                        "zonesStatus": zones_status or {"0": 48},
                         "smartDetectSnapshot": "",
                     }
                 )
@@ -151,20 +546,26 @@ class UnifiCamBase(metaclass=ABCMeta):
                     "EventSmartDetect" if object_type else "EventAnalytics",
                     payload=payload,
                 ),
+                key=f"motion-start-{self._motion_event_id}",
             )
             self._motion_event_ts = time.time()
             self._motion_object_type = object_type
 
             # Capture snapshot at beginning of motion event for thumbnail
-            motion_snapshot_path: str = tempfile.NamedTemporaryFile(delete=False).name
             try:
-                shutil.copyfile(await self.get_snapshot(), motion_snapshot_path)
-                self.logger.debug(f"Captured motion snapshot to {motion_snapshot_path}")
-                self._motion_snapshot = Path(motion_snapshot_path)
+                motion_snapshot = await run_blocking(
+                    copy_to_tempfile, await self.get_snapshot()
+                )
+                self.logger.debug(f"Captured motion snapshot to {motion_snapshot}")
+                self._motion_snapshot = motion_snapshot
             except FileNotFoundError:
                 pass
 
-    async def trigger_motion_stop(self) -> None:
+    async def trigger_motion_stop(
+        self,
+        levels: Optional[dict[str, int]] = None,
+        zones_status: Optional[dict[str, int]] = None,
+    ) -> None:
         motion_start_ts = self._motion_event_ts
         motion_object_type = self._motion_object_type
         if motion_start_ts:
@@ -178,16 +579,18 @@ class UnifiCamBase(metaclass=ABCMeta):
                 "edgeType": "stop",
                 "eventId": self._motion_event_id,
                 "eventType": "motion",
-                "levels": {"0": 49},
+                "levels": levels or {"0": 49},
                 "motionHeatmap": "heatmap.png",
                 "motionSnapshot": "motionsnap.jpg",
             }
+            if zones_status is not None:
+                payload["zonesStatus"] = zones_status
             if motion_object_type:
                 payload.update(
                     {
                         "objectTypes": [motion_object_type.value],
                         "edgeType": "leave",
-                        "zonesStatus": {"0": 48},
+                        "zonesStatus": zones_status or {"0": 48},
                         "smartDetectSnapshot": "motionsnap.jpg",
                     }
                 )
@@ -197,16 +600,75 @@ class UnifiCamBase(metaclass=ABCMeta):
                 if motion_object_type
                 else ""
             )
+            # A start still queued is dropped together with its stop
             await self.send(
                 self.gen_response(
                     "EventSmartDetect" if motion_object_type else "EventAnalytics",
                     payload=payload,
                 ),
+                cancels=f"motion-start-{self._motion_event_id}",
             )
             self._motion_event_id += 1
             self._motion_event_ts = None
             self._motion_object_type = None
 
+    def get_stats(self) -> dict[str, Any]:
+        streams = {}
+        for stream_index, pipeline in self._pipelines.items():
+            streams[stream_index] = {
+                **pipeline.stats(),
+                **self._process_stats.get(stream_index, {}),
+            }
+        stats: dict[str, Any] = {
+            "name": self.args.name,
+            "mac": self.args.mac,
+            "uptime": int(self.get_uptime()),
+            "streams": streams,
+        }
+        if "ladder" in self._process_stats:
+            stats["ladder"] = self._process_stats["ladder"]
+        if self._send_queue:
+            stats["send_queue"] = self._send_queue.stats()
+        monitor = get_loop_monitor()
+        if monitor:
+            stats["loop"] = monitor.stats()
+        return stats
+
+    async def monitor_streams(self) -> None:
+        if self.args.stats_interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.args.stats_interval)
+            await self.sample_streams()
+
+    async def sample_streams(self) -> None:
+        sessions = {
+            stream_index: pipeline.pid
+            for stream_index, pipeline in self._pipelines.items()
+            if pipeline.is_alive() and pipeline.pid
+        }
+        if self._ladder and self._ladder.is_alive() and self._ladder.pid:
+            sessions["ladder"] = self._ladder.pid
+        # Scans /proc, which takes a while with many processes
+        self._process_stats = await run_blocking(self._sampler.sample, sessions)
+
+        cpu_budget = self.args.stream_cpu_budget
+        memory_budget = self.args.stream_memory_budget
+        for name, stats in self._process_stats.items():
+            if cpu_budget is not None and stats["cpu_percent"] > cpu_budget:
+                self.logger.warning(
+                    f"Stream {name} is using {stats['cpu_percent']}% CPU"
+                    f" (budget: {cpu_budget}%)"
+                )
+            rss_mb = stats["rss_bytes"] / 1024 / 1024
+            if memory_budget is not None and rss_mb > memory_budget:
+                self.logger.warning(
+                    f"Stream {name} is using {rss_mb:.0f}MB of memory"
+                    f" (budget: {memory_budget}MB)"
+                )
+        if self.stream_logger.isEnabledFor(logging.DEBUG):
+            self.stream_logger.debug("Runtime stats: %s", self.get_stats())
+
     def update_motion_snapshot(self, path: Path) -> None:
         self._motion_snapshot = path
 
@@ -216,9 +678,8 @@ class UnifiCamBase(metaclass=ABCMeta):
                 if resp.status != 200:
                     self.logger.error(f"Error retrieving file {resp.status}")
                     return False
-                with dst.open("wb") as f:
-                    f.write(await resp.read())
-                    return True
+                await write_file(dst, await resp.read())
+                return True
         except aiohttp.ClientError:
             return False
 
@@ -351,10 +812,12 @@ class UnifiCamBase(metaclass=ABCMeta):
         if msg["payload"] is not None and "video" in msg["payload"]:
             for k, v in msg["payload"]["video"].items():
                 if v:
+                    if self.args.honor_video_settings:
+                        await self.update_video_settings(k, v)
                     if "avSerializer" in v:
                         vid_dst[k] = v["avSerializer"]["destinations"]
                         if "/dev/null" in vid_dst[k]:
-                            self.stop_video_stream(k)
+                            self.release_video_stream(k)
                         elif "parameters" in v["avSerializer"]:
                             self._streams[k] = stream = v["avSerializer"]["parameters"][
                                 "streamName"
@@ -369,7 +832,7 @@ class UnifiCamBase(metaclass=ABCMeta):
                             except ValueError:
                                 pass
 
-        return self.gen_response(
+        res = self.gen_response(
             "ChangeVideoSettings",
             msg["messageId"],
             {
@@ -611,6 +1074,46 @@ class UnifiCamBase(metaclass=ABCMeta):
                 },
             },
         )
+        for k in ["video1", "video2", "video3"]:
+            res["payload"]["video"][k].update(self.get_applied_video_settings(k))
+        return res
+
+    async def update_video_settings(
+        self, stream_index: str, options: dict[str, Any]
+    ) -> None:
+        current = self._video_settings.get(stream_index, {})
+        settings = {
+            **current,
+            **{
+                key: options[key]
+                for key in VIDEO_SETTING_KEYS
+                if options.get(key) is not None
+            },
+        }
+        if settings == current:
+            return
+
+        self.logger.info(f"Requested settings for {stream_index}: {settings}")
+        self._video_settings[stream_index] = settings
+        if await self.change_stream_settings(stream_index, settings):
+            self._encoder_configured.add(stream_index)
+        else:
+            self._encoder_configured.discard(stream_index)
+            if self.rate_control_changed(stream_index):
+                await self.restart_video_stream(stream_index)
+
+    def get_applied_video_settings(self, stream_index: str) -> dict[str, Any]:
+        if stream_index in self._encoder_configured or self.is_video_transcoded(
+            stream_index
+        ):
+            settings = self._video_settings.get(stream_index, {})
+            ladder = dict(self.args.transcode_ladder)
+            if stream_index in ladder:
+                # Renditions keep the ladder's size, whatever the NVR asked for
+                width, height = ladder[stream_index]
+                settings = {**settings, "width": width, "height": height}
+            return settings
+        return {}
 
     async def process_device_settings(self, msg: AVClientRequest) -> AVClientResponse:
         return self.gen_response(
@@ -764,6 +1267,15 @@ class UnifiCamBase(metaclass=ABCMeta):
     async def process_analytics_settings(
         self, msg: AVClientRequest
     ) -> AVClientResponse:
+        if msg["payload"]:
+            zones, masks = parse_analytics_settings(msg["payload"])
+            if zones != self.motion_zones or masks != self.privacy_masks:
+                self.motion_logger.info(
+                    f"Using {len(zones)} motion zones and {len(masks)} privacy masks"
+                )
+                self.motion_zones = zones
+                self.privacy_masks = masks
+                self.analytics_version += 1
         return self.gen_response(
             "ChangeAnalyticsSettings", msg["messageId"], msg["payload"]
         )
@@ -778,18 +1290,42 @@ class UnifiCamBase(metaclass=ABCMeta):
             path = await self.get_snapshot()
 
         if path and path.exists():
-            async with aiohttp.ClientSession() as session:
-                files = {"payload": open(path, "rb")}
-                files.update(msg["payload"].get("formFields", {}))
-                try:
-                    await session.post(
-                        msg["payload"]["uri"],
-                        data=files,
-                        ssl=self._ssl_context,
-                    )
-                    self.logger.debug(f"Uploaded {snapshot_type} from {path}")
-                except aiohttp.ClientError:
-                    self.logger.exception("Failed to upload snapshot")
+            requested_size = None
+            if msg["payload"].get("width") and msg["payload"].get("height"):
+                requested_size = (
+                    int(msg["payload"]["width"]),
+                    int(msg["payload"]["height"]),
+                )
+            resized = await self._resizer.resize(path, requested_size)
+
+            # aiohttp reads the file from its own executor, only opening blocks
+            payload = None if resized else await run_blocking(open, path, "rb")
+            try:
+                async with aiohttp.ClientSession() as session:
+                    files = aiohttp.FormData()
+                    if resized:
+                        files.add_field(
+                            "payload",
+                            resized,
+                            filename=path.name,
+                            content_type="image/jpeg",
+                        )
+                    else:
+                        files.add_field("payload", payload)
+                    for key, value in msg["payload"].get("formFields", {}).items():
+                        files.add_field(key, value)
+                    try:
+                        await session.post(
+                            msg["payload"]["uri"],
+                            data=files,
+                            ssl=self._ssl_context,
+                        )
+                        self.logger.debug(f"Uploaded {snapshot_type} from {path}")
+                    except aiohttp.ClientError:
+                        self.logger.exception("Failed to upload snapshot")
+            finally:
+                if payload:
+                    payload.close()
         else:
             self.logger.warning(
                 f"Snapshot file {path} is not ready yet, skipping upload"
@@ -827,18 +1363,40 @@ class UnifiCamBase(metaclass=ABCMeta):
     def get_uptime(self) -> float:
         return time.time() - self._init_time
 
-    async def send(self, msg: AVClientRequest) -> None:
-        self.logger.debug(f"Sending: {msg}")
-        ws = self._session
-        if ws:
-            await ws.send(json.dumps(msg).encode())
+    async def send(
+        self,
+        msg: AVClientRequest,
+        key: Optional[str] = None,
+        cancels: Optional[str] = None,
+    ) -> None:
+        """
+        Queue a message for the NVR. Events are sent after protocol responses
+        and can be coalesced, see `SendQueue.put`.
+        """
+        self.protocol_logger.debug("Sending: %s", msg)
+        if self._send_queue:
+            priority = (
+                PRIORITY_EVENT
+                if msg["functionName"].startswith("Event")
+                else PRIORITY_RESPONSE
+            )
+            self._send_queue.put(msg, priority, key, cancels)
+        else:
+            self.protocol_logger.warning(
+                f"Not connected to the NVR, dropped {msg['functionName']}"
+            )
 
     async def process(self, msg: bytes) -> bool:
         m = json.loads(msg)
         fn = m["functionName"]
 
-        self.logger.info(f"Processing [{fn}] message")
-        self.logger.debug(f"Message contents: {m}")
+        if fn in SAMPLED_MESSAGES:
+            self._log_sampler.log(
+                self.protocol_logger, logging.INFO, fn, "Processing [%s] message", fn
+            )
+        else:
+            self.protocol_logger.info("Processing [%s] message", fn)
+        self.protocol_logger.debug("Message contents: %s", m)
 
         if (("responseExpected" not in m) or (m["responseExpected"] is False)) and (
             fn
@@ -899,7 +1457,7 @@ class UnifiCamBase(metaclass=ABCMeta):
 
         return False
 
-    def get_base_ffmpeg_args(self, stream_index: str = "") -> str:
+    async def get_base_ffmpeg_args(self, stream_index: str = "") -> str:
         base_args = [
             "-avoid_negative_ts",
             "make_zero",
@@ -907,57 +1465,317 @@ class UnifiCamBase(metaclass=ABCMeta):
             "+genpts+discardcorrupt",
             "-use_wallclock_as_timestamps 1",
         ]
+        if stream_index in self._fast_probe:
+            base_args.append(FAST_PROBE_ARGS)
 
-        try:
-            output = subprocess.check_output(["ffmpeg", "-h", "full"])
-            if b"stimeout" in output:
-                base_args.append("-stimeout 15000000")
-            else:
-                base_args.append("-timeout 15000000")
-        except subprocess.CalledProcessError:
-            self.logger.exception("Could not check for ffmpeg options")
+        timeout_option = await get_ffmpeg_timeout_option(self.stream_logger)
+        if timeout_option:
+            base_args.append(f"{timeout_option} 15000000")
 
         return " ".join(base_args)
 
+    async def prewarm_streams(self) -> None:
+        """
+        Start ingest and probing of the expected streams while the connection
+        to the NVR is set up, holding their output until it requests them.
+        """
+        for stream_index in self.args.prewarm_streams:
+            self._prewarming[stream_index] = asyncio.create_task(
+                self.prewarm_stream(stream_index)
+            )
+        await asyncio.gather(*self._prewarming.values())
+        self._prewarming.clear()
+
+    async def prewarm_stream(self, stream_index: str) -> None:
+        try:
+            if stream_index in dict(self.args.transcode_ladder):
+                if not self._ladder or not self._ladder.is_alive():
+                    self.stream_logger.info("Pre-warming transcode ladder")
+                    await self.start_transcode_ladder()
+                return
+            pipeline = self._pipelines.get(stream_index)
+            if pipeline and pipeline.is_alive():
+                return
+            self.stream_logger.info(f"Pre-warming {stream_index}")
+            pipeline = await self.spawn_video_stream(stream_index, stream_index)
+            pipeline.hold(self.args.prewarm_timeout)
+        except Exception:
+            self.stream_logger.exception(f"Could not pre-warm {stream_index}")
+
+    async def wait_for_prewarm(self, stream_index: str) -> None:
+        # Never spawn a second ingest next to one that is still starting
+        task = self._prewarming.get(stream_index)
+        if task and not task.done():
+            await asyncio.shield(task)
+
     async def start_video_stream(
         self, stream_index: str, stream_name: str, destination: tuple[str, int]
     ):
-        has_spawned = stream_index in self._ffmpeg_handles
-        is_dead = has_spawned and self._ffmpeg_handles[stream_index].poll() is not None
+        await self.wait_for_prewarm(stream_index)
+        if stream_index in dict(self.args.transcode_ladder):
+            await self.start_ladder_stream(stream_index, stream_name, destination)
+            return
+
+        pipeline = self._pipelines.get(stream_index)
+        if pipeline:
+            if (
+                pipeline.is_alive()
+                and not self.rate_control_changed(stream_index)
+                and (
+                    pipeline.stream_name == stream_name
+                    or pipeline.has_subscribers()
+                    or not pipeline.attach_count
+                )
+            ):
+                # Pipelines pre-warmed or started for local clients are
+                # renamed on attach
+                await pipeline.attach(destination, stream_name)
+                return
+            elif pipeline.is_alive():
+                pipeline.stop()
+            else:
+                self.logger.warn(f"Previous ffmpeg process for {stream_index} died.")
+                if not pipeline.has_video_config():
+                    # Never produced video, the cached parameters may be stale
+                    self.invalidate_stream_cache(stream_index)
+
+        pipeline = await self.spawn_video_stream(stream_index, stream_name)
+        await pipeline.attach(destination)
+
+    async def spawn_video_stream(
+        self, stream_index: str, stream_name: str
+    ) -> StreamPipeline:
+        source = await self.resolve_stream_source(stream_index)
+        await self.probe_stream_source(stream_index, source)
+        rate_control = self.get_rate_control_args(stream_index)
+        cmd = (
+            "ffmpeg -nostdin -loglevel error -y"
+            f" {await self.get_base_ffmpeg_args(stream_index)} -rtsp_transport"
+            f' {self.args.rtsp_transport} -i "{source}"'
+            f" {self.get_extra_ffmpeg_args(stream_index)}"
+            f" {rate_control} -metadata"
+            f" streamName={stream_name} -f flv - | {sys.executable} -m"
+            " unifi.clock_sync"
+            f" {'--write-timestamps' if self._needs_flv_timestamps else ''}"
+        )
 
-        if not has_spawned or is_dead:
-            source = await self.get_stream_source(stream_index)
-            cmd = (
-                "ffmpeg -nostdin -loglevel error -y"
-                f" {self.get_base_ffmpeg_args(stream_index)} -rtsp_transport"
-                f' {self.args.rtsp_transport} -i "{source}"'
-                f" {self.get_extra_ffmpeg_args(stream_index)} -metadata"
-                f" streamName={stream_name} -f flv - | {sys.executable} -m"
-                " unifi.clock_sync"
-                f" {'--write-timestamps' if self._needs_flv_timestamps else ''} | nc"
-                f" {destination[0]} {destination[1]}"
-            )
+        self.logger.info(f"Spawning ffmpeg for {stream_index} ({stream_name}): {cmd}")
+        pipeline = StreamPipeline(
+            stream_index,
+            stream_name,
+            cmd,
+            self.args.stream_grace_period,
+            self.stream_logger,
+            gop_cache=self.args.gop_cache,
+            on_config=lambda kind, data: self.check_stream_config(
+                stream_index, kind, data
+            ),
+            spool=self.get_spool(stream_index),
+            replay_rate=self.args.spool_replay_rate * 1000 * 1000 / 8,
+        )
+        self._pipelines[stream_index] = pipeline
+        self._rate_control[stream_index] = rate_control
+        await pipeline.start()
+        return pipeline
+
+    async def update_snapshot_from_stream(self, dst: Path) -> bool:
+        """
+        Decode the latest keyframe relayed by a running stream into `dst`,
+        without opening another session to the camera.
+        """
+        # Lowest quality first, its keyframe is the cheapest to decode
+        for stream_index in ("video3", "video2", "video1"):
+            pipeline = self._pipelines.get(stream_index)
+            if not pipeline or not pipeline.is_alive():
+                continue
+            flv = pipeline.keyframe_flv()
+            if flv and await decode_snapshot(
+                ["-f", "flv", "-i", "pipe:0"], dst, self.stream_logger, stdin=flv
+            ):
+                return True
+        return False
 
-            if is_dead:
-                self.logger.warn(f"Previous ffmpeg process for {stream_index} died.")
+    async def acquire_local_stream(self, stream_index: str) -> StreamPipeline:
+        """
+        Return a running pipeline of a stream for local clients, sharing the
+        one relayed to the NVR or starting it if the NVR is not using it.
+        """
+        await self.wait_for_prewarm(stream_index)
+        if stream_index in dict(self.args.transcode_ladder):
+            if not self._ladder or not self._ladder.is_alive():
+                await self.start_transcode_ladder()
+            assert self._ladder
+            self._ladder.unpark()
+            return self._pipelines[stream_index]
+
+        pipeline = self._pipelines.get(stream_index)
+        if pipeline and pipeline.is_alive():
+            return pipeline
+        self.logger.info(f"Starting {stream_index} for local clients")
+        return await self.spawn_video_stream(stream_index, stream_index)
+
+    async def start_ladder_stream(
+        self, stream_index: str, stream_name: str, destination: tuple[str, int]
+    ):
+        if (
+            not self._ladder
+            or not self._ladder.is_alive()
+            or self.rate_control_changed(stream_index)
+        ):
+            await self.start_transcode_ladder()
 
-            self.logger.info(
-                f"Spawning ffmpeg for {stream_index} ({stream_name}): {cmd}"
+        assert self._ladder
+        self._ladder.unpark()
+        await self._pipelines[stream_index].attach(destination, stream_name)
+
+    async def start_transcode_ladder(self):
+        if self._ladder:
+            self._ladder.cleanup()
+
+        ladder = await TranscodeLadder.create(
+            dict(self.args.transcode_ladder), self.stream_logger
+        )
+        source = await self.resolve_stream_source("video1")
+        for stream_index in ladder.outputs:
+            await self.probe_stream_source(stream_index, source)
+        first_rendition = next(iter(ladder.outputs))
+        rate_control = {
+            stream_index: self.get_rate_control_args(stream_index, scale=False)
+            for stream_index in ladder.outputs
+        }
+        outputs = " ".join(
+            f'-map "[{stream_index}]" -map "0:a?"'
+            f" {self.get_extra_ffmpeg_args(stream_index)}"
+            f" {rate_control[stream_index]}"
+            f" -metadata streamName={stream_index} -f flv {fifo}"
+            for stream_index, fifo in ladder.outputs.items()
+        )
+        cmd = (
+            "ffmpeg -nostdin -loglevel error -y"
+            f" {await self.get_base_ffmpeg_args(first_rendition)} -rtsp_transport"
+            f' {self.args.rtsp_transport} -i "{source}"'
+            f' -filter_complex "{ladder.filter_complex()}" {outputs}'
+        )
+
+        # Each rendition is relayed by its own clock_sync reading the FIFO,
+        # renditions the NVR was already receiving are attached again
+        reattach = []
+        for stream_index, fifo in ladder.outputs.items():
+            previous = self._pipelines.get(stream_index)
+            if previous:
+                if previous.is_attached() and previous.destination:
+                    reattach.append(
+                        (stream_index, previous.destination, previous.stream_name)
+                    )
+                previous.stop()
+            pipeline = StreamPipeline(
+                stream_index,
+                stream_index,
+                f"{sys.executable} -m unifi.clock_sync"
+                f" {'--write-timestamps' if self._needs_flv_timestamps else ''}"
+                f" < {fifo}",
+                self.args.stream_grace_period,
+                self.stream_logger,
+                gop_cache=self.args.gop_cache,
+                persistent=True,
+                spool=self.get_spool(stream_index),
+                replay_rate=self.args.spool_replay_rate * 1000 * 1000 / 8,
             )
-            self._ffmpeg_handles[stream_index] = subprocess.Popen(
-                cmd, stdout=subprocess.DEVNULL, shell=True
+            # The new pipeline reuses the stopped one's spool ring, other
+            # pipelines keep theirs
+            self._pipelines[stream_index] = pipeline
+            await pipeline.start()
+
+        self.logger.info(f"Spawning ffmpeg for transcoding ladder: {cmd}")
+        await ladder.start(cmd)
+        self._ladder = ladder
+        self._rate_control.update(rate_control)
+        for stream_index, destination, stream_name in reattach:
+            await self._pipelines[stream_index].attach(destination, stream_name)
+
+    def get_spool(self, stream_index: str) -> Optional[SpoolRing]:
+        if not self.args.spool_dir:
+            return None
+        if stream_index not in self._spools:
+            spool_dir = Path(self.args.spool_dir)
+            try:
+                spool_dir.mkdir(parents=True, exist_ok=True)
+                self._spools[stream_index] = SpoolRing(
+                    spool_dir / f"{self.args.mac}-{stream_index}.spool",
+                    self.args.spool_size * 1024 * 1024,
+                )
+            except OSError:
+                self.logger.exception(f"Could not create spool for {stream_index}")
+                return None
+        return self._spools[stream_index]
+
+    async def restart_video_stream(self, stream_index: str):
+        pipeline = self._pipelines.get(stream_index)
+        if not pipeline or not pipeline.is_alive():
+            return
+
+        destination = pipeline.destination
+        attached = pipeline.is_attached()
+        self.logger.info(f"Restarting stream {stream_index} with new settings")
+        if stream_index in dict(self.args.transcode_ladder):
+            assert self._ladder
+            self._ladder.stop()
+        else:
+            pipeline.stop()
+        if destination and attached:
+            await self.start_video_stream(
+                stream_index, pipeline.stream_name, destination
             )
 
     def stop_video_stream(self, stream_index: str):
-        if stream_index in self._ffmpeg_handles:
+        if stream_index in self._pipelines:
             self.logger.info(f"Stopping stream {stream_index}")
-            self._ffmpeg_handles[stream_index].kill()
+            self._pipelines[stream_index].stop()
+
+    def release_video_stream(self, stream_index: str):
+        # Persistent streams stay warm when the NVR no longer wants them
+        pipeline = self._pipelines.get(stream_index)
+        if pipeline and (pipeline.persistent or pipeline.has_subscribers()):
+            self.logger.info(f"Detaching stream {stream_index}")
+            pipeline.detach()
+        else:
+            self.stop_video_stream(stream_index)
 
     async def close(self):
         self.logger.info("Cleaning up instance")
         await self.trigger_motion_stop()
-        self.close_streams()
+        self.park_streams()
+
+    async def start_http_api(self) -> None:
+        """
+        Serve the local API for the lifetime of the camera, so local viewers
+        do not depend on the connection to the NVR.
+        """
+        if self.args.http_api and not self._http_api:
+            self._http_api = HttpApi(self, self.args.http_api, self.logger)
+            await self._http_api.start()
+
+    async def stop_http_api(self) -> None:
+        if self._http_api:
+            await self._http_api.stop()
+            self._http_api = None
+
+    def park_streams(self):
+        # Losing the NVR connection is an outage, streams with a spool keep
+        # recording into it
+        for pipeline in self._pipelines.values():
+            pipeline.detach(outage=True)
+        local_clients = any(p.has_subscribers() for p in self._pipelines.values())
+        if self._ladder and not (
+            self.args.gop_cache or self.args.spool_dir or local_clients
+        ):
+            self._ladder.park(self.args.stream_grace_period)
 
     def close_streams(self):
-        for stream in self._ffmpeg_handles:
+        for stream in self._pipelines:
             self.stop_video_stream(stream)
+        if self._ladder:
+            self._ladder.cleanup()
+        for spool in self._spools.values():
+            spool.close()
+        self._spools.clear()
@@ -8,6 +8,7 @@ from amcrest import AmcrestCamera
 from amcrest.exceptions import CommError
 
 from unifi.cams.base import RetryableError, SmartDetectObjectType, UnifiCamBase
+from unifi.executor import write_file
 
 
 class DahuaCam(UnifiCamBase):
@@ -81,8 +82,7 @@ class DahuaCam(UnifiCamBase):
             snapshot = await self.camera.async_snapshot(
                 channel=self.args.snapshot_channel
             )
-            with img_file.open("wb") as f:
-                f.write(snapshot)
+            await write_file(img_file, snapshot)
         except CommError as e:
             self.logger.warning("Could not fetch snapshot", exc_info=e)
             pass
@@ -102,7 +102,13 @@ class DahuaCam(UnifiCamBase):
                     index = event[1].get("index")
 
                     if not index or int(index) != self.args.motion_index:
-                        self.logger.debug(f"Skipping event {event}")
+                        self._log_sampler.log(
+                            self.motion_logger,
+                            logging.DEBUG,
+                            "skipped_event",
+                            "Skipping event %s",
+                            event,
+                        )
                         continue
 
                     object_type = None
@@ -4,13 +4,127 @@ import logging
 import tempfile
 import time
 from pathlib import Path
-from typing import Any, Union
+from typing import Any, Optional
 
 import httpx
 import xmltodict
 from hikvisionapi import AsyncClient
 
-from unifi.cams.base import UnifiCamBase
+from unifi.alertstream import Alert, AlertStreamParser, parse_boundary
+from unifi.cams.base import SmartDetectObjectType, UnifiCamBase
+from unifi.executor import write_file
+
+# PTZ ranges of AbsoluteHigh, in tenths of a degree and zoom steps
+PTZ_MAX_PAN = 3600
+PTZ_MAX_TILT = 900
+PTZ_MAX_ZOOM = 40
+
+TARGET_OBJECT_TYPES = {
+    "human": SmartDetectObjectType.PERSON,
+    "vehicle": SmartDetectObjectType.VEHICLE,
+}
+
+
+class HikvisionPTZ:
+    """
+    PTZ control of one channel. Moves are coalesced so only the latest target
+    is sent, at most once per `interval`, and the position is polled in the
+    background so it can be reported without a request to the camera.
+    """
+
+    def __init__(
+        self,
+        cam: AsyncClient,
+        channel: int,
+        interval: float,
+        status_interval: float,
+        logger: logging.Logger,
+    ) -> None:
+        self.cam = cam
+        self.channel = channel
+        self.interval = interval
+        self.status_interval = status_interval
+        self.logger = logger
+        # (pan, tilt, zoom) in camera units
+        self.position: Optional[tuple[int, int, int]] = None
+        self._target: Optional[tuple[int, int, int]] = None
+        self._pending: Optional[asyncio.Event] = None
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._pending = asyncio.Event()
+            self._tasks = [
+                asyncio.create_task(self._send_moves()),
+                asyncio.create_task(self._poll_status()),
+            ]
+
+    def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def move(self, pan: int, tilt: int, zoom: int) -> None:
+        """Queue a move, replacing any that was not sent yet."""
+        assert self._pending
+        self._target = (pan, tilt, zoom)
+        self._pending.set()
+
+    @property
+    def target(self) -> Optional[tuple[int, int, int]]:
+        """Position the camera is moving to, or is at once it stopped."""
+        return self._target or self.position
+
+    async def _send_moves(self) -> None:
+        assert self._pending
+        while True:
+            await self._pending.wait()
+            self._pending.clear()
+            target = self._target
+            if target is None:
+                continue
+            pan, tilt, zoom = target
+            self.logger.info("Moving to %s:%s:%s", pan, tilt, zoom)
+            req = {
+                "PTZData": {
+                    "@version": "2.0",
+                    "@xmlns": "http://www.hikvision.com/ver20/XMLSchema",
+                    "AbsoluteHigh": {
+                        "absoluteZoom": str(zoom),
+                        "azimuth": str(pan),
+                        "elevation": str(tilt),
+                    },
+                }
+            }
+            try:
+                await self.cam.PTZCtrl.channels[self.channel].absolute(
+                    method="put", data=xmltodict.unparse(req, pretty=True)
+                )
+                self.position = target
+            except (httpx.RequestError, httpx.HTTPStatusError) as e:
+                self.logger.warning(f"PTZ move failed: {e}")
+            if self._target == target:
+                self._target = None
+            # Targets queued meanwhile are coalesced into the next move
+            await asyncio.sleep(self.interval)
+
+    async def _poll_status(self) -> None:
+        while True:
+            if self._target is None:
+                try:
+                    r = (
+                        await self.cam.PTZCtrl.channels[self.channel].status(
+                            method="get"
+                        )
+                    )["PTZStatus"]["AbsoluteHigh"]
+                    self.position = (
+                        int(r["azimuth"]),
+                        int(r["elevation"]),
+                        int(r["absoluteZoom"]),
+                    )
+                except (httpx.RequestError, httpx.HTTPStatusError, KeyError) as e:
+                    self.logger.debug(f"Could not get PTZ status: {e}")
+            await asyncio.sleep(self.status_interval)
 
 
 class HikvisionCam(UnifiCamBase):
@@ -26,9 +140,9 @@ class HikvisionCam(UnifiCamBase):
         )
         self.channel = args.channel
         self.substream = args.substream
-        self.ptz_supported = False
+        self.ptz: Optional[HikvisionPTZ] = None
         self.motion_in_progress: bool = False
-        self._last_event_timestamp: Union[str, int] = 0
+        self._last_event_timestamp: float = 0
 
     @classmethod
     def add_parser(cls, parser: argparse.ArgumentParser) -> None:
@@ -41,19 +155,41 @@ class HikvisionCam(UnifiCamBase):
         parser.add_argument(
             "--substream", "-s", default=3, type=int, help="Camera substream index"
         )
+        parser.add_argument(
+            "--ptz-channel",
+            default=None,
+            type=int,
+            help="Channel of the PTZ controlled by the image settings"
+            " (default: --channel)",
+        )
+        parser.add_argument(
+            "--ptz-interval",
+            default=0.5,
+            type=float,
+            help="Minimum seconds between PTZ moves, moves requested meanwhile"
+            " are merged",
+        )
+        parser.add_argument(
+            "--ptz-status-interval",
+            default=10,
+            type=float,
+            help="Seconds between PTZ position updates",
+        )
 
     async def get_snapshot(self) -> Path:
         img_file = Path(self.snapshot_dir, "screen.jpg")
         source = int(f"{self.channel}01")
+        chunks = []
         try:
-            with img_file.open("wb") as f:
-                async for chunk in self.cam.Streaming.channels[source].picture(
-                    method="get", type="opaque_data"
-                ):
-                    if chunk:
-                        f.write(chunk)
+            async for chunk in self.cam.Streaming.channels[source].picture(
+                method="get", type="opaque_data"
+            ):
+                if chunk:
+                    chunks.append(chunk)
         except httpx.RequestError:
             pass
+        if chunks:
+            await write_file(img_file, b"".join(chunks))
         return img_file
 
     async def check_ptz_support(self, channel) -> bool:
@@ -66,41 +202,25 @@ class HikvisionCam(UnifiCamBase):
         return False
 
     async def get_video_settings(self) -> dict[str, Any]:
-        if self.ptz_supported:
-            r = (await self.cam.PTZCtrl.channels[1].status(method="get"))["PTZStatus"][
-                "AbsoluteHigh"
-            ]
+        position = self.ptz.target if self.ptz else None
+        if position:
+            pan, tilt, zoom = position
             return {
                 # Tilt/elevation
-                "brightness": int(100 * int(r["azimuth"]) / 3600),
+                "brightness": int(100 * tilt / PTZ_MAX_TILT),
                 # Pan/azimuth
-                "contrast": int(100 * int(r["azimuth"]) / 3600),
+                "contrast": int(100 * pan / PTZ_MAX_PAN),
                 # Zoom
-                "hue": int(100 * int(r["absoluteZoom"]) / 40),
+                "hue": int(100 * zoom / PTZ_MAX_ZOOM),
             }
         return {}
 
     async def change_video_settings(self, options: dict[str, Any]) -> None:
-        if self.ptz_supported:
-            tilt = int((900 * int(options["brightness"])) / 100)
-            pan = int((3600 * int(options["contrast"])) / 100)
-            zoom = int((40 * int(options["hue"])) / 100)
-
-            self.logger.info("Moving to %s:%s:%s", pan, tilt, zoom)
-            req = {
-                "PTZData": {
-                    "@version": "2.0",
-                    "@xmlns": "http://www.hikvision.com/ver20/XMLSchema",
-                    "AbsoluteHigh": {
-                        "absoluteZoom": str(zoom),
-                        "azimuth": str(pan),
-                        "elevation": str(tilt),
-                    },
-                }
-            }
-            await self.cam.PTZCtrl.channels[1].absolute(
-                method="put", data=xmltodict.unparse(req, pretty=True)
-            )
+        if self.ptz:
+            tilt = int((PTZ_MAX_TILT * int(options["brightness"])) / 100)
+            pan = int((PTZ_MAX_PAN * int(options["contrast"])) / 100)
+            zoom = int((PTZ_MAX_ZOOM * int(options["hue"])) / 100)
+            self.ptz.move(pan, tilt, zoom)
 
     async def get_stream_source(self, stream_index: str) -> str:
         substream = 1
@@ -119,30 +239,56 @@ class HikvisionCam(UnifiCamBase):
             self.motion_in_progress = False
 
     async def run(self) -> None:
-        self.ptz_supported = await self.check_ptz_support(self.channel)
-        return
+        ptz_channel = self.args.ptz_channel or self.channel
+        if not self.ptz and await self.check_ptz_support(ptz_channel):
+            self.ptz = HikvisionPTZ(
+                self.cam,
+                ptz_channel,
+                self.args.ptz_interval,
+                self.args.ptz_status_interval,
+                self.logger,
+            )
+            self.ptz.start()
 
-        while True:
-            self.logger.info("Connecting to motion events API")
-            try:
-                async for event in self.cam.Event.notification.alertStream(
-                    method="get", type="stream", timeout=None
-                ):
-                    alert = event.get("EventNotificationAlert")
-                    if (
-                        alert
-                        and alert.get("channelID") == str(self.channel)
-                        and alert.get("eventType") == "VMD"
-                    ):
-                        self._last_event_timestamp = alert.get("dateTime", time.time())
-
-                        if self.motion_in_progress is False:
-                            self.motion_in_progress = True
-                            await self.trigger_motion_start()
-
-                        # End motion event after 2 seconds of no updates
-                        asyncio.ensure_future(
-                            self.maybe_end_motion_event(self._last_event_timestamp)
+        url = f"http://{self.args.ip}/ISAPI/Event/notification/alertStream"
+        async with httpx.AsyncClient(
+            auth=httpx.DigestAuth(self.args.username, self.args.password),
+            # Cameras send a heartbeat every few seconds
+            timeout=httpx.Timeout(10, read=60),
+        ) as client:
+            while True:
+                self.logger.info("Connecting to motion events API")
+                try:
+                    async with client.stream("GET", url) as response:
+                        response.raise_for_status()
+                        parser = AlertStreamParser(
+                            parse_boundary(response.headers.get("content-type", ""))
                         )
-            except httpx.RequestError:
-                self.logger.error("Motion API request failed, retrying")
+                        async for chunk in response.aiter_bytes():
+                            for alert in parser.feed(chunk):
+                                await self.handle_alert(alert)
+                except (httpx.RequestError, httpx.HTTPStatusError) as e:
+                    self.logger.error(f"Motion API request failed, retrying: {e}")
+                await asyncio.sleep(5)
+
+    async def close(self) -> None:
+        # Started again by the next run
+        if self.ptz:
+            self.ptz.stop()
+            self.ptz = None
+        await super().close()
+
+    async def handle_alert(self, alert: Alert) -> None:
+        if not alert.active or alert.channel not in (None, str(self.channel)):
+            return
+        self.motion_logger.debug(f"Received {alert}")
+        self._last_event_timestamp = time.monotonic()
+
+        if self.motion_in_progress is False:
+            self.motion_in_progress = True
+            await self.trigger_motion_start(
+                TARGET_OBJECT_TYPES.get(alert.target_type or "")
+            )
+
+        # End motion event after 2 seconds of no updates
+        asyncio.ensure_future(self.maybe_end_motion_event(self._last_event_timestamp))
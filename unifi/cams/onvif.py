@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import logging
+import xml.etree.ElementTree as ET
+from typing import Optional
+
+import httpx
+
+from unifi.cams.base import SmartDetectObjectType
+from unifi.cams.rtsp import RTSPCam
+from unifi.onvif import Notification, OnvifError, OnvifEventsClient
+
+# Keywords in event topics of smart detections
+TOPIC_OBJECT_TYPES = {
+    "people": SmartDetectObjectType.PERSON,
+    "person": SmartDetectObjectType.PERSON,
+    "human": SmartDetectObjectType.PERSON,
+    "vehicle": SmartDetectObjectType.VEHICLE,
+    "car": SmartDetectObjectType.VEHICLE,
+}
+# Topics reported as motion, matched case-insensitively
+MOTION_TOPICS = (
+    "motion",
+    "linedetector",
+    "fielddetector",
+    "objectsinside",
+    "intrusion",
+    "people",
+    "person",
+    "human",
+    "vehicle",
+)
+# Seconds an event without a state, such as a line crossing, lasts
+PULSE_DURATION = 2
+
+
+def topic_object_type(topic: str) -> Optional[SmartDetectObjectType]:
+    topic = topic.lower()
+    for keyword, object_type in TOPIC_OBJECT_TYPES.items():
+        if keyword in topic:
+            return object_type
+    return None
+
+
+class OnvifCam(RTSPCam):
+    """
+    Generic camera streamed over RTSP, with motion and analytics events
+    received from its ONVIF PullPoint subscription.
+    """
+
+    def __init__(self, args: argparse.Namespace, logger: logging.Logger) -> None:
+        super().__init__(args, logger)
+        self.onvif = OnvifEventsClient(
+            self.args.onvif_host or self.args.ip,
+            self.args.onvif_port,
+            self.args.username,
+            self.args.password,
+            self.motion_logger,
+        )
+        # Topics currently reporting motion
+        self._active_topics: set[str] = set()
+        self._pulse_tasks: dict[str, asyncio.Task] = {}
+
+    @classmethod
+    def add_parser(cls, parser: argparse.ArgumentParser) -> None:
+        super().add_parser(parser)
+        parser.add_argument("--username", "-u", default="", help="Camera username")
+        parser.add_argument("--password", "-p", default="", help="Camera password")
+        parser.add_argument(
+            "--onvif-host",
+            default=None,
+            help="Camera ONVIF host, defaults to the camera IP address",
+        )
+        parser.add_argument(
+            "--onvif-port", default=80, type=int, help="Camera ONVIF port"
+        )
+        parser.add_argument(
+            "--onvif-source",
+            default=None,
+            help="Only use events of this video source token, for multi-channel"
+            " devices",
+        )
+
+    async def run(self) -> None:
+        await asyncio.gather(super().run(), self.watch_events())
+
+    async def check_video_source(self) -> None:
+        try:
+            sources = await self.onvif.video_sources()
+        except (httpx.HTTPError, OnvifError, ET.ParseError) as e:
+            self.logger.warning(f"Could not list ONVIF profiles: {e}")
+            return
+        if self.args.onvif_source not in sources.values():
+            self.logger.warning(
+                f"Video source {self.args.onvif_source} not found, the camera"
+                f" has {', '.join(sorted(set(sources.values()))) or 'none'}"
+            )
+
+    async def watch_events(self) -> None:
+        if self.args.onvif_source:
+            await self.check_video_source()
+        while True:
+            self.logger.info("Connecting to ONVIF events")
+            try:
+                async for notification in self.onvif.events():
+                    await self.handle_notification(notification)
+            except (httpx.HTTPError, OnvifError, ET.ParseError) as e:
+                self.logger.error(f"ONVIF events failed, retrying: {e}")
+            await asyncio.sleep(5)
+
+    async def handle_notification(self, notification: Notification) -> None:
+        topic = notification.topic
+        if not any(name in topic.lower() for name in MOTION_TOPICS):
+            return
+        if self.args.onvif_source and self.args.onvif_source not in (
+            notification.source.values()
+        ):
+            return
+        self.motion_logger.debug(f"Received {notification}")
+
+        state = notification.state
+        if state is None:
+            self._restart_pulse(topic)
+            state = True
+        if state:
+            self._active_topics.add(topic)
+            if not self._motion_event_ts:
+                await self.trigger_motion_start(topic_object_type(topic))
+        else:
+            self._active_topics.discard(topic)
+            if not self._active_topics and self._motion_event_ts:
+                await self.trigger_motion_stop()
+
+    def _restart_pulse(self, topic: str) -> None:
+        task = self._pulse_tasks.get(topic)
+        if task:
+            task.cancel()
+        self._pulse_tasks[topic] = asyncio.create_task(self._end_pulse(topic))
+
+    async def _end_pulse(self, topic: str) -> None:
+        await asyncio.sleep(PULSE_DURATION)
+        del self._pulse_tasks[topic]
+        self._active_topics.discard(topic)
+        if not self._active_topics and self._motion_event_ts:
+            await self.trigger_motion_stop()
@@ -1,14 +1,17 @@
 import argparse
+import asyncio
 import json
 import logging
 import tempfile
 from pathlib import Path
+from typing import Optional
 
 import aiohttp
 import reolinkapi
 from yarl import URL
 
 from unifi.cams.base import UnifiCamBase
+from unifi.executor import run_blocking
 
 
 class Reolink(UnifiCamBase):
@@ -17,12 +20,9 @@ class Reolink(UnifiCamBase):
         self.snapshot_dir: str = tempfile.mkdtemp()
         self.motion_in_progress: bool = False
         self.substream = args.substream
-        self.cam = reolinkapi.Camera(
-            ip=args.ip,
-            username=args.username,
-            password=args.password,
-        )
-        self.stream_fps = self.get_stream_info(self.cam)
+        self.cam: Optional[reolinkapi.Camera] = None
+        self.stream_fps: Optional[tuple[int, int]] = None
+        self._connect_lock = asyncio.Lock()
 
     @classmethod
     def add_parser(cls, parser: argparse.ArgumentParser) -> None:
@@ -54,6 +54,19 @@ class Reolink(UnifiCamBase):
             help="Stream profile to use for the lower quality stream",
         )
 
+    async def connect(self) -> None:
+        # reolinkapi is synchronous, log in and query from the thread pool
+        async with self._connect_lock:
+            if self.stream_fps is not None:
+                return
+            self.cam = await run_blocking(
+                reolinkapi.Camera,
+                ip=self.args.ip,
+                username=self.args.username,
+                password=self.args.password,
+            )
+            self.stream_fps = await run_blocking(self.get_stream_info, self.cam)
+
     def get_stream_info(self, camera) -> tuple[int, int]:
         info = camera.get_recording_encoding()
         return (
@@ -126,17 +139,21 @@ class Reolink(UnifiCamBase):
                 self.logger.error(f"Motion API request failed, retrying. Error: {err}")
 
     def get_extra_ffmpeg_args(self, stream_index: str) -> str:
+        args = f"{self.get_audio_ffmpeg_args(stream_index)} -c:v copy"
+        if self.stream_fps is None:
+            # Settings can be queried before any stream source was resolved,
+            # the frame rate is only needed once a stream is spawned
+            return args
         if stream_index == "video1":
             fps = self.stream_fps[0]
         else:
             fps = self.stream_fps[1]
 
-        return (
-            "-ar 32000 -ac 1 -codec:a aac -b:a 32k -c:v copy -vbsf"
-            f' "h264_metadata=tick_rate={fps*2}"'
-        )
+        return f'{args} -vbsf "h264_metadata=tick_rate={fps*2}"'
 
     async def get_stream_source(self, stream_index: str) -> str:
+        # The frame rates are needed to build the ffmpeg arguments next
+        await self.connect()
         if stream_index == "video1":
             stream = self.args.stream
         else:
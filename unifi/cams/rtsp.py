@@ -1,12 +1,15 @@
 import argparse
+import asyncio
 import logging
-import subprocess
 import tempfile
+import time
 from pathlib import Path
 
-from aiohttp import web
-
-from unifi.cams.base import UnifiCamBase
+from unifi.cams.base import UnifiCamBase, parse_size
+from unifi.motion import MotionDetector, ZoneScorer, np
+from unifi.restream import STREAMS
+from unifi.snapshot import decode_snapshot
+from unifi.stream import StreamSubscriber
 
 
 class RTSPCam(UnifiCamBase):
@@ -15,15 +18,14 @@ class RTSPCam(UnifiCamBase):
         self.args = args
         self.event_id = 0
         self.snapshot_dir = tempfile.mkdtemp()
-        self.snapshot_stream = None
-        self.runner = None
+        self._snapshot_lock = asyncio.Lock()
+        self._snapshot_time: float = float("-inf")
+        self._last_motion: float = float("-inf")
         self.stream_source = dict()
         for i, stream_index in enumerate(["video1", "video2", "video3"]):
             if not i < len(self.args.source):
                 i = -1
             self.stream_source[stream_index] = self.args.source[i]
-        if not self.args.snapshot_url:
-            self.start_snapshot_stream()
 
     @classmethod
     def add_parser(cls, parser: argparse.ArgumentParser) -> None:
@@ -35,12 +37,6 @@ class RTSPCam(UnifiCamBase):
             required=True,
             help="Source(s) for up to three streams in order of descending quality",
         )
-        parser.add_argument(
-            "--http-api",
-            default=0,
-            type=int,
-            help="Specify a port number to enable the HTTP API (default: disabled)",
-        )
         parser.add_argument(
             "--snapshot-url",
             "-i",
@@ -49,59 +45,178 @@ class RTSPCam(UnifiCamBase):
             required=False,
             help="HTTP endpoint to fetch snapshot image from",
         )
+        parser.add_argument(
+            "--snapshot-max-age",
+            default=10,
+            type=float,
+            help="Seconds a snapshot decoded from the stream is reused for",
+        )
+        parser.add_argument(
+            "--motion-detection",
+            action="store_true",
+            help="Detect motion in the stream itself (requires numpy)",
+        )
+        parser.add_argument(
+            "--motion-stream",
+            default="video3",
+            choices=STREAMS,
+            help="Stream decoded for motion detection",
+        )
+        parser.add_argument(
+            "--motion-size",
+            default=(160, 90),
+            type=parse_size,
+            help="Resolution frames are scaled down to for motion detection",
+        )
+        parser.add_argument(
+            "--motion-fps",
+            default=5,
+            type=float,
+            help="Frames per second analysed for motion detection",
+        )
+        parser.add_argument(
+            "--motion-threshold",
+            default=10,
+            type=int,
+            help="Motion level (0-100) at which a motion event starts,"
+            " when no motion zones are set in Protect",
+        )
+        parser.add_argument(
+            "--motion-timeout",
+            default=5,
+            type=float,
+            help="Seconds without motion after which a motion event stops",
+        )
 
-    def start_snapshot_stream(self) -> None:
-        if not self.snapshot_stream or self.snapshot_stream.poll() is not None:
-            cmd = (
-                f"ffmpeg -nostdin -y -re -rtsp_transport {self.args.rtsp_transport} "
-                f'-i "{self.args.source[-1]}" '
-                "-r 1 "
-                f"-update 1 {self.snapshot_dir}/screen.jpg"
+    async def run(self) -> None:
+        if not self.args.motion_detection:
+            return
+        if np is None:
+            self.motion_logger.error("Motion detection requires numpy, disabling it")
+            return
+        while True:
+            try:
+                await self.detect_motion()
+            except (OSError, asyncio.IncompleteReadError) as e:
+                self.motion_logger.warning(f"Motion detection stopped: {e}")
+            await asyncio.sleep(5)
+
+    async def detect_motion(self) -> None:
+        """
+        Decode the relayed stream into small gray frames at a low frame rate
+        and turn the motion levels of their zones into motion events.
+        """
+        width, height = self.args.motion_size
+        detector = MotionDetector(width, height)
+        scorer = None
+        analytics_version = -1
+        pipeline = await self.acquire_local_stream(self.args.motion_stream)
+        subscriber = pipeline.subscribe(self.args.restream_queue)
+        proc = None
+        feeder = None
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg",
+                "-loglevel",
+                "error",
+                "-f",
+                "flv",
+                "-i",
+                "pipe:0",
+                "-an",
+                "-vf",
+                f"fps={self.args.motion_fps},scale={width}:{height}",
+                "-pix_fmt",
+                "gray",
+                "-f",
+                "rawvideo",
+                "pipe:1",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
             )
-            self.logger.info(f"Spawning stream for snapshots: {cmd}")
-            self.snapshot_stream = subprocess.Popen(
-                cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=True
+            assert proc.stdin and proc.stdout
+            feeder = asyncio.create_task(self._feed_decoder(subscriber, proc.stdin))
+            self.motion_logger.info(
+                f"Detecting motion in {self.args.motion_stream} at {width}x{height}"
             )
+            while True:
+                data = await proc.stdout.readexactly(detector.frame_size)
+                if analytics_version != self.analytics_version:
+                    analytics_version = self.analytics_version
+                    scorer = ZoneScorer(
+                        self.motion_zones,
+                        self.privacy_masks,
+                        width,
+                        height,
+                        self.args.motion_threshold,
+                    )
+                assert scorer
+                await self.update_motion(*scorer.score(detector.process(data)))
+        finally:
+            if feeder:
+                feeder.cancel()
+            pipeline.unsubscribe(subscriber)
+            if proc and proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+    async def _feed_decoder(
+        self, subscriber: StreamSubscriber, stdin: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                chunk = await subscriber.get()
+                if chunk is None:
+                    break
+                stdin.write(chunk)
+                await stdin.drain()
+        except ConnectionError:
+            pass
+        finally:
+            stdin.close()
+
+    async def update_motion(
+        self, levels: dict[str, int], zones_status: dict[str, int]
+    ) -> None:
+        now = time.monotonic()
+        if zones_status:
+            self._last_motion = now
+            if not self._motion_event_ts:
+                self.motion_logger.debug(f"Motion in zones {zones_status}")
+                await self.trigger_motion_start(
+                    levels=levels, zones_status=zones_status
+                )
+        elif (
+            self._motion_event_ts
+            and now - self._last_motion >= self.args.motion_timeout
+        ):
+            await self.trigger_motion_stop(levels=levels, zones_status=zones_status)
 
     async def get_snapshot(self) -> Path:
         img_file = Path(self.snapshot_dir, "screen.jpg")
         if self.args.snapshot_url:
             await self.fetch_to_file(self.args.snapshot_url, img_file)
-        else:
-            self.start_snapshot_stream()
+            return img_file
+
+        # Concurrent requests share one decode
+        async with self._snapshot_lock:
+            if time.monotonic() - self._snapshot_time < self.args.snapshot_max_age:
+                return img_file
+            updated = await self.update_snapshot_from_stream(img_file)
+            if not updated:
+                updated = await self.decode_snapshot_from_source(img_file)
+            if updated:
+                self._snapshot_time = time.monotonic()
         return img_file
 
-    async def run(self) -> None:
-        if self.args.http_api:
-            self.logger.info(f"Enabling HTTP API on port {self.args.http_api}")
-
-            app = web.Application()
-
-            async def start_motion(request):
-                self.logger.debug("Starting motion")
-                await self.trigger_motion_start()
-                return web.Response(text="ok")
-
-            async def stop_motion(request):
-                self.logger.debug("Starting motion")
-                await self.trigger_motion_stop()
-                return web.Response(text="ok")
-
-            app.add_routes([web.get("/start_motion", start_motion)])
-            app.add_routes([web.get("/stop_motion", stop_motion)])
-
-            self.runner = web.AppRunner(app)
-            await self.runner.setup()
-            site = web.TCPSite(self.runner, port=self.args.http_api)
-            await site.start()
-
-    async def close(self) -> None:
-        await super().close()
-        if self.runner:
-            await self.runner.cleanup()
-
-        if self.snapshot_stream:
-            self.snapshot_stream.kill()
+    async def decode_snapshot_from_source(self, dst: Path) -> bool:
+        source = self.args.source[-1]
+        input_args = ["-i", source]
+        if source.startswith("rtsp"):
+            input_args = ["-rtsp_transport", self.args.rtsp_transport] + input_args
+        self.logger.debug(f"Decoding snapshot from {source}")
+        return await decode_snapshot(input_args, dst, self.logger)
 
     async def get_stream_source(self, stream_index: str) -> str:
         return self.stream_source[stream_index]
@@ -10,6 +10,8 @@ from flvlib3.astypes import FLVObject
 from flvlib3.primitives import make_ui8, make_ui32
 from flvlib3.tags import create_script_tag
 
+from unifi.meter import StreamMeter
+
 
 def read_bytes(source, num_bytes):
     read_bytes = 0
@@ -43,6 +45,18 @@ def write_timestamp_trailer(is_packet, ts):
     write(make_ui32(int(ts * 1000 * 100)))
 
 
+def make_mpma(meter: StreamMeter) -> FLVObject:
+    data = FLVObject()
+    for key in ("cs", "m", "sp"):
+        data[key] = FLVObject()
+        data[key]["cur"] = int(meter.bitrate)
+        data[key]["max"] = int(meter.max_bitrate)
+        data[key]["min"] = int(meter.min_bitrate)
+    data["r"] = 0
+    data["t"] = float(int(meter.mean_bitrate))
+    return data
+
+
 def main(args):
     source = sys.stdin.buffer
 
@@ -65,6 +79,7 @@ def main(args):
 
     last_ts = time.time()
     start = time.time()
+    meter = StreamMeter()
     i = 0
     while True:
         # Packet structure from Wikipedia:
@@ -96,6 +111,14 @@ def main(args):
         combined = bytes([low_high[3]]) + low_high[:3]
         timestamp = struct.unpack(">i", combined)[0]
 
+        # The header read includes the first byte of the tag data
+        meter.add(
+            packet_type,
+            payload_size,
+            timestamp,
+            packet_type == 9 and header[11] >> 4 == 1,
+        )
+
         now = time.time()
         if not last_ts or now - last_ts >= 5:
             last_ts = now
@@ -110,7 +133,7 @@ def main(args):
             # Write 15 byte trailer
             write_timestamp_trailer(False, now - start)
 
-            # Write mpma tag
+            # Write mpma tag with the bitrate measured over the last windows
             # {'cs': {'cur': 1500000.0,
             #         'max': 1500000.0,
             #         'min': 32000.0},
@@ -122,24 +145,7 @@ def main(args):
             #         'max': 1500000.0,
             #         'min': 150000.0},
             #  't': 750000.0}
-
-            data = FLVObject()
-            data["cs"] = FLVObject()
-            data["cs"]["cur"] = 1500000
-            data["cs"]["max"] = 1500000
-            data["cs"]["min"] = 1500000
-
-            data["m"] = FLVObject()
-            data["m"]["cur"] = 1500000
-            data["m"]["max"] = 1500000
-            data["m"]["min"] = 1500000
-            data["r"] = 0
-
-            data["sp"] = FLVObject()
-            data["sp"]["cur"] = 1500000
-            data["sp"]["max"] = 1500000
-            data["sp"]["min"] = 1500000
-            data["t"] = 75000.0
+            data = make_mpma(meter)
             packet_to_inject = create_script_tag("onMpma", data, 0)
 
             write(packet_to_inject)
@@ -0,0 +1,215 @@
+"""
+Lease based ownership of cameras shared by several supervisors, so each camera
+is adopted by exactly one host at a time.
+"""
+import logging
+import math
+import sqlite3
+import time
+from abc import ABCMeta, abstractmethod
+from typing import Optional
+
+
+class LeaseStoreError(Exception):
+    pass
+
+
+class LeaseStore(metaclass=ABCMeta):
+    """
+    Storage for camera leases and node liveness. Implementations must make
+    `acquire` atomic across every host sharing the store.
+    """
+
+    @abstractmethod
+    def acquire(self, camera_id: str, owner: str, ttl: float) -> bool:
+        """
+        Take or renew the lease on a camera, failing if another owner holds an
+        unexpired lease.
+        """
+        raise NotImplementedError("You need to write this!")
+
+    @abstractmethod
+    def release(self, camera_id: str, owner: str) -> None:
+        raise NotImplementedError("You need to write this!")
+
+    @abstractmethod
+    def owners(self) -> dict[str, str]:
+        """Current owner of every camera with an unexpired lease."""
+        raise NotImplementedError("You need to write this!")
+
+    @abstractmethod
+    def heartbeat(self, node_id: str, load: int, ttl: float) -> None:
+        raise NotImplementedError("You need to write this!")
+
+    @abstractmethod
+    def nodes(self) -> dict[str, int]:
+        """Load of every node that sent a heartbeat within its TTL."""
+        raise NotImplementedError("You need to write this!")
+
+
+class SQLiteLeaseStore(LeaseStore):
+    """
+    Lease store in a SQLite database, relying on SQLite's file locking. The
+    database must be on a filesystem with working POSIX locks and the hosts'
+    clocks must be kept in sync.
+
+    Calls block for up to 10 seconds while another host holds the database
+    lock, so they are made from a worker thread, one at a time.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._db = sqlite3.connect(
+            path, timeout=10, isolation_level=None, check_same_thread=False
+        )
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS leases"
+            " (camera_id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL)"
+        )
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS nodes"
+            " (node_id TEXT PRIMARY KEY, load INTEGER, expires_at REAL)"
+        )
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        try:
+            return self._db.execute(sql, params)
+        except sqlite3.Error as e:
+            raise LeaseStoreError(str(e)) from e
+
+    def acquire(self, camera_id: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        cursor = self._execute(
+            "INSERT INTO leases (camera_id, owner, expires_at) VALUES (?, ?, ?)"
+            " ON CONFLICT (camera_id) DO UPDATE"
+            " SET owner = excluded.owner, expires_at = excluded.expires_at"
+            " WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+            (camera_id, owner, now + ttl, now),
+        )
+        return cursor.rowcount == 1
+
+    def release(self, camera_id: str, owner: str) -> None:
+        self._execute(
+            "DELETE FROM leases WHERE camera_id = ? AND owner = ?",
+            (camera_id, owner),
+        )
+
+    def owners(self) -> dict[str, str]:
+        rows = self._execute(
+            "SELECT camera_id, owner FROM leases WHERE expires_at >= ?",
+            (time.time(),),
+        )
+        return dict(rows.fetchall())
+
+    def heartbeat(self, node_id: str, load: int, ttl: float) -> None:
+        self._execute(
+            "INSERT INTO nodes (node_id, load, expires_at) VALUES (?, ?, ?)"
+            " ON CONFLICT (node_id) DO UPDATE"
+            " SET load = excluded.load, expires_at = excluded.expires_at",
+            (node_id, load, time.time() + ttl),
+        )
+
+    def nodes(self) -> dict[str, int]:
+        rows = self._execute(
+            "SELECT node_id, load FROM nodes WHERE expires_at >= ?",
+            (time.time(),),
+        )
+        return dict(rows.fetchall())
+
+
+class LeaseManager:
+    """
+    Decides which cameras this node should run: it keeps renewing the leases
+    it holds up to its fair share of the cluster, claims free or expired ones
+    and hands off any surplus when other nodes join or this node is overloaded.
+    """
+
+    def __init__(
+        self,
+        store: LeaseStore,
+        node_id: str,
+        ttl: float,
+        logger: logging.Logger,
+        max_cameras: Optional[int] = None,
+    ) -> None:
+        self.store = store
+        self.node_id = node_id
+        self.ttl = ttl
+        self.logger = logger
+        self.max_cameras = max_cameras
+        self._draining: set[str] = set()
+        self._last_sync: float = time.monotonic()
+
+    def update(
+        self,
+        cameras: list[str],
+        owned: set[str],
+        overloaded: bool = False,
+        stopping: Optional[set[str]] = None,
+    ) -> set[str]:
+        """
+        Return the cameras this node should be running. Cameras dropped from
+        the result are released by a later call once they are not `stopping`
+        anymore, their leases are renewed until then.
+
+        This blocks on the store, call it from a worker thread.
+        """
+        now = time.monotonic()
+        stopping = stopping or set()
+        try:
+            for camera_id in sorted(self._draining):
+                if camera_id in stopping:
+                    self.store.acquire(camera_id, self.node_id, self.ttl)
+                else:
+                    self.store.release(camera_id, self.node_id)
+                    self._draining.discard(camera_id)
+
+            self.store.heartbeat(self.node_id, len(owned), self.ttl)
+            nodes = self.store.nodes()
+            share = math.ceil(len(cameras) / max(len(nodes), 1))
+            if self.max_cameras is not None:
+                share = min(share, self.max_cameras)
+            # Shed one camera at a time while another node has room for it
+            if overloaded and any(
+                load < share for node, load in nodes.items() if node != self.node_id
+            ):
+                share = min(share, len(owned) - 1)
+
+            wanted: set[str] = set()
+            for camera_id in sorted(owned):
+                if len(wanted) < share and self.store.acquire(
+                    camera_id, self.node_id, self.ttl
+                ):
+                    wanted.add(camera_id)
+
+            owners = self.store.owners()
+            for camera_id in cameras:
+                if len(wanted) >= share:
+                    break
+                if owners.get(camera_id, self.node_id) != self.node_id:
+                    continue
+                if camera_id in wanted or camera_id in self._draining:
+                    continue
+                if self.store.acquire(camera_id, self.node_id, self.ttl):
+                    self.logger.info(f"Claimed camera {camera_id}")
+                    wanted.add(camera_id)
+        except LeaseStoreError as e:
+            self.logger.error(f"Could not update camera leases: {e}")
+            # Stop everything before our leases can expire and be claimed
+            if now - self._last_sync > 0.8 * self.ttl:
+                self.logger.error("Lost contact with lease store, stopping cameras")
+                return set()
+            return owned
+
+        self._last_sync = now
+        for camera_id in owned - wanted:
+            self.logger.info(f"Handing off camera {camera_id}")
+            self._draining.add(camera_id)
+        return wanted
+
+    def release(self, cameras: set[str]) -> None:
+        try:
+            for camera_id in cameras | self._draining:
+                self.store.release(camera_id, self.node_id)
+        except LeaseStoreError as e:
+            self.logger.error(f"Could not release camera leases: {e}")
+        self._draining = set()
@@ -78,4 +78,11 @@ class Core(object):
             finally:
                 await self.cam.close()
 
-        await connect()
+        await self.cam.start_http_api()
+        # Streams start warming up while the connection is set up
+        prewarm = asyncio.create_task(self.cam.prewarm_streams())
+        try:
+            await connect()
+        finally:
+            prewarm.cancel()
+            await self.cam.stop_http_api()
@@ -0,0 +1,42 @@
+"""
+Bounded thread pool for blocking calls (file I/O, synchronous camera SDKs)
+that would otherwise stall the event loop shared by every camera.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Optional, TypeVar, Union
+
+T = TypeVar("T")
+
+# Blocking calls beyond this many wait for a free thread instead of piling up
+MAX_BLOCKING_THREADS = 8
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=MAX_BLOCKING_THREADS, thread_name_prefix="blocking-io"
+        )
+    return _executor
+
+
+async def run_blocking(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run a blocking function in the shared thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(func, *args, **kwargs)
+    )
+
+
+def _write_file(path: Path, data: bytes) -> None:
+    with path.open("wb") as f:
+        f.write(data)
+
+
+async def write_file(path: Union[str, Path], data: bytes) -> None:
+    await run_blocking(_write_file, Path(path), data)
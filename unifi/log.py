@@ -0,0 +1,71 @@
+"""
+Logging helpers: per-subsystem log levels and sampling of messages that would
+otherwise be logged many times a second across a large number of cameras.
+"""
+import argparse
+import logging
+import time
+from typing import Any, Hashable
+
+# Child loggers of each camera's logger that can be given their own level
+SUBSYSTEMS = ("protocol", "stream", "motion")
+
+# Messages logged through a sampler are repeated at most this often
+DEFAULT_SAMPLE_INTERVAL = 60
+
+
+def parse_log_level(value: str) -> tuple[str, int]:
+    try:
+        subsystem, level = value.split("=")
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Invalid log level '{value}', expected SUBSYSTEM=LEVEL"
+        )
+    if subsystem not in SUBSYSTEMS:
+        raise argparse.ArgumentTypeError(
+            f"Unknown subsystem '{subsystem}', expected one of {', '.join(SUBSYSTEMS)}"
+        )
+    number = logging.getLevelName(level.upper())
+    if not isinstance(number, int):
+        raise argparse.ArgumentTypeError(f"Unknown log level '{level}'")
+    return subsystem, number
+
+
+def set_subsystem_levels(logger: logging.Logger, levels: list[tuple[str, int]]) -> None:
+    for subsystem, level in levels:
+        logger.getChild(subsystem).setLevel(level)
+
+
+class LogSampler:
+    """
+    Logs the first occurrence of a message and then at most one per interval
+    for the same key, reporting how many were suppressed in between. Nothing
+    is formatted unless the message is actually emitted.
+    """
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL) -> None:
+        self.interval = interval
+        self._last: dict[Hashable, tuple[float, int]] = {}
+
+    def log(
+        self,
+        logger: logging.Logger,
+        level: int,
+        key: Hashable,
+        msg: str,
+        *args: Any,
+    ) -> None:
+        if not logger.isEnabledFor(level):
+            return
+
+        now = time.monotonic()
+        last = self._last.get(key)
+        if last and now - last[0] < self.interval:
+            self._last[key] = (last[0], last[1] + 1)
+            return
+
+        self._last[key] = (now, 0)
+        if last and last[1]:
+            msg += " (%d similar messages suppressed)"
+            args += (last[1],)
+        logger.log(level, msg, *args)
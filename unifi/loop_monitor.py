@@ -0,0 +1,139 @@
+"""
+Measures how late the event loop runs scheduled callbacks, which is how long
+something blocked it, and optionally captures the stack of whatever is
+blocking it from a watchdog thread.
+"""
+import asyncio
+import bisect
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Optional
+from weakref import WeakKeyDictionary
+
+# Upper bounds in milliseconds of the scheduling delay histogram buckets
+LAG_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+_monitors: "WeakKeyDictionary[asyncio.AbstractEventLoop, LoopMonitor]" = (
+    WeakKeyDictionary()
+)
+
+
+def get_loop_monitor(
+    loop: Optional[asyncio.AbstractEventLoop] = None,
+) -> Optional["LoopMonitor"]:
+    """Return the monitor running on a loop (the current one by default)."""
+    if loop is None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+    return _monitors.get(loop)
+
+
+class LoopMonitor:
+    """
+    Wakes up every `interval` seconds and records how late it woke up in a
+    histogram. Any delay longer than `threshold` seconds is logged.
+
+    With `capture_stacks`, a watchdog thread checks that the loop keeps
+    waking up and logs the loop thread's stack while it is blocked, pointing
+    at the offending call.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        interval: float = 0.1,
+        threshold: float = 0.1,
+        capture_stacks: bool = False,
+    ) -> None:
+        self.logger = logger
+        self.interval = interval
+        self.threshold = threshold
+        self.capture_stacks = capture_stacks
+        self._counts = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self._max_lag: float = 0
+        self._total_lag: float = 0
+        self._samples = 0
+        self._stalls = 0
+        self._beat: float = 0
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        if loop in _monitors:
+            return
+        _monitors[loop] = self
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._measure())
+        if self.capture_stacks:
+            self._watchdog = threading.Thread(
+                target=self._watch,
+                args=(threading.get_ident(),),
+                name="loop-watchdog",
+                daemon=True,
+            )
+            self._watchdog.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for loop, monitor in list(_monitors.items()):
+            if monitor is self:
+                del _monitors[loop]
+
+    async def _measure(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+            self.record(max(now - expected, 0))
+
+    def record(self, lag: float) -> None:
+        lag_ms = lag * 1000
+        self._counts[bisect.bisect_left(LAG_BUCKETS_MS, lag_ms)] += 1
+        self._samples += 1
+        self._total_lag += lag
+        self._max_lag = max(self._max_lag, lag)
+        if lag > self.threshold:
+            self._stalls += 1
+            self.logger.warning(f"Event loop was blocked for {lag_ms:.0f}ms")
+
+    def _watch(self, thread_id: int) -> None:
+        reported: float = 0
+        while not self._stopped.wait(self.threshold / 2):
+            beat = self._beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked <= self.threshold or beat == reported:
+                continue
+            # Only report each stall once, while it is still ongoing
+            reported = beat
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                return
+            stack = "".join(traceback.format_stack(frame))
+            self.logger.warning(
+                f"Event loop blocked for over {blocked * 1000:.0f}ms in:\n{stack}"
+            )
+
+    def stats(self) -> dict[str, Any]:
+        histogram = {
+            f"<={bound}ms": count for bound, count in zip(LAG_BUCKETS_MS, self._counts)
+        }
+        histogram[f">{LAG_BUCKETS_MS[-1]}ms"] = self._counts[-1]
+        return {
+            "samples": self._samples,
+            "stalls": self._stalls,
+            "mean_lag_ms": round(1000 * self._total_lag / max(self._samples, 1), 2),
+            "max_lag_ms": round(1000 * self._max_lag, 2),
+            "histogram": histogram,
+        }
@@ -3,6 +3,7 @@ import asyncio
 import logging
 import sys
 from shutil import which
+from typing import Optional
 
 import coloredlogs
 from pyunifiprotect import ProtectApiClient
@@ -11,11 +12,14 @@ from unifi.cams import (
     DahuaCam,
     FrigateCam,
     HikvisionCam,
+    OnvifCam,
     Reolink,
     ReolinkNVRCam,
     RTSPCam,
 )
 from unifi.core import Core
+from unifi.log import SUBSYSTEMS, parse_log_level, set_subsystem_levels
+from unifi.loop_monitor import LoopMonitor
 from unifi.version import __version__
 
 CAMS = {
@@ -24,13 +28,14 @@ CAMS = {
     "frigate": FrigateCam,
     "hikvision": HikvisionCam,
     "lorex": DahuaCam,
+    "onvif": OnvifCam,
     "reolink": Reolink,
     "reolink_nvr": ReolinkNVRCam,
     "rtsp": RTSPCam,
 }
 
 
-def parse_args():
+def parse_args(argv: Optional[list[str]] = None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--version", action="version", version=__version__)
     parser.add_argument("--host", "-H", required=True, help="NVR ip address and port")
@@ -105,6 +110,16 @@ def parse_args():
     parser.add_argument(
         "--verbose", "-v", action="store_true", help="increase output verbosity"
     )
+    parser.add_argument(
+        "--log-level",
+        action="append",
+        default=[],
+        type=parse_log_level,
+        metavar="SUBSYSTEM=LEVEL",
+        help="Log level of a camera subsystem, overriding --verbose (subsystems:"
+        f" {', '.join(SUBSYSTEMS)})",
+    )
+    add_loop_monitor_args(parser)
 
     sp = parser.add_subparsers(
         help="Camera implementations",
@@ -114,7 +129,34 @@ def parse_args():
     for name, impl in CAMS.items():
         subparser = sp.add_parser(name)
         impl.add_parser(subparser)
-    return parser.parse_args()
+    return parser.parse_args(argv)
+
+
+def add_loop_monitor_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--loop-lag-threshold",
+        default=250,
+        type=float,
+        help="Warn when the event loop is blocked for longer than this many ms",
+    )
+    parser.add_argument(
+        "--debug-blocking",
+        action="store_true",
+        help="Log the stack of any call blocking the event loop for longer than"
+        " --loop-lag-threshold",
+    )
+
+
+def start_loop_monitor(args, level: int) -> LoopMonitor:
+    logger = logging.getLogger("LoopMonitor")
+    coloredlogs.install(level=level, logger=logger)
+    monitor = LoopMonitor(
+        logger,
+        threshold=args.loop_lag_threshold / 1000,
+        capture_stacks=args.debug_blocking,
+    )
+    monitor.start()
+    return monitor
 
 
 async def generate_token(args, logger):
@@ -135,35 +177,54 @@ async def generate_token(args, logger):
         await protect.close_session()
 
 
-async def run():
-    args = parse_args()
+def check_dependencies(logger: logging.Logger) -> bool:
+    for binary in ["ffmpeg"]:
+        if which(binary) is None:
+            logger.error(f"{binary} is not installed")
+            return False
+    return True
+
+
+async def create_core(args, logger_suffix: str = "") -> Optional[Core]:
     klass = CAMS[args.impl]
 
-    core_logger = logging.getLogger("Core")
-    class_logger = logging.getLogger(klass.__name__)
+    core_logger = logging.getLogger(f"Core{logger_suffix}")
+    class_logger = logging.getLogger(f"{klass.__name__}{logger_suffix}")
 
     level = logging.INFO
     if args.verbose:
         level = logging.DEBUG
 
+    # The handler lets through the most verbose subsystem level, the loggers
+    # themselves filter everything else
+    handler_level = min([level] + [lvl for _, lvl in args.log_level])
     for logger in [core_logger, class_logger]:
-        coloredlogs.install(level=level, logger=logger)
-
-    # Preflight checks
-    for binary in ["ffmpeg", "nc"]:
-        if which(binary) is None:
-            logger.error(f"{binary} is not installed")
-            sys.exit(1)
+        coloredlogs.install(level=handler_level, logger=logger)
+        logger.setLevel(level)
+    set_subsystem_levels(class_logger, args.log_level)
 
     if not args.token:
-        args.token = await generate_token(args, logger)
+        args.token = await generate_token(args, class_logger)
 
     if not args.token:
-        logger.error("A valid token is required")
+        class_logger.error("A valid token is required")
+        return None
+
+    cam = klass(args, class_logger)
+    return Core(args, cam, core_logger)
+
+
+async def run():
+    args = parse_args()
+
+    # Preflight checks
+    if not check_dependencies(logging.getLogger(CAMS[args.impl].__name__)):
         sys.exit(1)
 
-    cam = klass(args, logger)
-    c = Core(args, cam, core_logger)
+    start_loop_monitor(args, logging.DEBUG if args.verbose else logging.INFO)
+    c = await create_core(args)
+    if not c:
+        sys.exit(1)
     await c.run()
 
 
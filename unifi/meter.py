@@ -0,0 +1,102 @@
+"""
+Rolling bitrate, frame rate and keyframe interval of an FLV stream, measured
+from the tags as they are relayed.
+"""
+import time
+from collections import deque
+from typing import Any, Optional
+
+TAG_TYPE_VIDEO = 9
+
+# Length of one measurement window in seconds
+WINDOW = 5.0
+# Completed windows kept for the minimum and maximum bitrate
+HISTORY = 12
+
+
+class StreamMeter:
+    """
+    Accumulates tag sizes over fixed windows of wall clock time. The current
+    values are those of the last completed window, the minimum and maximum
+    cover the last `history` windows.
+    """
+
+    def __init__(self, window: float = WINDOW, history: int = HISTORY) -> None:
+        self.window = window
+        self._window_start: float = time.monotonic()
+        self._bytes = 0
+        self._frames = 0
+        self._bitrates: deque[float] = deque(maxlen=history)
+        self.bitrate: float = 0
+        self.fps: float = 0
+        self.keyframe_interval: Optional[float] = None
+        self._last_keyframe_ts: Optional[int] = None
+
+    def add(
+        self,
+        tag_type: int,
+        size: int,
+        timestamp: int,
+        is_keyframe: bool,
+        now: Optional[float] = None,
+    ) -> None:
+        """
+        Count a tag of `size` data bytes. `timestamp` is the FLV timestamp in
+        milliseconds, used to measure the keyframe interval.
+        """
+        if now is None:
+            now = time.monotonic()
+        if now - self._window_start >= self.window:
+            self.roll(now)
+
+        self._bytes += size
+        if tag_type == TAG_TYPE_VIDEO:
+            self._frames += 1
+            if is_keyframe:
+                if (
+                    self._last_keyframe_ts is not None
+                    and timestamp > self._last_keyframe_ts
+                ):
+                    self.keyframe_interval = (timestamp - self._last_keyframe_ts) / 1000
+                self._last_keyframe_ts = timestamp
+
+    def roll(self, now: Optional[float] = None) -> None:
+        """Close the current window, making its values the current ones."""
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed <= 0:
+            return
+        self.bitrate = 8 * self._bytes / elapsed
+        self.fps = self._frames / elapsed
+        self._bitrates.append(self.bitrate)
+        self._window_start = now
+        self._bytes = 0
+        self._frames = 0
+
+    @property
+    def min_bitrate(self) -> float:
+        return min(self._bitrates, default=0)
+
+    @property
+    def max_bitrate(self) -> float:
+        return max(self._bitrates, default=0)
+
+    @property
+    def mean_bitrate(self) -> float:
+        if not self._bitrates:
+            return 0
+        return sum(self._bitrates) / len(self._bitrates)
+
+    def stats(self) -> dict[str, Any]:
+        # A stalled stream has no tags to close its window
+        now = time.monotonic()
+        if now - self._window_start >= self.window:
+            self.roll(now)
+        return {
+            "bitrate": int(self.bitrate),
+            "min_bitrate": int(self.min_bitrate),
+            "max_bitrate": int(self.max_bitrate),
+            "fps": round(self.fps, 2),
+            "keyframe_interval": self.keyframe_interval,
+        }
@@ -0,0 +1,206 @@
+"""
+Software motion detection on small grayscale frames, using NumPy to compare
+each frame against the previous one and a running background model, and
+scoring of moving pixels against the motion zones and privacy masks set in
+Protect.
+"""
+from typing import Any, Optional
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, only needed for motion detection
+    np = None
+
+# Change in gray level below which a pixel is considered noise
+PIXEL_THRESHOLD = 25
+# Weight of a new frame in the running background average
+BACKGROUND_ALPHA = 0.05
+# Fraction of moving pixels reported as the maximum motion level (100)
+FULL_SCALE = 0.1
+# Sensitivity of zones that do not set one
+DEFAULT_SENSITIVITY = 50
+
+Polygon = list[tuple[float, float]]
+
+
+class MotionZone:
+    """
+    A motion zone from ChangeAnalyticsSettings, a polygon in coordinates
+    relative to the frame (0 to 1). A zone reports motion once its level
+    reaches 100 minus its sensitivity.
+    """
+
+    def __init__(self, zone_id: str, points: Polygon, sensitivity: int) -> None:
+        self.zone_id = zone_id
+        self.points = points
+        self.sensitivity = sensitivity
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, MotionZone) and (
+            self.zone_id,
+            self.points,
+            self.sensitivity,
+        ) == (other.zone_id, other.points, other.sensitivity)
+
+    def __repr__(self) -> str:
+        return f"MotionZone({self.zone_id}, sensitivity={self.sensitivity})"
+
+
+def _parse_points(zone: dict[str, Any]) -> Optional[Polygon]:
+    points = zone.get("points", zone.get("coord"))
+    if not points:
+        return None
+    try:
+        polygon = [(float(x), float(y)) for x, y in points]
+    except (TypeError, ValueError):
+        return None
+    return polygon if len(polygon) >= 3 else None
+
+
+def parse_analytics_settings(
+    payload: dict[str, Any]
+) -> tuple[list[MotionZone], list[Polygon]]:
+    """
+    Motion zones and privacy mask polygons of a ChangeAnalyticsSettings
+    payload. Zones without a usable polygon are skipped.
+    """
+    zones = []
+    for i, zone in enumerate(payload.get("motionZones") or []):
+        points = _parse_points(zone)
+        if points is None:
+            continue
+        try:
+            sensitivity = int(zone.get("sensitivity", DEFAULT_SENSITIVITY))
+        except (TypeError, ValueError):
+            sensitivity = DEFAULT_SENSITIVITY
+        zones.append(
+            MotionZone(str(zone.get("id", i)), points, max(0, min(100, sensitivity)))
+        )
+
+    masks = []
+    for mask in payload.get("privacyZones") or payload.get("privacyMasks") or []:
+        points = _parse_points(mask)
+        if points is not None:
+            masks.append(points)
+    return zones, masks
+
+
+def polygon_mask(points: Polygon, width: int, height: int) -> "np.ndarray":
+    """Pixels of a `width`x`height` frame whose centre is inside a polygon."""
+    ys, xs = np.mgrid[0:height, 0:width]
+    xs = (xs + 0.5) / width
+    ys = (ys + 0.5) / height
+    inside = np.zeros((height, width), bool)
+    # Even-odd rule, one edge at a time over all pixels
+    for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1]):
+        if y1 == y2:
+            continue
+        crosses = (y1 > ys) != (y2 > ys)
+        crosses &= xs < x1 + (ys - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses
+    return inside
+
+
+class MotionDetector:
+    """
+    Scores frames of `width`x`height` 8-bit gray pixels. A pixel is moving
+    when it differs both from the previous frame and from the background,
+    which filters out slow lighting changes and single-frame noise.
+    """
+
+    def __init__(self, width: int, height: int) -> None:
+        if np is None:
+            raise RuntimeError("Motion detection requires numpy")
+        self.width = width
+        self.height = height
+        self.frame_size = width * height
+        shape = (height, width)
+        self._frame = np.zeros(shape, np.float32)
+        self._background: Optional["np.ndarray"] = None
+        self._previous = np.zeros(shape, np.float32)
+        self._diff = np.zeros(shape, np.float32)
+        self._moving = np.zeros(shape, bool)
+
+    def process(self, data: bytes) -> "np.ndarray":
+        """Return the boolean mask of moving pixels of a raw gray frame."""
+        frame = np.frombuffer(data, np.uint8).reshape(self.height, self.width)
+        np.copyto(self._frame, frame)
+        if self._background is None:
+            self._background = self._frame.copy()
+            self._previous[:] = self._frame
+            self._moving[:] = False
+            return self._moving
+
+        np.subtract(self._frame, self._background, out=self._diff)
+        np.abs(self._diff, out=self._diff)
+        np.greater(self._diff, PIXEL_THRESHOLD, out=self._moving)
+
+        np.subtract(self._frame, self._previous, out=self._diff)
+        np.abs(self._diff, out=self._diff)
+        self._moving &= self._diff > PIXEL_THRESHOLD
+
+        self._background *= 1 - BACKGROUND_ALPHA
+        self._background += BACKGROUND_ALPHA * self._frame
+        self._previous[:] = self._frame
+        return self._moving
+
+
+class ZoneScorer:
+    """
+    Per-zone motion levels of masks of moving pixels. The zone masks are
+    rasterized once at the analysis resolution, with privacy masks cut out,
+    so scoring a frame is a single masked sum over all zones. Without zones,
+    the whole frame is one zone "0" reporting motion from `threshold`.
+    """
+
+    def __init__(
+        self,
+        zones: list[MotionZone],
+        privacy_masks: list[Polygon],
+        width: int,
+        height: int,
+        threshold: int,
+    ) -> None:
+        if np is None:
+            raise RuntimeError("Motion detection requires numpy")
+        self.width = width
+        self.height = height
+        if not zones:
+            frame = [(0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0)]
+            zones = [MotionZone("0", frame, 100 - threshold)]
+        visible = np.ones((height, width), bool)
+        for points in privacy_masks:
+            visible &= ~polygon_mask(points, width, height)
+
+        self.zone_ids = [zone.zone_id for zone in zones]
+        self._masks = np.stack(
+            [polygon_mask(zone.points, width, height) & visible for zone in zones]
+        )
+        self._areas = np.maximum(self._masks.sum(axis=(1, 2)), 1)
+        self._thresholds = np.array([100 - zone.sensitivity for zone in zones])
+
+    def _resample(self, moving: "np.ndarray") -> "np.ndarray":
+        # Coarse motion grids reported by cameras, nearest neighbour
+        rows = np.arange(self.height) * moving.shape[0] // self.height
+        cols = np.arange(self.width) * moving.shape[1] // self.width
+        return moving[np.ix_(rows, cols)]
+
+    def score(self, moving: "np.ndarray") -> tuple[dict[str, int], dict[str, int]]:
+        """
+        Return the level of every zone and the levels of the zones reporting
+        motion, for a mask of moving pixels of any resolution.
+        """
+        if moving.shape != (self.height, self.width):
+            moving = self._resample(moving)
+        counts = np.count_nonzero(self._masks & moving, axis=(1, 2))
+        levels = np.minimum(100, np.rint(100 * counts / self._areas / FULL_SCALE))
+        active = levels >= self._thresholds
+        all_levels = {
+            zone_id: int(level) for zone_id, level in zip(self.zone_ids, levels)
+        }
+        active_levels = {
+            zone_id: int(level)
+            for zone_id, level, hit in zip(self.zone_ids, levels, active)
+            if hit
+        }
+        return all_levels, active_levels
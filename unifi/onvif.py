@@ -0,0 +1,356 @@
+"""
+Minimal ONVIF events client. Events are received through a PullPoint
+subscription that is long-polled with PullMessages over one persistent HTTP
+connection, and notifications are parsed as the response streams in.
+"""
+import asyncio
+import base64
+import datetime
+import hashlib
+import logging
+import os
+import time
+import xml.etree.ElementTree as ET
+from typing import AsyncIterator, Optional
+from xml.sax.saxutils import escape
+
+import httpx
+
+NS = {
+    "s": "http://www.w3.org/2003/05/soap-envelope",
+    "wsnt": "http://docs.oasis-open.org/wsn/b-2",
+    "tev": "http://www.onvif.org/ver10/events/wsdl",
+    "tds": "http://www.onvif.org/ver10/device/wsdl",
+    "trt": "http://www.onvif.org/ver10/media/wsdl",
+    "tt": "http://www.onvif.org/ver10/schema",
+    "wsa": "http://www.w3.org/2005/08/addressing",
+}
+WSSE_NS = (
+    "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd"
+)
+WSU_NS = (
+    "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd"
+)
+PASSWORD_DIGEST = (
+    "http://docs.oasis-open.org/wss/2004/01/"
+    "oasis-200401-wss-username-token-profile-1.0#PasswordDigest"
+)
+EVENTS_WSDL = "http://www.onvif.org/ver10/events/wsdl"
+
+# Seconds a PullMessages request waits for events before returning empty
+PULL_TIMEOUT = 30
+MESSAGE_LIMIT = 32
+# Lifetime of the subscription, renewed halfway through
+TERMINATION_TIME = 300
+
+
+class OnvifError(Exception):
+    pass
+
+
+class Notification:
+    """One NotificationMessage: its topic and the Source and Data items."""
+
+    __slots__ = ("topic", "operation", "source", "data")
+
+    def __init__(
+        self,
+        topic: str,
+        operation: Optional[str],
+        source: dict[str, str],
+        data: dict[str, str],
+    ) -> None:
+        self.topic = topic
+        # "Initialized" for the state sent on subscribing, then "Changed"
+        self.operation = operation
+        self.source = source
+        self.data = data
+
+    @property
+    def state(self) -> Optional[bool]:
+        """The first boolean Data item, None for events without a state."""
+        for value in self.data.values():
+            if value.lower() in ("true", "false"):
+                return value.lower() == "true"
+        return None
+
+    def __repr__(self) -> str:
+        return f"Notification({self.topic}, {self.operation}, {self.data})"
+
+
+def _simple_items(message: Optional[ET.Element], path: str) -> dict[str, str]:
+    if message is None:
+        return {}
+    return {
+        item.get("Name", ""): item.get("Value", "")
+        for item in message.iterfind(f"{path}/tt:SimpleItem", NS)
+    }
+
+
+def _notification(element: ET.Element) -> Notification:
+    topic = (element.findtext("wsnt:Topic", "", NS) or "").strip()
+    prefix, _, rest = topic.partition(":")
+    if rest and "/" not in prefix:
+        topic = rest
+    message = element.find("wsnt:Message/tt:Message", NS)
+    return Notification(
+        topic,
+        message.get("PropertyOperation") if message is not None else None,
+        _simple_items(message, "tt:Source"),
+        _simple_items(message, "tt:Data"),
+    )
+
+
+class NotificationParser:
+    """
+    Incremental parser of a PullMessages response, returning notifications
+    as soon as their element is complete and discarding them afterwards.
+    """
+
+    def __init__(self) -> None:
+        self._parser = ET.XMLPullParser(events=("end",))
+        self._tag = f"{{{NS['wsnt']}}}NotificationMessage"
+        self._fault = f"{{{NS['s']}}}Fault"
+
+    def feed(self, data: bytes) -> list[Notification]:
+        self._parser.feed(data)
+        notifications = []
+        for _, element in self._parser.read_events():
+            if element.tag == self._tag:
+                notifications.append(_notification(element))
+                element.clear()
+            elif element.tag == self._fault:
+                reason = " ".join(element.itertext()).strip()
+                raise OnvifError(f"SOAP fault: {reason}")
+        return notifications
+
+    def close(self) -> None:
+        self._parser.close()
+
+
+def _duration(seconds: int) -> str:
+    return f"PT{seconds}S"
+
+
+def _headers(action: str) -> dict[str, str]:
+    return {"Content-Type": f'application/soap+xml; charset=utf-8; action="{action}"'}
+
+
+class OnvifEventsClient:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        logger: logging.Logger,
+    ) -> None:
+        self.device_url = f"http://{host}:{port}/onvif/device_service"
+        self.username = username
+        self.password = password
+        self.logger = logger
+        # Camera clock minus ours, the password digest must use camera time
+        self._clock_offset = 0.0
+
+    def _security(self) -> str:
+        if not self.username:
+            return ""
+        nonce = os.urandom(16)
+        created = (
+            datetime.datetime.now(datetime.timezone.utc)
+            + datetime.timedelta(seconds=self._clock_offset)
+        ).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        digest = hashlib.sha1(nonce + created.encode() + self.password.encode())
+        return (
+            f'<wsse:Security s:mustUnderstand="1" xmlns:wsse="{WSSE_NS}"'
+            f' xmlns:wsu="{WSU_NS}"><wsse:UsernameToken>'
+            f"<wsse:Username>{escape(self.username)}</wsse:Username>"
+            f'<wsse:Password Type="{PASSWORD_DIGEST}">'
+            f"{base64.b64encode(digest.digest()).decode()}</wsse:Password>"
+            f"<wsse:Nonce>{base64.b64encode(nonce).decode()}</wsse:Nonce>"
+            f"<wsu:Created>{created}</wsu:Created>"
+            "</wsse:UsernameToken></wsse:Security>"
+        )
+
+    def _envelope(self, action: str, to: str, body: str, auth: bool = True) -> bytes:
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            f'<s:Envelope xmlns:s="{NS["s"]}" xmlns:wsa="{NS["wsa"]}"'
+            f' xmlns:wsnt="{NS["wsnt"]}" xmlns:tev="{NS["tev"]}"'
+            f' xmlns:tds="{NS["tds"]}" xmlns:trt="{NS["trt"]}"><s:Header>'
+            f"{self._security() if auth else ''}"
+            f"<wsa:Action>{action}</wsa:Action><wsa:To>{escape(to)}</wsa:To>"
+            f"</s:Header><s:Body>{body}</s:Body></s:Envelope>"
+        ).encode()
+
+    async def _call(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        action: str,
+        body: str,
+        auth: bool = True,
+    ) -> ET.Element:
+        response = await client.post(
+            url,
+            content=self._envelope(action, url, body, auth),
+            headers=_headers(action),
+        )
+        try:
+            root = ET.fromstring(response.content)
+        except ET.ParseError:
+            response.raise_for_status()
+            raise
+        fault = root.find("s:Body/s:Fault", NS)
+        if fault is not None:
+            raise OnvifError(f"SOAP fault: {' '.join(fault.itertext()).strip()}")
+        response.raise_for_status()
+        return root
+
+    async def _sync_clock(self, client: httpx.AsyncClient) -> None:
+        root = await self._call(
+            client,
+            self.device_url,
+            "http://www.onvif.org/ver10/device/wsdl/GetSystemDateAndTime",
+            "<tds:GetSystemDateAndTime/>",
+            auth=False,
+        )
+        utc = root.find(".//tt:UTCDateTime", NS)
+        if utc is None:
+            return
+        try:
+            camera_time = datetime.datetime(
+                *(
+                    int(utc.findtext(path, "0", NS))
+                    for path in (
+                        "tt:Date/tt:Year",
+                        "tt:Date/tt:Month",
+                        "tt:Date/tt:Day",
+                        "tt:Time/tt:Hour",
+                        "tt:Time/tt:Minute",
+                        "tt:Time/tt:Second",
+                    )
+                ),
+                tzinfo=datetime.timezone.utc,
+            )
+        except ValueError:
+            return
+        self._clock_offset = camera_time.timestamp() - time.time()
+
+    async def _service_url(self, client: httpx.AsyncClient, category: str) -> str:
+        root = await self._call(
+            client,
+            self.device_url,
+            "http://www.onvif.org/ver10/device/wsdl/GetCapabilities",
+            f"<tds:GetCapabilities><tds:Category>{category}</tds:Category>"
+            "</tds:GetCapabilities>",
+        )
+        url = root.findtext(f".//tt:{category}/tt:XAddr", None, NS)
+        if not url:
+            raise OnvifError(f"Camera does not support the ONVIF {category} service")
+        return url.strip()
+
+    async def video_sources(self) -> dict[str, str]:
+        """The video source token of every media profile, by profile token."""
+        async with httpx.AsyncClient(timeout=10) as client:
+            await self._sync_clock(client)
+            media_url = await self._service_url(client, "Media")
+            root = await self._call(
+                client,
+                media_url,
+                "http://www.onvif.org/ver10/media/wsdl/GetProfiles",
+                "<trt:GetProfiles/>",
+            )
+        return {
+            profile.get("token", ""): (
+                profile.findtext("tt:VideoSourceConfiguration/tt:SourceToken", "", NS)
+                or ""
+            ).strip()
+            for profile in root.iterfind(".//trt:Profiles", NS)
+        }
+
+    async def _subscribe(self, client: httpx.AsyncClient, events_url: str) -> str:
+        root = await self._call(
+            client,
+            events_url,
+            f"{EVENTS_WSDL}/EventPortType/CreatePullPointSubscriptionRequest",
+            "<tev:CreatePullPointSubscription><tev:InitialTerminationTime>"
+            f"{_duration(TERMINATION_TIME)}"
+            "</tev:InitialTerminationTime></tev:CreatePullPointSubscription>",
+        )
+        address = root.findtext(".//tev:SubscriptionReference/wsa:Address", None, NS)
+        if not address:
+            raise OnvifError("No subscription address in response")
+        return address.strip()
+
+    async def _renew(self, client: httpx.AsyncClient, address: str) -> None:
+        await self._call(
+            client,
+            address,
+            "http://docs.oasis-open.org/wsn/bw-2/SubscriptionManager/RenewRequest",
+            f"<wsnt:Renew><wsnt:TerminationTime>{_duration(TERMINATION_TIME)}"
+            "</wsnt:TerminationTime></wsnt:Renew>",
+        )
+
+    async def _unsubscribe(self, client: httpx.AsyncClient, address: str) -> None:
+        try:
+            await self._call(
+                client,
+                address,
+                "http://docs.oasis-open.org/wsn/bw-2/SubscriptionManager"
+                "/UnsubscribeRequest",
+                "<wsnt:Unsubscribe/>",
+            )
+        except (httpx.HTTPError, OnvifError, ET.ParseError) as e:
+            self.logger.debug(f"Could not unsubscribe: {e}")
+
+    async def _pull(
+        self, client: httpx.AsyncClient, address: str
+    ) -> AsyncIterator[Notification]:
+        action = f"{EVENTS_WSDL}/PullPointSubscription/PullMessagesRequest"
+        content = self._envelope(
+            action,
+            address,
+            f"<tev:PullMessages><tev:Timeout>{_duration(PULL_TIMEOUT)}</tev:Timeout>"
+            f"<tev:MessageLimit>{MESSAGE_LIMIT}</tev:MessageLimit>"
+            "</tev:PullMessages>",
+        )
+        async with client.stream(
+            "POST",
+            address,
+            content=content,
+            headers=_headers(action),
+        ) as response:
+            parser = NotificationParser()
+            async for chunk in response.aiter_bytes():
+                for notification in parser.feed(chunk):
+                    yield notification
+            response.raise_for_status()
+            parser.close()
+
+    async def events(self) -> AsyncIterator[Notification]:
+        """
+        Subscribe and yield notifications until the connection fails, keeping
+        the subscription renewed.
+        """
+        async with httpx.AsyncClient(
+            timeout=httpx.Timeout(10, read=PULL_TIMEOUT + 10)
+        ) as client:
+            await self._sync_clock(client)
+            events_url = await self._service_url(client, "Events")
+            address = await self._subscribe(client, events_url)
+            self.logger.info(f"Subscribed to ONVIF events at {address}")
+            renewed = time.monotonic()
+            try:
+                while True:
+                    async for notification in self._pull(client, address):
+                        yield notification
+                    if time.monotonic() - renewed > TERMINATION_TIME / 2:
+                        await self._renew(client, address)
+                        renewed = time.monotonic()
+            finally:
+                # Cameras only allow a few subscriptions, do not leave one behind
+                try:
+                    await asyncio.wait_for(self._unsubscribe(client, address), 2)
+                except asyncio.TimeoutError:
+                    pass
@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+from unifi.executor import run_blocking
+
+PROBE_TIMEOUT = 20
+
+VIDEO_KEYS = ("codec_name", "profile", "width", "height", "avg_frame_rate", "pix_fmt")
+AUDIO_KEYS = ("codec_name", "profile", "sample_rate", "channels")
+
+StreamInfo = dict[str, Optional[dict[str, Any]]]
+
+
+async def probe_stream(
+    source: str, rtsp_transport: str, logger: logging.Logger
+) -> Optional[StreamInfo]:
+    """
+    Detect the first video and audio stream of a source with ffprobe.
+    """
+    cmd = ["ffprobe", "-v", "error", "-show_streams", "-of", "json"]
+    if source.startswith("rtsp"):
+        cmd += ["-rtsp_transport", rtsp_transport]
+    cmd += ["-i", source]
+
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except FileNotFoundError:
+        logger.warning("ffprobe is not installed, skipping stream probe")
+        return None
+
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), PROBE_TIMEOUT)
+    except asyncio.TimeoutError:
+        proc.kill()
+        logger.warning("Timed out probing stream")
+        return None
+
+    try:
+        streams = json.loads(stdout).get("streams", [])
+    except json.JSONDecodeError:
+        streams = []
+    if proc.returncode != 0 or not streams:
+        logger.warning("Could not probe stream")
+        return None
+
+    info: StreamInfo = {"video": None, "audio": None}
+    for stream in streams:
+        codec_type = stream.get("codec_type")
+        if codec_type == "video" and not info["video"]:
+            info["video"] = {k: stream[k] for k in VIDEO_KEYS if k in stream}
+        elif codec_type == "audio" and not info["audio"]:
+            info["audio"] = {k: stream[k] for k in AUDIO_KEYS if k in stream}
+
+    logger.debug(f"Probed stream: {info}")
+    return info
+
+
+class StreamInfoCache:
+    """
+    Probed stream parameters keyed by source URL, kept in memory and, when a
+    directory is configured, persisted across restarts as one JSON file per
+    source. Files are read once per source and written back in the shared
+    executor, so lookups from the relay never touch the disk.
+
+    Each entry also records a fingerprint of the codec sequence headers seen
+    by the relay, so the entry is dropped as soon as the camera starts sending
+    a stream with different parameters.
+    """
+
+    def __init__(self, cache_dir: Optional[str], logger: logging.Logger) -> None:
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.logger = logger
+        # None for sources known to have no entry, on disk either
+        self._entries: dict[str, Optional[dict[str, Any]]] = {}
+        self._dirty: set[str] = set()
+        self._writer: Optional[asyncio.Task] = None
+
+    def _path(self, source: str) -> Optional[Path]:
+        if not self.cache_dir:
+            return None
+        key = hashlib.sha256(source.encode()).hexdigest()[:32]
+        return self.cache_dir / f"{key}.json"
+
+    def _read(self, path: Path) -> Optional[dict[str, Any]]:
+        if not path.exists():
+            return None
+        try:
+            return json.loads(path.read_text())
+        except (OSError, json.JSONDecodeError):
+            self.logger.warning(f"Ignoring unreadable stream cache {path}")
+            return None
+
+    def _write(self, path: Path, data: Optional[str]) -> None:
+        try:
+            if data is None:
+                path.unlink(missing_ok=True)
+                return
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.parent)
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            self.logger.warning(f"Could not write stream cache {path}")
+
+    async def _load(self, source: str) -> Optional[dict[str, Any]]:
+        if source not in self._entries:
+            path = self._path(source)
+            entry = await run_blocking(self._read, path) if path else None
+            # Another call may have set the entry meanwhile
+            self._entries.setdefault(source, entry)
+        return self._entries[source]
+
+    def _save(self, source: str, entry: Optional[dict[str, Any]]) -> None:
+        self._entries[source] = entry
+        if not self.cache_dir:
+            return
+        self._dirty.add(source)
+        if not self._writer or self._writer.done():
+            self._writer = asyncio.get_running_loop().create_task(self._flush())
+
+    async def _flush(self) -> None:
+        while self._dirty:
+            source = self._dirty.pop()
+            path = self._path(source)
+            assert path
+            entry = self._entries.get(source)
+            # Serialized here, the entry may change while it is written
+            data = json.dumps(entry) if entry is not None else None
+            await run_blocking(self._write, path, data)
+
+    async def get(self, source: str) -> Optional[StreamInfo]:
+        entry = await self._load(source)
+        return entry.get("info") if entry else None
+
+    def put(self, source: str, info: StreamInfo) -> None:
+        entry = self._entries.get(source) or {}
+        self._save(
+            source,
+            {
+                "info": info,
+                "fingerprints": entry.get("fingerprints", {}),
+                "updated": time.time(),
+            },
+        )
+
+    def invalidate(self, source: str) -> None:
+        self._save(source, None)
+
+    def check_fingerprint(self, source: str, kind: str, data: bytes) -> bool:
+        """
+        Record the fingerprint of a sequence header, returning False and
+        dropping the cached parameters if it differs from the one seen before.
+        Sources never looked up with `get` are not tracked.
+        """
+        if source not in self._entries:
+            return True
+        fingerprint = hashlib.sha1(data).hexdigest()
+        entry = self._entries.get(source) or {"info": None, "fingerprints": {}}
+        previous = entry["fingerprints"].get(kind)
+        if previous == fingerprint:
+            return True
+
+        if previous is not None:
+            entry = {"info": None, "fingerprints": {}}
+        entry["fingerprints"][kind] = fingerprint
+        self._save(source, entry)
+        return previous is None
@@ -0,0 +1,124 @@
+"""
+Lightweight CPU, memory and I/O accounting of child pipelines through /proc.
+
+Every stream pipeline runs in its own session, so the processes belonging to
+it (shell, ffmpeg and clock_sync) are found by their session id.
+"""
+import os
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+PROC = Path("/proc")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+# Processes are rescanned at most this often, shared by every sampler
+SCAN_MAX_AGE = 1.0
+
+_scan: tuple[float, dict[int, list[tuple[int, int]]]] = (0.0, {})
+
+
+def _read_stat(pid: int) -> Optional[tuple[int, int]]:
+    """Return (session id, utime + stime ticks) of a process."""
+    try:
+        stat = (PROC / str(pid) / "stat").read_text()
+    except OSError:
+        return None
+    # Fields after the parenthesized command name, which may contain spaces
+    fields = stat[stat.rfind(")") + 2 :].split()
+    return int(fields[3]), int(fields[11]) + int(fields[12])
+
+
+def scan_sessions() -> dict[int, list[tuple[int, int]]]:
+    """Map of session id to (pid, cpu ticks) of every process in it."""
+    global _scan
+    now = time.monotonic()
+    if now - _scan[0] < SCAN_MAX_AGE:
+        return _scan[1]
+
+    sessions: dict[int, list[tuple[int, int]]] = {}
+    try:
+        entries = os.listdir(PROC)
+    except OSError:
+        entries = []
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        stat = _read_stat(int(entry))
+        if stat:
+            sessions.setdefault(stat[0], []).append((int(entry), stat[1]))
+    _scan = (now, sessions)
+    return sessions
+
+
+def _read_rss(pid: int) -> int:
+    try:
+        with (PROC / str(pid) / "status").open() as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _read_io(pid: int) -> tuple[int, int]:
+    read = write = 0
+    try:
+        with (PROC / str(pid) / "io").open() as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key == "rchar":
+                    read = int(value)
+                elif key == "wchar":
+                    write = int(value)
+    except OSError:
+        pass
+    return read, write
+
+
+class ProcessSampler:
+    """
+    Samples the process groups of named pipelines, computing CPU usage over
+    the time between two samples.
+    """
+
+    def __init__(self) -> None:
+        self._last: dict[str, tuple[float, int]] = {}
+
+    def sample(self, sessions: dict[str, int]) -> dict[str, dict[str, Any]]:
+        """
+        Sample each pipeline, given as a name to the session id (the pid of
+        its session leader) it runs in.
+        """
+        processes = scan_sessions()
+        now = time.monotonic()
+        stats: dict[str, dict[str, Any]] = {}
+        for name, sid in sessions.items():
+            members = processes.get(sid, [])
+            ticks = sum(t for _, t in members)
+            rss = 0
+            read = write = 0
+            for pid, _ in members:
+                rss += _read_rss(pid)
+                r, w = _read_io(pid)
+                read += r
+                write += w
+
+            cpu_percent = 0.0
+            last = self._last.get(name)
+            if last and now > last[0] and ticks >= last[1]:
+                cpu_percent = 100 * (ticks - last[1]) / CLOCK_TICKS / (now - last[0])
+            self._last[name] = (now, ticks)
+
+            stats[name] = {
+                "pids": [pid for pid, _ in members],
+                "cpu_percent": round(cpu_percent, 1),
+                "rss_bytes": rss,
+                "read_bytes": read,
+                "write_bytes": write,
+            }
+
+        for name in set(self._last) - set(sessions):
+            del self._last[name]
+        return stats
@@ -0,0 +1,179 @@
+"""
+Local HTTP API of a camera: manual motion triggers, runtime stats and live
+endpoints (JPEG, MJPEG and FLV) served from the proxy's own ingest, so other
+consumers do not need their own sessions to the camera.
+"""
+import asyncio
+import logging
+from typing import TYPE_CHECKING, AsyncIterator, Optional
+
+from aiohttp import web
+
+from unifi.executor import run_blocking
+
+if TYPE_CHECKING:
+    from unifi.cams.base import UnifiCamBase
+
+STREAMS = ("video1", "video2", "video3")
+MJPEG_BOUNDARY = "frame"
+
+
+def is_complete_jpeg(data: bytes) -> bool:
+    # Snapshots written in place by ffmpeg can be read half-written
+    return data.startswith(b"\xff\xd8") and data.rstrip(b"\x00").endswith(b"\xff\xd9")
+
+
+class SnapshotBroadcaster:
+    """
+    Refreshes the camera snapshot while anyone is watching and hands each
+    viewer the latest frame once it is ready for it, so slow viewers skip
+    frames instead of queueing them.
+    """
+
+    def __init__(
+        self, cam: "UnifiCamBase", interval: float, logger: logging.Logger
+    ) -> None:
+        self.cam = cam
+        self.interval = interval
+        self.logger = logger
+        self._frame: Optional[bytes] = None
+        self._version = 0
+        self._changed: Optional[asyncio.Condition] = None
+        self._viewers = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def frames(self) -> AsyncIterator[bytes]:
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        self._viewers += 1
+        if not self._task:
+            self._task = asyncio.create_task(self._refresh())
+        try:
+            version = 0
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(
+                        lambda seen=version: self._version != seen
+                    )
+                    frame, version = self._frame, self._version
+                assert frame
+                yield frame
+        finally:
+            self._viewers -= 1
+            if not self._viewers and self._task:
+                self._task.cancel()
+                self._task = None
+
+    async def _refresh(self) -> None:
+        assert self._changed
+        while True:
+            try:
+                path = await self.cam.get_snapshot()
+                frame = await run_blocking(path.read_bytes)
+            except OSError:
+                frame = None
+            if frame and frame != self._frame and is_complete_jpeg(frame):
+                async with self._changed:
+                    self._frame = frame
+                    self._version += 1
+                    self._changed.notify_all()
+            await asyncio.sleep(self.interval)
+
+
+class HttpApi:
+    def __init__(self, cam: "UnifiCamBase", port: int, logger: logging.Logger) -> None:
+        self.cam = cam
+        self.port = port
+        self.logger = logger
+        self.snapshots = SnapshotBroadcaster(
+            cam, 1 / cam.args.mjpeg_fps, logger.getChild("mjpeg")
+        )
+        self.runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        self.logger.info(f"Enabling HTTP API on port {self.port}")
+        app = web.Application()
+        app.add_routes(
+            [
+                web.get("/start_motion", self.start_motion),
+                web.get("/stop_motion", self.stop_motion),
+                web.get("/stats", self.stats),
+                web.get("/snapshot.jpg", self.snapshot),
+                web.get("/stream.mjpeg", self.mjpeg),
+                web.get("/{stream}.flv", self.flv),
+            ]
+        )
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, port=self.port)
+        await site.start()
+
+    async def stop(self) -> None:
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def start_motion(self, request: web.Request) -> web.Response:
+        self.logger.debug("Starting motion")
+        await self.cam.trigger_motion_start()
+        return web.Response(text="ok")
+
+    async def stop_motion(self, request: web.Request) -> web.Response:
+        self.logger.debug("Stopping motion")
+        await self.cam.trigger_motion_stop()
+        return web.Response(text="ok")
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.cam.get_stats())
+
+    async def snapshot(self, request: web.Request) -> web.Response:
+        try:
+            path = await self.cam.get_snapshot()
+            frame = await run_blocking(path.read_bytes)
+        except OSError:
+            raise web.HTTPServiceUnavailable(text="Snapshot is not ready yet")
+        return web.Response(body=frame, content_type="image/jpeg")
+
+    async def mjpeg(self, request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse(
+            headers={
+                "Content-Type": "multipart/x-mixed-replace;"
+                f" boundary={MJPEG_BOUNDARY}",
+                "Cache-Control": "no-cache",
+            }
+        )
+        await response.prepare(request)
+        try:
+            async for frame in self.snapshots.frames():
+                await response.write(
+                    f"--{MJPEG_BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                    f"Content-Length: {len(frame)}\r\n\r\n".encode() + frame + b"\r\n"
+                )
+        except ConnectionResetError:
+            pass
+        return response
+
+    async def flv(self, request: web.Request) -> web.StreamResponse:
+        stream_index = request.match_info["stream"]
+        if stream_index not in STREAMS:
+            raise web.HTTPNotFound()
+
+        pipeline = await self.cam.acquire_local_stream(stream_index)
+        subscriber = pipeline.subscribe(self.cam.args.restream_queue)
+        self.logger.info(f"Restreaming {stream_index} to {request.remote}")
+        try:
+            response = web.StreamResponse(
+                headers={"Content-Type": "video/x-flv", "Cache-Control": "no-cache"}
+            )
+            await response.prepare(request)
+            while True:
+                chunk = await subscriber.get()
+                if chunk is None:
+                    break
+                await response.write(chunk)
+        except ConnectionResetError:
+            pass
+        finally:
+            pipeline.unsubscribe(subscriber)
+            self.logger.info(f"Stopped restreaming {stream_index} to {request.remote}")
+        return response
@@ -0,0 +1,186 @@
+"""
+Outbound queue of messages to the NVR, written by a single task so callers
+never wait on the socket. Protocol responses go ahead of events, and events
+are held for a short window in which superseded ones are coalesced.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from typing import Any, Optional
+
+from websockets.exceptions import ConnectionClosed
+
+PRIORITY_RESPONSE = 0
+PRIORITY_EVENT = 1
+
+# Messages waiting to be sent, the oldest events are dropped beyond this
+MAX_QUEUE_SIZE = 256
+# Seconds events wait before being sent, so they can be coalesced
+FLUSH_INTERVAL = 0.05
+# Sent messages the latency statistics cover
+LATENCY_SAMPLES = 100
+
+
+class _Entry:
+    __slots__ = ("msg", "priority", "key", "enqueued", "cancelled")
+
+    def __init__(
+        self, msg: dict[str, Any], priority: int, key: Optional[str], enqueued: float
+    ) -> None:
+        self.msg = msg
+        self.priority = priority
+        self.key = key
+        self.enqueued = enqueued
+        self.cancelled = False
+
+
+class SendQueue:
+    """
+    A bounded priority queue drained into a websocket by `run`.
+
+    An event put with a `key` replaces a pending event with the same key, and
+    an event that `cancels` a key still pending is dropped together with it,
+    such as a motion stop that follows its start within the flush window.
+    """
+
+    def __init__(
+        self,
+        ws,
+        logger: logging.Logger,
+        max_size: int = MAX_QUEUE_SIZE,
+        flush_interval: float = FLUSH_INTERVAL,
+    ) -> None:
+        self.ws = ws
+        self.logger = logger
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._queues: tuple[deque[_Entry], ...] = (deque(), deque())
+        self._keyed: dict[str, _Entry] = {}
+        self._size = 0
+        self._changed = asyncio.Event()
+        self._empty = asyncio.Event()
+        self._empty.set()
+        # Nothing is sent anymore once the connection closed
+        self._closed = False
+        self._latencies: deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def put(
+        self,
+        msg: dict[str, Any],
+        priority: int = PRIORITY_RESPONSE,
+        key: Optional[str] = None,
+        cancels: Optional[str] = None,
+    ) -> None:
+        if cancels and cancels in self._keyed:
+            self._remove(self._keyed[cancels])
+            self.coalesced += 2
+            if not self._size:
+                self._empty.set()
+            return
+        if key and key in self._keyed:
+            self._keyed[key].msg = msg
+            self.coalesced += 1
+            return
+
+        if self._size >= self.max_size:
+            self._drop_oldest()
+        entry = _Entry(msg, priority, key, time.monotonic())
+        self._queues[priority].append(entry)
+        if key:
+            self._keyed[key] = entry
+        self._size += 1
+        self.max_depth = max(self.max_depth, self._size)
+        self._empty.clear()
+        self._changed.set()
+
+    def _remove(self, entry: _Entry) -> None:
+        entry.cancelled = True
+        if entry.key:
+            self._keyed.pop(entry.key, None)
+        self._size -= 1
+
+    def _drop_oldest(self) -> None:
+        for queue in reversed(self._queues):
+            while queue:
+                entry = queue.popleft()
+                if not entry.cancelled:
+                    self._remove(entry)
+                    self.dropped += 1
+                    self.logger.warning(
+                        f"Send queue full, dropped {entry.msg['functionName']}"
+                    )
+                    return
+
+    def _next(self) -> tuple[Optional[_Entry], Optional[float]]:
+        """The next entry ready to send, or the time to wait for one."""
+        now = time.monotonic()
+        wait = None
+        for queue in self._queues:
+            while queue and queue[0].cancelled:
+                queue.popleft()
+            if not queue:
+                continue
+            entry = queue[0]
+            delay = 0 if entry.priority == PRIORITY_RESPONSE else self.flush_interval
+            ready = entry.enqueued + delay
+            if ready <= now:
+                queue.popleft()
+                return entry, None
+            wait = ready - now if wait is None else min(wait, ready - now)
+        return None, wait
+
+    async def run(self) -> None:
+        while True:
+            entry, wait = self._next()
+            if entry is None:
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._remove(entry)
+            try:
+                await self.ws.send(json.dumps(entry.msg).encode())
+            except ConnectionClosed:
+                self.logger.info("Connection closed, stopped sending")
+                self._closed = True
+                self._empty.set()
+                return
+            self.sent += 1
+            self._latencies.append(time.monotonic() - entry.enqueued)
+            if not self._size:
+                self._empty.set()
+
+    async def drain(self, timeout: float) -> None:
+        """Wait until everything queued was sent, for at most `timeout`."""
+        if self._closed:
+            return
+        try:
+            await asyncio.wait_for(self._empty.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def stats(self) -> dict[str, Any]:
+        latencies = self._latencies
+        return {
+            "depth": self._size,
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "latency_ms": round(1000 * sum(latencies) / len(latencies), 2)
+            if latencies
+            else None,
+            "max_latency_ms": round(1000 * max(latencies), 2) if latencies else None,
+        }
@@ -0,0 +1,144 @@
+"""
+On-demand snapshots decoded from a single keyframe, either one already relayed
+by the proxy or one pulled from the camera by a short-lived ffmpeg, and scaled
+down before they are uploaded.
+"""
+import asyncio
+import io
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from unifi.executor import run_blocking
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, snapshots are uploaded as is
+    Image = None
+
+SNAPSHOT_TIMEOUT = 15
+# Resized snapshots kept, keyed by source file version and size
+RESIZE_CACHE_SIZE = 16
+
+
+async def decode_snapshot(
+    input_args: list[str],
+    dst: Path,
+    logger: logging.Logger,
+    stdin: Optional[bytes] = None,
+) -> bool:
+    """
+    Decode the first keyframe of an input into a JPEG at `dst`, which is
+    replaced atomically so readers never see a partial image.
+    """
+    fd, tmp = tempfile.mkstemp(dir=dst.parent, suffix=".jpg")
+    os.close(fd)
+    cmd = [
+        "ffmpeg",
+        "-loglevel",
+        "error",
+        "-y",
+        "-skip_frame",
+        "nokey",
+        *input_args,
+        "-frames:v",
+        "1",
+        "-q:v",
+        "2",
+        "-f",
+        "image2",
+        tmp,
+    ]
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if stdin else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except OSError:
+        logger.exception("Could not run ffmpeg for snapshot")
+        os.unlink(tmp)
+        return False
+
+    try:
+        _, stderr = await asyncio.wait_for(proc.communicate(stdin), SNAPSHOT_TIMEOUT)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        logger.warning("Timed out decoding snapshot")
+        os.unlink(tmp)
+        return False
+
+    if proc.returncode != 0 or os.path.getsize(tmp) == 0:
+        logger.warning(f"Could not decode snapshot: {stderr.decode().strip()}")
+        os.unlink(tmp)
+        return False
+
+    os.replace(tmp, dst)
+    return True
+
+
+def _resize(path: Path, size: tuple[int, int], quality: int) -> Optional[bytes]:
+    with Image.open(path) as image:
+        if image.width <= size[0] and image.height <= size[1]:
+            return None
+        # Let libjpeg scale while decoding, far cheaper than a full decode
+        image.draft("RGB", size)
+        image = image.convert("RGB")
+        image.thumbnail(size)
+        out = io.BytesIO()
+        image.save(out, "JPEG", quality=quality, optimize=True)
+        return out.getvalue()
+
+
+class SnapshotResizer:
+    """
+    Scales snapshots down to a maximum size in the blocking I/O pool, caching
+    the result for each version of the source file and size.
+    """
+
+    def __init__(
+        self, max_size: tuple[int, int], quality: int, logger: logging.Logger
+    ) -> None:
+        self.max_size = max_size
+        self.quality = quality
+        self.logger = logger
+        self._cache: OrderedDict[tuple, Optional[bytes]] = OrderedDict()
+
+    async def resize(
+        self, path: Path, size: Optional[tuple[int, int]] = None
+    ) -> Optional[bytes]:
+        """
+        Return the snapshot as a JPEG no larger than `size` (and the maximum
+        size), or None if the original should be used as is.
+        """
+        if Image is None:
+            return None
+        if size:
+            size = (min(size[0], self.max_size[0]), min(size[1], self.max_size[1]))
+        else:
+            size = self.max_size
+
+        try:
+            stat = await run_blocking(path.stat)
+        except OSError:
+            return None
+        key = (str(path), stat.st_mtime_ns, stat.st_size, size)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        try:
+            data = await run_blocking(_resize, path, size, self.quality)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Could not resize snapshot {path}: {e}")
+            return None
+
+        self._cache[key] = data
+        if len(self._cache) > RESIZE_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return data
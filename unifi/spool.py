@@ -0,0 +1,155 @@
+"""
+Fixed-size, memory-mapped ring of relayed FLV units, filled while the NVR is
+unreachable and replayed to it once it is back.
+"""
+import mmap
+import os
+from pathlib import Path
+from typing import Optional
+
+from unifi.stream import (
+    PREVIOUS_TAG_SIZE,
+    TAG_HEADER_SIZE,
+    TAG_TYPE_VIDEO,
+    TRAILER_SIZE,
+)
+
+
+class SpoolRing:
+    """
+    A ring buffer of whole units backed by a memory-mapped file.
+
+    Units are copied straight into the mapping and never split at the end of
+    the file: when a unit does not fit before the end, writing wraps to the
+    start and the data ends at `_wrap_end`. When full, the oldest units are
+    dropped up to the next keyframe so the ring always starts decodable. A GOP
+    larger than the ring empties it, and new units are then discarded until
+    the next keyframe.
+    """
+
+    def __init__(self, path: Path, capacity: int) -> None:
+        self.path = path
+        self.capacity = capacity
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, capacity)
+            self._map = mmap.mmap(fd, capacity)
+        finally:
+            os.close(fd)
+        self._view = memoryview(self._map)
+        self._head = 0
+        self._tail = 0
+        self._wrap_end: Optional[int] = None
+        self._used = 0
+        # Set when eviction emptied the ring in the middle of a GOP
+        self._needs_keyframe = False
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return self._used
+
+    def _unit_size(self, offset: int) -> int:
+        m = self._map
+        data_size = (m[offset + 1] << 16) | (m[offset + 2] << 8) | m[offset + 3]
+        return TAG_HEADER_SIZE + data_size + PREVIOUS_TAG_SIZE + TRAILER_SIZE
+
+    @staticmethod
+    def _is_keyframe(buf, offset: int = 0) -> bool:
+        return (
+            buf[offset] == TAG_TYPE_VIDEO
+            and buf[offset + TAG_HEADER_SIZE] >> 4 == 1
+            and buf[offset + TAG_HEADER_SIZE + 1] != 0
+        )
+
+    def _advance(self, size: int) -> None:
+        self._tail += size
+        self._used -= size
+        if self._wrap_end is not None and self._tail >= self._wrap_end:
+            self._tail = 0
+            self._wrap_end = None
+        if self._used == 0:
+            self._reset()
+
+    def _drop_oldest(self) -> None:
+        self._advance(self._unit_size(self._tail))
+        self.dropped += 1
+
+    def append(self, unit: bytes) -> bool:
+        """
+        Copy a unit into the ring, dropping the oldest units if needed.
+        Returns False if the unit is larger than the whole ring.
+        """
+        size = len(unit)
+        if size > self.capacity:
+            return False
+        if self._needs_keyframe:
+            if not self._is_keyframe(unit):
+                self.dropped += 1
+                return True
+            self._needs_keyframe = False
+
+        dropped = False
+        while True:
+            if self._wrap_end is None:
+                if self.capacity - self._head >= size:
+                    break
+                if self._used == 0 or self._tail >= size:
+                    # Wrap to the start, leaving the end of the file unused
+                    self._wrap_end = self._head
+                    self._head = 0
+                    if self._used == 0:
+                        self._tail = 0
+                        self._wrap_end = None
+                    continue
+            elif self._tail - self._head >= size:
+                break
+            self._drop_oldest()
+            dropped = True
+
+        self._view[self._head : self._head + size] = unit
+        self._head += size
+        self._used += size
+
+        if dropped:
+            # Never start a replay in the middle of a GOP
+            while self._used and not self._is_keyframe(self._map, self._tail):
+                self._drop_oldest()
+            self._needs_keyframe = not self._used
+        return True
+
+    def peek(self, max_bytes: int) -> memoryview:
+        """
+        Return the oldest whole units, contiguous in the file, totalling at most
+        `max_bytes` (but always at least one unit).
+        """
+        if not self._used:
+            return self._view[0:0]
+        end = self._wrap_end if self._wrap_end is not None else self._head
+        size = 0
+        while self._tail + size < end:
+            unit_size = self._unit_size(self._tail + size)
+            if size and size + unit_size > max_bytes:
+                break
+            size += unit_size
+        return self._view[self._tail : self._tail + size]
+
+    def consume(self, size: int) -> None:
+        """Drop `size` bytes returned by `peek`."""
+        self._advance(size)
+
+    def _reset(self) -> None:
+        self._head = self._tail = self._used = 0
+        self._wrap_end = None
+
+    def clear(self) -> None:
+        self._reset()
+        self._needs_keyframe = False
+
+    def close(self) -> None:
+        self.clear()
+        self._view.release()
+        self._map.close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
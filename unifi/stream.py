@@ -0,0 +1,665 @@
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import tempfile
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from unifi.executor import run_blocking
+from unifi.meter import StreamMeter
+
+if TYPE_CHECKING:
+    from unifi.spool import SpoolRing
+
+TAG_TYPE_AUDIO = 8
+TAG_TYPE_VIDEO = 9
+TAG_TYPE_SCRIPT = 18
+
+# FLV file header plus the first (always zero) previous tag size
+FLV_HEADER_SIZE = 13
+TAG_HEADER_SIZE = 11
+PREVIOUS_TAG_SIZE = 4
+# Timestamp trailer written by unifi.clock_sync after every tag
+TRAILER_SIZE = 16
+
+METADATA_PREFIX = b"\x02\x00\x0aonMetaData"
+STREAM_NAME_KEY = b"\x00\x0astreamName\x02"
+
+# Upper bound for a cached GOP, longer GOPs are not cached
+GOP_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+
+class StreamSubscriber:
+    """
+    A local consumer of a pipeline's stream, fed plain FLV tags through a
+    bounded queue. A subscriber that falls behind loses tags up to the next
+    keyframe instead of slowing down the pipeline.
+    """
+
+    def __init__(self, max_queue: int) -> None:
+        self.queue: asyncio.Queue[Optional[bytes]] = asyncio.Queue(max_queue)
+        self.started = False
+        self.dropped = 0
+        self._needs_keyframe = False
+
+    def start(self, prologue: bytes) -> None:
+        self.started = True
+        self.queue.put_nowait(prologue)
+
+    def offer(self, tag: bytes, is_keyframe: bool) -> None:
+        if self._needs_keyframe:
+            if not is_keyframe:
+                return
+            self._needs_keyframe = False
+        try:
+            self.queue.put_nowait(tag)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            self._needs_keyframe = True
+
+    def close(self) -> None:
+        # Make room for the end of stream marker if needed
+        while self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def get(self) -> Optional[bytes]:
+        """Next chunk of FLV, or None once the stream has ended."""
+        return await self.queue.get()
+
+
+def tag_timestamp(unit: bytes) -> int:
+    """FLV timestamp of a tag in milliseconds."""
+    return (unit[7] << 24) | int.from_bytes(unit[4:7], "big")
+
+
+def rewrite_stream_name(unit: bytes, stream_name: str) -> bytes:
+    """
+    Replace the streamName string in an onMetaData unit, fixing up the tag data
+    size and previous tag size around it.
+    """
+    data = unit[TAG_HEADER_SIZE : -(PREVIOUS_TAG_SIZE + TRAILER_SIZE)]
+    key = data.find(STREAM_NAME_KEY)
+    if key < 0:
+        return unit
+
+    value = key + len(STREAM_NAME_KEY)
+    old_length = int.from_bytes(data[value : value + 2], "big")
+    new_value = stream_name.encode()
+    data = b"".join(
+        [
+            data[:value],
+            len(new_value).to_bytes(2, "big"),
+            new_value,
+            data[value + 2 + old_length :],
+        ]
+    )
+    return b"".join(
+        [
+            unit[:1],
+            len(data).to_bytes(3, "big"),
+            unit[4:TAG_HEADER_SIZE],
+            data,
+            (TAG_HEADER_SIZE + len(data)).to_bytes(PREVIOUS_TAG_SIZE, "big"),
+            unit[-TRAILER_SIZE:],
+        ]
+    )
+
+
+class StreamPipeline:
+    """
+    A `ffmpeg | unifi.clock_sync` ingest whose extended FLV output is relayed to
+    an avSerializer destination by the proxy itself.
+
+    Because the proxy owns the destination socket, the ingest can outlive it: a
+    detached pipeline keeps reading from the camera and is re-attached to the
+    NVR at the next keyframe, prefixed with the FLV header, onMetaData and codec
+    sequence headers it saw when the stream started.
+
+    With the GOP cache enabled the pipeline also holds every tag since the most
+    recent keyframe, so a new destination is served a decodable picture
+    immediately instead of waiting for the camera's next keyframe.
+
+    With a spool, losing the destination keeps the ingest running and writes
+    the stream to the spool instead. The next destination is first sent the
+    spooled footage, at most `replay_rate` bytes per second, and then live.
+
+    Local subscribers receive the same stream as plain FLV, and keep the
+    ingest running while the NVR is not attached.
+    """
+
+    def __init__(
+        self,
+        stream_index: str,
+        stream_name: str,
+        cmd: str,
+        grace_period: float,
+        logger: logging.Logger,
+        gop_cache: bool = False,
+        persistent: bool = False,
+        on_config: Optional[Callable[[str, bytes], None]] = None,
+        spool: Optional["SpoolRing"] = None,
+        replay_rate: float = 2 * 1024 * 1024,
+    ) -> None:
+        self.stream_index = stream_index
+        self.stream_name = stream_name
+        self.cmd = cmd
+        self.grace_period = grace_period
+        self.logger = logger
+        self.gop_cache = gop_cache
+        # Persistent pipelines are only stopped explicitly, never on detach
+        self.persistent = persistent or gop_cache
+        # Called with ("video" | "audio", data) for every sequence header
+        self.on_config = on_config
+        self.spool = spool
+        self.replay_rate = replay_rate
+
+        self._proc: Optional[asyncio.subprocess.Process] = None
+        self._relay_task: Optional[asyncio.Task] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._destination: Optional[tuple[str, int]] = None
+        self._park_handle: Optional[asyncio.TimerHandle] = None
+        self._needs_keyframe: bool = True
+        self._stopped: bool = False
+        self._bytes_sent: int = 0
+        self._attach_count: int = 0
+        self.meter = StreamMeter()
+        self._spooling: bool = False
+        self._spool_started: bool = False
+        self._replay_task: Optional[asyncio.Task] = None
+        self._subscribers: set[StreamSubscriber] = set()
+
+        self._header: Optional[bytes] = None
+        self._metadata: Optional[bytes] = None
+        self._video_config: Optional[bytes] = None
+        self._audio_config: Optional[bytes] = None
+        self._configured = asyncio.Event()
+        self._gop: list[bytes] = []
+        self._gop_size: int = 0
+        self._keyframe: Optional[bytes] = None
+
+    @property
+    def destination(self) -> Optional[tuple[str, int]]:
+        return self._destination
+
+    def is_alive(self) -> bool:
+        return (
+            not self._stopped
+            and self._proc is not None
+            and self._proc.returncode is None
+            and self._relay_task is not None
+            and not self._relay_task.done()
+        )
+
+    def is_attached(self) -> bool:
+        return self._writer is not None
+
+    def has_video_config(self) -> bool:
+        return self._video_config is not None
+
+    def has_subscribers(self) -> bool:
+        return bool(self._subscribers)
+
+    @property
+    def attach_count(self) -> int:
+        return self._attach_count
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self._proc.pid if self._proc else None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "stream_name": self.stream_name,
+            "alive": self.is_alive(),
+            "attached": self.is_attached(),
+            "attach_count": self._attach_count,
+            "bytes_sent": self._bytes_sent,
+            "gop_cached_tags": len(self._gop),
+            "spooled_bytes": len(self.spool) if self.spool is not None else 0,
+            "subscribers": len(self._subscribers),
+            "subscriber_drops": sum(sub.dropped for sub in self._subscribers),
+            **self.meter.stats(),
+        }
+
+    async def start(self) -> None:
+        self._proc = await asyncio.create_subprocess_shell(
+            self.cmd, stdout=asyncio.subprocess.PIPE, start_new_session=True
+        )
+        self._relay_task = asyncio.create_task(self._relay())
+
+    async def attach(
+        self, destination: tuple[str, int], stream_name: Optional[str] = None
+    ) -> None:
+        if self._park_handle:
+            self._park_handle.cancel()
+            self._park_handle = None
+
+        if stream_name and stream_name != self.stream_name:
+            self.stream_name = stream_name
+            self._close_writer()
+        elif self._writer and self._destination == destination:
+            return
+
+        self._close_writer()
+        try:
+            _, self._writer = await asyncio.open_connection(*destination)
+        except OSError as e:
+            self.logger.error(
+                f"Could not connect {self.stream_index} to"
+                f" {destination[0]}:{destination[1]}: {e}"
+            )
+            self.detach(outage=True)
+            return
+
+        self.logger.info(
+            f"Attached {self.stream_index} ({self.stream_name}) to"
+            f" {destination[0]}:{destination[1]}"
+        )
+        self._destination = destination
+        self._needs_keyframe = True
+        self._attach_count += 1
+
+        if self.spool is not None and len(self.spool):
+            if not self._spooling:
+                # Spooled by a pipeline that died during the outage, live
+                # tags are queued behind it from the next keyframe
+                self._spooling = True
+                self._spool_started = False
+            self._needs_keyframe = False
+            self._replay_task = asyncio.create_task(self._replay(self._writer))
+            return
+        self._spooling = False
+
+        if self._gop:
+            prologue = self._prologue()
+            self._writer.write(prologue)
+            self._writer.writelines(self._gop)
+            self._bytes_sent += len(prologue) + self._gop_size
+            self._needs_keyframe = False
+            self.logger.debug(
+                f"Served {len(self._gop)} cached tags to {self.stream_index}"
+            )
+
+    def detach(self, outage: bool = False) -> None:
+        """
+        Disconnect from the destination and keep the ingest running for the
+        grace period, after which it is stopped unless re-attached. Persistent
+        pipelines are kept running until explicitly stopped.
+
+        An `outage` is a destination that went away unexpectedly: pipelines
+        with a spool keep running and spool the stream until re-attached.
+        """
+        self._close_writer()
+        if self.spool is not None:
+            # A stopped pipeline may share its ring with its replacement
+            if outage and not self._stopped:
+                if not self._spooling:
+                    self.logger.info(
+                        f"Spooling {self.stream_index} until the NVR is back"
+                    )
+                    self._spooling = True
+                    self._spool_started = bool(len(self.spool))
+                return
+            self._spooling = False
+            self.spool.clear()
+
+        if self.persistent or self._subscribers:
+            return
+
+        if self.grace_period <= 0:
+            self.stop()
+            return
+
+        if not self._park_handle and self.is_alive():
+            self.logger.info(
+                f"Parking {self.stream_index} ({self.stream_name})"
+                f" for {self.grace_period}s"
+            )
+            self._park_handle = asyncio.get_running_loop().call_later(
+                self.grace_period, self.stop
+            )
+
+    def hold(self, timeout: float) -> None:
+        """
+        Keep a pipeline that was started ahead of any destination running for
+        `timeout` seconds, then detach it as usual unless it was attached.
+        """
+        if self._park_handle:
+            self._park_handle.cancel()
+        self._park_handle = asyncio.get_running_loop().call_later(
+            timeout, self._release_hold
+        )
+
+    def _release_hold(self) -> None:
+        self._park_handle = None
+        if not self._writer and self.is_alive():
+            self.logger.info(f"{self.stream_index} was not requested, releasing it")
+            self.detach()
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._spooling = False
+        if self._replay_task:
+            self._replay_task.cancel()
+            self._replay_task = None
+        # The ring belongs to the camera, the next pipeline of this stream
+        # replays what is left in it
+        if self._park_handle:
+            self._park_handle.cancel()
+            self._park_handle = None
+
+        # The pipeline runs in its own session so the shell, ffmpeg and
+        # clock_sync can be killed together. The relay task closes the
+        # destination once stdout hits EOF.
+        if self._proc and self._proc.returncode is None:
+            try:
+                os.killpg(self._proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def subscribe(self, max_queue: int) -> StreamSubscriber:
+        subscriber = StreamSubscriber(max_queue)
+        self._subscribers.add(subscriber)
+        if self._park_handle:
+            self._park_handle.cancel()
+            self._park_handle = None
+        if self._gop:
+            # Start right away from the cached GOP
+            subscriber.start(self.flv_prologue())
+            for unit in self._gop:
+                subscriber.offer(unit[:-TRAILER_SIZE], unit is self._gop[0])
+        return subscriber
+
+    def unsubscribe(self, subscriber: StreamSubscriber) -> None:
+        self._subscribers.discard(subscriber)
+        if not self._subscribers and not self._writer and not self._spooling:
+            self.detach()
+
+    def flv_prologue(self) -> bytes:
+        """
+        Standard FLV header, onMetaData and sequence headers for local
+        subscribers, without the clock_sync trailers.
+        """
+        header = self._header or b"FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00"
+        return b"".join(
+            [header[:4], b"\x05", header[5:]]
+            + [
+                part[:-TRAILER_SIZE]
+                for part in (self._metadata, self._video_config, self._audio_config)
+                if part
+            ]
+        )
+
+    def keyframe_flv(self) -> Optional[bytes]:
+        """
+        The latest keyframe as a standalone FLV with its sequence header, or
+        None if none was seen yet.
+        """
+        if not self._keyframe or not self._video_config:
+            return None
+        return self.flv_prologue() + self._keyframe[:-TRAILER_SIZE]
+
+    def _close_writer(self) -> None:
+        if self._replay_task:
+            self._replay_task.cancel()
+            self._replay_task = None
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    async def _relay(self) -> None:
+        assert self._proc and self._proc.stdout
+        stdout = self._proc.stdout
+        try:
+            self._header = await stdout.readexactly(FLV_HEADER_SIZE)
+            while True:
+                tag_header = await stdout.readexactly(TAG_HEADER_SIZE)
+                data_size = int.from_bytes(tag_header[1:4], "big")
+                unit = tag_header + await stdout.readexactly(
+                    data_size + PREVIOUS_TAG_SIZE + TRAILER_SIZE
+                )
+                await self._process_unit(unit)
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            self.logger.info(f"Stream pipeline for {self.stream_index} exited")
+            self._close_writer()
+            for subscriber in self._subscribers:
+                subscriber.close()
+
+    async def _process_unit(self, unit: bytes) -> None:
+        tag_type = unit[0]
+        data = TAG_HEADER_SIZE
+        is_keyframe = False
+
+        if tag_type == TAG_TYPE_VIDEO:
+            # Sequence headers are replayed explicitly on attach
+            if unit[data + 1] == 0:
+                self._video_config = unit
+                self._configured.set()
+                self._notify_config("video", unit)
+                return
+            is_keyframe = unit[data] >> 4 == 1
+            if is_keyframe:
+                # Kept for snapshots, which only need the latest keyframe
+                self._keyframe = unit
+        elif tag_type == TAG_TYPE_AUDIO:
+            if unit[data] >> 4 == 10 and unit[data + 1] == 0:
+                self._audio_config = unit
+                self._notify_config("audio", unit)
+                return
+        elif tag_type == TAG_TYPE_SCRIPT and unit.startswith(METADATA_PREFIX, data):
+            self._metadata = unit
+            return
+
+        if tag_type in (TAG_TYPE_VIDEO, TAG_TYPE_AUDIO):
+            self.meter.add(
+                tag_type,
+                len(unit) - TAG_HEADER_SIZE - PREVIOUS_TAG_SIZE - TRAILER_SIZE,
+                tag_timestamp(unit),
+                is_keyframe,
+            )
+            if self._subscribers:
+                self._publish(unit, is_keyframe)
+
+        if self.gop_cache:
+            self._cache_unit(unit, is_keyframe)
+
+        if self._spooling and self.spool is not None:
+            # Spooled footage must start at a keyframe, and live units queue
+            # behind it until the replay catches up
+            self._spool_started = self._spool_started or is_keyframe
+            if self._spool_started:
+                self.spool.append(unit)
+            return
+
+        if not self._writer:
+            return
+
+        if self._needs_keyframe:
+            if not is_keyframe:
+                return
+            self._needs_keyframe = False
+            prologue = self._prologue()
+            self._writer.write(prologue)
+            self._bytes_sent += len(prologue)
+
+        try:
+            self._bytes_sent += len(unit)
+            self._writer.write(unit)
+            await self._writer.drain()
+        except OSError as e:
+            self.logger.warning(f"Lost destination for {self.stream_index}: {e}")
+            self.detach(outage=True)
+
+    def _publish(self, unit: bytes, is_keyframe: bool) -> None:
+        tag = unit[:-TRAILER_SIZE]
+        prologue = None
+        for subscriber in self._subscribers:
+            if not subscriber.started:
+                if not is_keyframe:
+                    continue
+                prologue = prologue or self.flv_prologue()
+                subscriber.start(prologue)
+            subscriber.offer(tag, is_keyframe)
+
+    async def _replay(self, writer: asyncio.StreamWriter) -> None:
+        assert self.spool is not None
+        spool = self.spool
+        chunk_size = max(int(self.replay_rate / 10), 1)
+        # A pipeline replacing a dead one has no prologue yet
+        await self._configured.wait()
+        self.logger.info(f"Replaying {len(spool)} spooled bytes of {self.stream_index}")
+        try:
+            prologue = self._prologue()
+            writer.write(prologue)
+            self._bytes_sent += len(prologue)
+            while len(spool):
+                chunk = spool.peek(chunk_size)
+                data = bytes(chunk)
+                chunk.release()
+                spool.consume(len(data))
+                writer.write(data)
+                self._bytes_sent += len(data)
+                await writer.drain()
+                await asyncio.sleep(len(data) / self.replay_rate)
+        except OSError as e:
+            self.logger.warning(f"Lost destination for {self.stream_index}: {e}")
+            self._replay_task = None
+            self.detach(outage=True)
+            return
+
+        self.logger.info(f"Replayed spool of {self.stream_index}, back to live")
+        self._replay_task = None
+        self._spooling = False
+
+    def _notify_config(self, kind: str, unit: bytes) -> None:
+        if self.on_config:
+            self.on_config(
+                kind, unit[TAG_HEADER_SIZE : -(PREVIOUS_TAG_SIZE + TRAILER_SIZE)]
+            )
+
+    def _cache_unit(self, unit: bytes, is_keyframe: bool) -> None:
+        if is_keyframe:
+            self._gop = [unit]
+            self._gop_size = len(unit)
+        elif self._gop:
+            self._gop_size += len(unit)
+            if self._gop_size > GOP_CACHE_MAX_BYTES:
+                self._gop = []
+            else:
+                self._gop.append(unit)
+
+    def _prologue(self) -> bytes:
+        return b"".join(
+            part
+            for part in (
+                self._header,
+                self._metadata
+                and rewrite_stream_name(self._metadata, self.stream_name),
+                self._video_config,
+                self._audio_config,
+            )
+            if part
+        )
+
+
+class TranscodeLadder:
+    """
+    A single ffmpeg that decodes a source once and encodes several renditions
+    of it, each written to its own FIFO for a `StreamPipeline` to relay. Use
+    `create` to make one along with its FIFOs.
+    """
+
+    def __init__(
+        self,
+        renditions: dict[str, tuple[int, int]],
+        logger: logging.Logger,
+        fifo_dir: str,
+    ) -> None:
+        self.renditions = renditions
+        self.logger = logger
+        self._fifo_dir = fifo_dir
+        self.outputs: dict[str, str] = {
+            stream_index: self.fifo_path(fifo_dir, stream_index)
+            for stream_index in renditions
+        }
+
+        self._proc: Optional[asyncio.subprocess.Process] = None
+        self._park_handle: Optional[asyncio.TimerHandle] = None
+        self._stopped: bool = False
+
+    @staticmethod
+    def fifo_path(fifo_dir: str, stream_index: str) -> str:
+        return os.path.join(fifo_dir, f"{stream_index}.flv")
+
+    @classmethod
+    def _make_fifos(cls, stream_indexes: list[str]) -> str:
+        fifo_dir = tempfile.mkdtemp()
+        for stream_index in stream_indexes:
+            os.mkfifo(cls.fifo_path(fifo_dir, stream_index))
+        return fifo_dir
+
+    @classmethod
+    async def create(
+        cls, renditions: dict[str, tuple[int, int]], logger: logging.Logger
+    ) -> "TranscodeLadder":
+        fifo_dir = await run_blocking(cls._make_fifos, list(renditions))
+        return cls(renditions, logger, fifo_dir)
+
+    def filter_complex(self) -> str:
+        """
+        Filter graph splitting the decoded video into one scaled output per
+        rendition, labelled `[<stream_index>]`.
+        """
+        splits = "".join(f"[s{i}]" for i in range(len(self.renditions)))
+        graph = [f"[0:v]split={len(self.renditions)}{splits}"]
+        for i, (stream_index, (width, height)) in enumerate(self.renditions.items()):
+            graph.append(f"[s{i}]scale={width}:{height}[{stream_index}]")
+        return ";".join(graph)
+
+    def is_alive(self) -> bool:
+        return (
+            not self._stopped
+            and self._proc is not None
+            and self._proc.returncode is None
+        )
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self._proc.pid if self._proc else None
+
+    async def start(self, cmd: str) -> None:
+        self._proc = await asyncio.create_subprocess_shell(
+            cmd, stdout=asyncio.subprocess.DEVNULL, start_new_session=True
+        )
+
+    def unpark(self) -> None:
+        if self._park_handle:
+            self._park_handle.cancel()
+            self._park_handle = None
+
+    def park(self, grace_period: float) -> None:
+        if grace_period <= 0:
+            self.stop()
+        elif not self._park_handle and self.is_alive():
+            self._park_handle = asyncio.get_running_loop().call_later(
+                grace_period, self.stop
+            )
+
+    def stop(self) -> None:
+        self._stopped = True
+        self.unpark()
+        if self._proc and self._proc.returncode is None:
+            try:
+                os.killpg(self._proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def cleanup(self) -> None:
+        self.stop()
+        # Only a few empty FIFOs, and this also runs at exit, after the
+        # executor was shut down
+        shutil.rmtree(self._fifo_dir, ignore_errors=True)
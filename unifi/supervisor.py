@@ -0,0 +1,565 @@
+"""
+Run many cameras from a single host by sharding them across worker processes,
+each running its own event loop of `Core` instances.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import shlex
+import signal
+import socket
+import sys
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Connection, wait
+from typing import Any, Optional
+
+import coloredlogs
+
+from unifi.cluster import LeaseManager, LeaseStoreError, SQLiteLeaseStore
+from unifi.executor import get_executor
+from unifi.main import (
+    add_loop_monitor_args,
+    check_dependencies,
+    create_core,
+    parse_args,
+    start_loop_monitor,
+)
+
+# Delay before a crashed camera is started again inside its worker
+CAMERA_RESTART_DELAY = 10
+# Base delay before a dead worker is replaced, doubled for every crash in a row
+WORKER_RESTART_DELAY = 1
+WORKER_RESTART_MAX_DELAY = 60
+# A worker that stays up this long resets its crash count
+WORKER_STABLE_AFTER = 60
+
+
+def load_cameras(path: str, logger: logging.Logger) -> dict[str, list[str]]:
+    """
+    Read a camera list with the `unifi-cam-proxy` arguments of one camera per
+    line. Cameras are identified by their MAC address, which must be unique.
+    Lines with invalid arguments are skipped.
+    """
+    cameras: dict[str, list[str]] = {}
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                argv = shlex.split(line)
+                # argparse exits on invalid arguments, after printing why
+                args = parse_args(argv)
+            except (ValueError, SystemExit):
+                logger.error(f"Skipping invalid camera on line {lineno}: {line}")
+                continue
+            if args.mac in cameras:
+                raise ValueError(f"Duplicate camera MAC address {args.mac}")
+            cameras[args.mac] = argv
+    return cameras
+
+
+class Worker:
+    def __init__(
+        self,
+        worker_id: int,
+        conn: Connection,
+        heartbeat_interval: float,
+        monitor_args: argparse.Namespace,
+    ) -> None:
+        self.worker_id = worker_id
+        self.conn = conn
+        self.heartbeat_interval = heartbeat_interval
+        self.monitor_args = monitor_args
+        self.logger = logging.getLogger(f"Worker[{worker_id}]")
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._stopping: Optional[asyncio.Event] = None
+
+    async def run(self) -> None:
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.conn.fileno(), self._on_command)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stopping.set)
+        monitor = start_loop_monitor(self.monitor_args, self.logger.getEffectiveLevel())
+
+        cpu_time = self._cpu_time()
+        ts = time.monotonic()
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(
+                    self._stopping.wait(), timeout=self.heartbeat_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+
+            now_cpu, now = self._cpu_time(), time.monotonic()
+            try:
+                self.conn.send(
+                    (
+                        "heartbeat",
+                        {
+                            "cameras": sorted(self._tasks),
+                            "cpu_percent": round(
+                                100 * (now_cpu - cpu_time) / max(now - ts, 1e-6), 1
+                            ),
+                            "loop": monitor.stats(),
+                        },
+                    )
+                )
+            except OSError:
+                break
+            cpu_time, ts = now_cpu, now
+
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        monitor.stop()
+
+    @staticmethod
+    def _cpu_time() -> float:
+        times = os.times()
+        return times.user + times.system
+
+    def _on_command(self) -> None:
+        assert self._stopping
+        while self.conn.poll():
+            try:
+                command, camera_id, argv = self.conn.recv()
+            except EOFError:
+                # Supervisor went away
+                asyncio.get_running_loop().remove_reader(self.conn.fileno())
+                self._stopping.set()
+                return
+            if command == "add" and camera_id not in self._tasks:
+                self.logger.info(f"Starting camera {camera_id}")
+                self._tasks[camera_id] = asyncio.create_task(
+                    self._run_camera(camera_id, argv)
+                )
+            elif command == "remove":
+                task = self._tasks.pop(camera_id, None)
+                if task:
+                    self.logger.info(f"Stopping camera {camera_id}")
+                    task.cancel()
+                asyncio.create_task(self._confirm_stop(camera_id, task))
+
+    async def _confirm_stop(self, camera_id: str, task: Optional[asyncio.Task]) -> None:
+        if task:
+            await asyncio.gather(task, return_exceptions=True)
+        try:
+            self.conn.send(("stopped", camera_id))
+        except OSError:
+            pass
+
+    async def _run_camera(self, camera_id: str, argv: list[str]) -> None:
+        while True:
+            args = parse_args(argv)
+            core = await create_core(args, logger_suffix=f"[{args.name}]")
+            if core:
+                try:
+                    await core.run()
+                except Exception:
+                    self.logger.exception(f"Camera {camera_id} crashed")
+                finally:
+                    core.cam.close_streams()
+
+            self.logger.warning(
+                f"Camera {camera_id} exited, restarting in {CAMERA_RESTART_DELAY}s"
+            )
+            await asyncio.sleep(CAMERA_RESTART_DELAY)
+
+
+def worker_main(
+    worker_id: int,
+    conn: Connection,
+    heartbeat_interval: float,
+    level: int,
+    monitor_args: argparse.Namespace,
+) -> None:
+    worker = Worker(worker_id, conn, heartbeat_interval, monitor_args)
+    coloredlogs.install(level=level, logger=worker.logger)
+    asyncio.run(worker.run())
+
+
+class WorkerHandle:
+    def __init__(self, worker_id: int) -> None:
+        self.worker_id = worker_id
+        self.process: Optional[multiprocessing.Process] = None
+        self.conn: Optional[Connection] = None
+        self.cameras: set[str] = set()
+        # Cameras removed from the worker that it has not confirmed stopping
+        self.stopping: set[str] = set()
+        self.started_at: float = 0
+        self.last_heartbeat: float = 0
+        self.load: dict[str, Any] = {}
+        self.failures: int = 0
+        self.restart_at: Optional[float] = None
+
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+
+class Supervisor:
+    """
+    Shards cameras across worker processes, replaces workers that die or stop
+    sending heartbeats and rebalances cameras so every worker runs a similar
+    number of them. A camera is only started on a worker once any other worker
+    running it confirmed stopping it, and cameras of a dead worker stay where
+    they were reassigned when it comes back.
+
+    With a lease manager only the cameras this host holds a lease on are run,
+    so the camera list can be shared by several hosts.
+    """
+
+    def __init__(
+        self,
+        cameras: dict[str, list[str]],
+        num_workers: int,
+        heartbeat_interval: float,
+        logger: logging.Logger,
+        leases: Optional[LeaseManager] = None,
+        max_cpu: Optional[float] = None,
+        monitor_args: Optional[argparse.Namespace] = None,
+    ) -> None:
+        if monitor_args is None:
+            parser = argparse.ArgumentParser()
+            add_loop_monitor_args(parser)
+            monitor_args = parser.parse_args([])
+        self.cameras = cameras
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = 3 * heartbeat_interval
+        self.logger = logger
+        self.workers = [WorkerHandle(i) for i in range(num_workers)]
+        self.leases = leases
+        self.max_cpu = max_cpu
+        self.monitor_args = monitor_args
+        self.active: set[str] = set() if leases else set(cameras)
+        # Cameras restarted once on another worker, never moved again
+        self._settled: set[str] = set()
+        # Lease update running in the executor, the store may block
+        self._lease_sync: Optional[Future] = None
+        self._stopping = False
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for worker in self.workers:
+            self._start_worker(worker)
+
+        last_report, last_sync = time.monotonic(), 0.0
+        while not self._stopping:
+            now = time.monotonic()
+            if self._lease_sync and self._lease_sync.done():
+                self._apply_leases(self._lease_sync.result())
+                self._lease_sync = None
+            if (
+                self.leases
+                and not self._lease_sync
+                and now - last_sync >= self.heartbeat_interval
+            ):
+                self._sync_leases()
+                last_sync = now
+
+            for worker in self.workers:
+                self._check_worker(worker, now)
+            self._rebalance()
+
+            if now - last_report >= 6 * self.heartbeat_interval:
+                self._report()
+                last_report = now
+
+            conns = [w.conn for w in self.workers if w.conn and w.is_running()]
+            for conn in wait(conns, timeout=self.heartbeat_interval):
+                self._on_message(conn)
+
+        self._shutdown()
+        if self.leases:
+            if self._lease_sync:
+                self.active = self._lease_sync.result()
+            # Every camera is stopped once the workers exited
+            self.leases.release(self.active)
+
+    def _sync_leases(self) -> None:
+        assert self.leases
+        running = [w for w in self.workers if w.is_running() and w.load]
+        overloaded = (
+            self.max_cpu is not None
+            and bool(running)
+            and sum(w.load.get("cpu_percent", 0) for w in running) / len(running)
+            > self.max_cpu
+        )
+        # Leases of handed off cameras are kept until their worker confirmed
+        # stopping them
+        stopping = set().union(*(w.stopping for w in self.workers))
+        self._lease_sync = get_executor().submit(
+            self.leases.update,
+            list(self.cameras),
+            set(self.active),
+            overloaded,
+            stopping,
+        )
+
+    def _apply_leases(self, wanted: set[str]) -> None:
+        for camera_id in self.active - wanted:
+            self._remove(camera_id)
+        self.active = wanted
+
+    def _stop(self, signum, frame) -> None:
+        self._stopping = True
+
+    def _start_worker(self, worker: WorkerHandle) -> None:
+        parent_conn, child_conn = multiprocessing.Pipe()
+        worker.process = multiprocessing.Process(
+            target=worker_main,
+            args=(
+                worker.worker_id,
+                child_conn,
+                self.heartbeat_interval,
+                self.logger.getEffectiveLevel(),
+                self.monitor_args,
+            ),
+            name=f"unifi-cam-proxy-worker-{worker.worker_id}",
+            daemon=True,
+        )
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+        worker.started_at = worker.last_heartbeat = time.monotonic()
+        worker.restart_at = None
+        worker.load = {}
+        worker.stopping = set()
+        self.logger.info(
+            f"Started worker {worker.worker_id} (pid {worker.process.pid})"
+        )
+
+    def _send(self, worker: WorkerHandle, command: str, camera_id: str) -> None:
+        assert worker.conn
+        try:
+            worker.conn.send((command, camera_id, self.cameras[camera_id]))
+        except OSError:
+            # Picked up as a dead worker on the next check
+            pass
+
+    def _assign(self, camera_id: str) -> None:
+        running = [w for w in self.workers if w.is_running()]
+        if not running or any(camera_id in w.stopping for w in self.workers):
+            # Assigned again once stopped, never run twice
+            return
+        worker = min(running, key=lambda w: len(w.cameras))
+        worker.cameras.add(camera_id)
+        self._send(worker, "add", camera_id)
+
+    def _remove(self, camera_id: str) -> None:
+        self._settled.discard(camera_id)
+        for worker in self.workers:
+            if camera_id in worker.cameras:
+                self._stop_camera(worker, camera_id)
+
+    def _stop_camera(self, worker: WorkerHandle, camera_id: str) -> None:
+        worker.cameras.discard(camera_id)
+        if worker.is_running():
+            worker.stopping.add(camera_id)
+            self._send(worker, "remove", camera_id)
+
+    def _on_message(self, conn: Connection) -> None:
+        worker = next(w for w in self.workers if w.conn is conn)
+        try:
+            kind, payload = conn.recv()
+        except (EOFError, OSError):
+            return
+        if kind == "heartbeat":
+            worker.last_heartbeat = time.monotonic()
+            worker.load = payload
+        elif kind == "stopped":
+            worker.stopping.discard(payload)
+
+    def _check_worker(self, worker: WorkerHandle, now: float) -> None:
+        if worker.restart_at is not None:
+            if now >= worker.restart_at:
+                self._start_worker(worker)
+            return
+
+        alive = worker.is_running()
+        if alive and now - worker.last_heartbeat < self.heartbeat_timeout:
+            if now - worker.started_at >= WORKER_STABLE_AFTER:
+                worker.failures = 0
+            return
+
+        assert worker.process
+        if alive:
+            self.logger.error(
+                f"Worker {worker.worker_id} stopped responding, terminating it"
+            )
+            worker.process.kill()
+        worker.process.join(timeout=5)
+        self.logger.error(
+            f"Worker {worker.worker_id} died (exit code {worker.process.exitcode})"
+        )
+        if worker.conn:
+            worker.conn.close()
+            worker.conn = None
+        worker.stopping = set()
+
+        delay = min(
+            WORKER_RESTART_DELAY * 2**worker.failures, WORKER_RESTART_MAX_DELAY
+        )
+        worker.failures += 1
+        worker.restart_at = now + delay
+
+        # Keep the orphaned cameras running on the remaining workers, where
+        # they stay once this one is back
+        orphans, worker.cameras = worker.cameras, set()
+        for camera_id in orphans:
+            self._assign(camera_id)
+            self._settled.add(camera_id)
+
+    def _rebalance(self) -> None:
+        running = [w for w in self.workers if w.is_running()]
+        unassigned = self.active.difference(*(w.cameras for w in self.workers))
+        for camera_id in unassigned:
+            self._assign(camera_id)
+
+        # One move at a time, the camera is assigned to the idlest worker
+        # once the busiest confirmed stopping it
+        if not running or any(w.stopping for w in self.workers):
+            return
+        busiest = max(running, key=lambda w: len(w.cameras))
+        idlest = min(running, key=lambda w: len(w.cameras))
+        movable = sorted(busiest.cameras - self._settled)
+        if len(busiest.cameras) - len(idlest.cameras) <= 1 or not movable:
+            return
+        camera_id = movable[0]
+        self.logger.info(
+            f"Moving camera {camera_id} from worker {busiest.worker_id}"
+            f" to worker {idlest.worker_id}"
+        )
+        self._stop_camera(busiest, camera_id)
+
+    def _report(self) -> None:
+        for worker in self.workers:
+            state = "running" if worker.is_running() else "restarting"
+            self.logger.info(
+                f"Worker {worker.worker_id} ({state}): {len(worker.cameras)} cameras,"
+                f" {worker.load.get('cpu_percent', 0)}% CPU, event loop lag up to"
+                f" {worker.load.get('loop', {}).get('max_lag_ms', 0)}ms"
+            )
+
+    def _shutdown(self) -> None:
+        self.logger.info("Stopping workers")
+        for worker in self.workers:
+            if worker.is_running():
+                assert worker.process
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process:
+                worker.process.join(timeout=10)
+                if worker.process.is_alive():
+                    worker.process.kill()
+
+
+def parse_supervisor_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Run many cameras sharded across worker processes"
+    )
+    parser.add_argument(
+        "--cameras",
+        required=True,
+        help="File with the unifi-cam-proxy arguments of one camera per line",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        default=os.cpu_count() or 1,
+        type=int,
+        help="Number of worker processes (default: number of cores)",
+    )
+    parser.add_argument(
+        "--heartbeat-interval",
+        default=5,
+        type=float,
+        help="Seconds between worker health reports",
+    )
+    parser.add_argument(
+        "--cluster-store",
+        default=None,
+        help="SQLite database shared with other hosts to split the cameras between"
+        " them (default: run every camera)",
+    )
+    parser.add_argument(
+        "--node-id",
+        default=socket.gethostname(),
+        help="Unique name of this host in the cluster",
+    )
+    parser.add_argument(
+        "--lease-ttl",
+        default=30,
+        type=float,
+        help="Seconds before the cameras of an unresponsive host are taken over",
+    )
+    parser.add_argument(
+        "--max-cameras",
+        default=None,
+        type=int,
+        help="Maximum number of cameras this host claims in a cluster",
+    )
+    parser.add_argument(
+        "--max-cpu",
+        default=None,
+        type=float,
+        help="Average worker CPU percentage above which cameras are handed off to"
+        " other hosts in a cluster",
+    )
+    parser.add_argument(
+        "--verbose", "-v", action="store_true", help="increase output verbosity"
+    )
+    add_loop_monitor_args(parser)
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_supervisor_args()
+    logger = logging.getLogger("Supervisor")
+    coloredlogs.install(
+        level=logging.DEBUG if args.verbose else logging.INFO, logger=logger
+    )
+
+    if not check_dependencies(logger):
+        sys.exit(1)
+
+    try:
+        cameras = load_cameras(args.cameras, logger)
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not load camera list: {e}")
+        sys.exit(1)
+
+    leases = None
+    if args.cluster_store:
+        try:
+            store = SQLiteLeaseStore(args.cluster_store)
+        except LeaseStoreError as e:
+            logger.error(f"Could not open cluster store: {e}")
+            sys.exit(1)
+        leases = LeaseManager(
+            store, args.node_id, args.lease_ttl, logger, args.max_cameras
+        )
+        logger.info(f"Joining cluster as {args.node_id}")
+
+    num_workers = max(1, min(args.workers, len(cameras)))
+    logger.info(f"Running up to {len(cameras)} cameras on {num_workers} workers")
+    Supervisor(
+        cameras,
+        num_workers,
+        args.heartbeat_interval,
+        logger,
+        leases=leases,
+        max_cpu=args.max_cpu,
+        monitor_args=args,
+    ).run()
+
+
+if __name__ == "__main__":
+    main()